@@ -0,0 +1,106 @@
+"""
+Time SwiftDBTracker against a generated tree of container DBs.
+
+    python -m benchmarks.bench_db_tracker [--dbs N] [--devices N] [--dir PATH]
+
+Reports a cold pass (every DB opened), a warm pass (nothing changed), and a
+pass after touching a tenth of the DBs.
+"""
+import argparse
+import hashlib
+import os
+import pathlib
+import queue
+import random
+import sqlite3
+import tempfile
+import time
+
+from swift_metrics.swift_db_stats import SwiftDBTracker
+
+
+SCHEMA = '''
+CREATE TABLE container_stat (
+    account TEXT,
+    container TEXT,
+    created_at TEXT,
+    put_timestamp TEXT DEFAULT '0',
+    delete_timestamp TEXT DEFAULT '0',
+    object_count INTEGER,
+    bytes_used INTEGER,
+    metadata TEXT DEFAULT ''
+);
+CREATE TABLE object (
+    ROWID INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    created_at TEXT,
+    size INTEGER,
+    content_type TEXT,
+    etag TEXT,
+    deleted INTEGER DEFAULT 0
+);
+'''
+
+
+def make_tree(root: pathlib.Path, dbs: int, devices: int) -> None:
+    rng = random.Random(dbs)
+    for i in range(dbs):
+        account, container = f'AUTH_test{i % 17}', f'c{i}'
+        hash_ = hashlib.md5(f'/{account}/{container}'.encode()).hexdigest()
+        hash_path = (root / f'd{i % devices}' / 'containers' /
+                     str(rng.randrange(1024)) / hash_[-3:] / hash_)
+        hash_path.mkdir(parents=True, exist_ok=True)
+        names = [f'{hash_}.db']
+        if i % 50 == 0:
+            names.append(f'{hash_}_{time.time():016.5f}.db')
+        for name in names:
+            conn = sqlite3.connect(hash_path / name)
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.executescript(SCHEMA)
+            conn.execute(
+                'INSERT INTO container_stat (account, container, '
+                'created_at, object_count, bytes_used, metadata) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (account, container, '0', rng.randrange(10 ** 6),
+                 rng.randrange(10 ** 12),
+                 '{"X-Container-Sysmeta-Sharding": ["True", "0"]}'
+                 if i % 50 == 0 else ''))
+            conn.commit()
+            conn.close()
+        if i % 3 == 0:
+            (hash_path / f'{hash_}.db.pending').write_bytes(
+                b':' * rng.randrange(1, 4096))
+
+
+def timed(tracker: SwiftDBTracker) -> float:
+    start = time.perf_counter()
+    tracker.get_stats()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dbs', type=int, default=5000)
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--dir', help='reuse (or create) a tree here')
+    args = parser.parse_args()
+
+    root = pathlib.Path(args.dir or tempfile.mkdtemp(prefix='bench_db_'))
+    if not any(root.glob('*/containers')):
+        start = time.perf_counter()
+        make_tree(root, args.dbs, args.devices)
+        print(f'generated {args.dbs} DBs in {root} '
+              f'({time.perf_counter() - start:.1f}s)')
+
+    tracker = SwiftDBTracker(queue.Queue(), {'devices': str(root)})
+    print(f'cold:    {timed(tracker):.3f}s')
+    print(f'warm:    {timed(tracker):.3f}s')
+
+    dbs = sorted(root.glob('*/containers/*/*/*/*.db'))
+    for path in dbs[::10]:
+        os.utime(path, ns=(time.time_ns(), time.time_ns()))
+    print(f'touched: {timed(tracker):.3f}s ({len(dbs[::10])} DBs changed)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Time FederationTracker against local stand-ins for many swift_metrics nodes.
+
+    python -m benchmarks.bench_federation [--nodes N] [--devices N]
+        [--rounds N] [--concurrency N]
+
+Every node serves partitions per device (a gauge) and request counts (a
+counter). Each round bumps the counters; halfway through, one node
+"restarts" and its counters go back to zero. After every round the rollups
+are checked against what they should add up to, and how long the round
+took is printed along with how many connections the nodes had to accept --
+with keep-alive working, that's one per node for the whole run.
+"""
+# monkey patches; socketserver has to see the green selectors
+import swift_metrics  # noqa: F401
+
+import argparse
+import http.server
+import queue
+import threading
+import time
+import typing
+
+from swift_metrics import federation
+
+
+class Node(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    devices = 0
+    requests = 0  # each device's request counter
+    connections = 0
+
+    def body(self) -> bytes:
+        lines = [
+            '# HELP partitions Partitions on disk',
+            '# TYPE partitions gauge',
+        ]
+        for d in range(self.devices):
+            for policy in range(2):
+                lines.append(f'partitions{{device="d{d}",policy="{policy}",'
+                             f'type="primary"}} 100')
+        lines.extend((
+            '# HELP swift_requests Requests',
+            '# TYPE swift_requests counter',
+        ))
+        for d in range(self.devices):
+            for status in ('200', '404'):
+                lines.append(f'swift_requests{{device="d{d}",policy_idx="0",'
+                             f'status="{status}",target_layer="object"}} '
+                             f'{self.requests}')
+        lines.extend((
+            '# HELP unrelated Something nobody rolls up',
+            '# TYPE unrelated gauge',
+        ))
+        lines.extend(f'unrelated{{pid="{p}"}} 1' for p in range(200))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: Node
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self) -> None:
+        body = self.server.body()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: typing.Any) -> None:
+        pass
+
+
+def rollups(stats: typing.Iterable[swift_metrics.Stat]) -> typing.Dict[
+        typing.Tuple[str, typing.Tuple[typing.Tuple[str, str], ...]], float]:
+    return {(s.name, s.labels): s.value for s in stats}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--devices', type=int, default=24)
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--concurrency', default='64')
+    args = parser.parse_args()
+
+    nodes = []
+    for _ in range(args.nodes):
+        node = Node(('127.0.0.1', 0), Handler)
+        node.devices = args.devices
+        threading.Thread(target=node.serve_forever, daemon=True).start()
+        nodes.append(node)
+    tracker = federation.FederationTracker(queue.Queue(), {
+        'targets': ','.join(
+            f'127.0.0.1:{n.server_address[1]}' for n in nodes),
+        'rollups': 'partitions:policy;swift_requests:status',
+        'concurrency': args.concurrency,
+    })
+
+    total = 0  # what each rolled-up request counter should be by now
+    for i in range(args.rounds):
+        for node in nodes:
+            node.requests += 5
+        total += 5 * args.nodes * args.devices
+        if i == args.rounds // 2:
+            # a restart: back to zero, then this round's requests
+            nodes[0].requests = 5
+        start = time.perf_counter()
+        got = rollups(tracker.collect())
+        elapsed = time.perf_counter() - start
+
+        want_partitions = 100 * args.nodes * args.devices
+        for key, want in (
+            (('partitions', (('policy', '0'),)), want_partitions),
+            (('partitions', (('policy', '1'),)), want_partitions),
+            (('swift_requests', (('status', '200'),)), total),
+            (('swift_requests', (('status', '404'),)), total),
+        ):
+            if got.get(key) != want:
+                raise SystemExit(f'round {i}: {key} is {got.get(key)}, '
+                                 f'expected {want}')
+        up = sum(v for (name, _), v in got.items()
+                 if name == 'federation_target_up')
+        print(f'round {i}: {elapsed:7.3f}s  {up}/{args.nodes} up  '
+              f'{sum(n.connections for n in nodes)} connections  '
+              f'{len(got)} series out')
+    print('rollups add up')
+
+
+if __name__ == '__main__':
+    main()
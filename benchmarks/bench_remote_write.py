@@ -0,0 +1,130 @@
+"""
+Time RemoteWriteTracker pushing to a local stand-in receiver.
+
+    python -m benchmarks.bench_remote_write [--series N] [--changed 0.1]
+
+Reports how long it takes to encode everything, a first push (every series
+sent), a push where only ``--changed`` of them changed, and getting through
+a short outage: one push spooled while the receiver answers 503, then the
+push that drains the spool.
+"""
+# monkey patches; socketserver has to see the green selectors
+import swift_metrics  # noqa: F401
+
+import argparse
+import http.server
+import pathlib
+import queue
+import tempfile
+import threading
+import time
+import typing
+
+from swift_metrics import remote_write
+from swift_metrics import Stat
+from swift_metrics import WriteOnceStatCollection
+
+
+class SeriesStat(Stat):
+    name = 'bench_series'
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = 'Made-up series'
+
+
+class Receiver(http.server.ThreadingHTTPServer):
+    status = 204
+    requests = 0
+    bytes = 0
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: Receiver
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        self.server.bytes += len(body)
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args: typing.Any) -> None:
+        pass
+
+
+class FakeManager:
+    def __init__(self, series: int) -> None:
+        self.values = [0] * series
+
+    def touch(self, fraction: float) -> None:
+        for i in range(0, len(self.values), round(1 / fraction)):
+            self.values[i] += 1
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        now = Stat.now()
+        return WriteOnceStatCollection(
+            SeriesStat(v, now, (
+                ('device', f'd{i % 48}'),
+                ('policy', str(i % 4)),
+                ('series', str(i)),
+            ))
+            for i, v in enumerate(self.values))
+
+
+def timed(label: str, func: typing.Callable[[], typing.Any],
+          receiver: Receiver, series: int) -> None:
+    requests, sent = receiver.requests, receiver.bytes
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<10} {elapsed:7.3f}s  {series / elapsed:>10,.0f} series/s'
+          f'  {receiver.requests - requests:>4} requests'
+          f'  {(receiver.bytes - sent) / 2**20:7.2f}MiB')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=50000)
+    parser.add_argument('--changed', type=float, default=0.1)
+    args = parser.parse_args()
+
+    receiver = Receiver(('127.0.0.1', 0), Handler)
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    manager = FakeManager(args.series)
+    tracker = remote_write.RemoteWriteTracker(queue.Queue(), {
+        'manager': manager,
+        'url': f'http://127.0.0.1:{receiver.server_address[1]}/write',
+        'spool_dir': tempfile.mkdtemp(prefix='bench_spool_'),
+        'max_retries': '0',
+    })
+    print(f'snappy: {"python-snappy" if remote_write.snappy else "literal"}')
+
+    stats = manager.get_stats()
+    start = time.perf_counter()
+    for body, _ in remote_write.RemoteWriteTracker(queue.Queue(), {
+        'manager': manager, 'url': 'http://unused/',
+    }).batches(stats):
+        remote_write.compress(body)
+    elapsed = time.perf_counter() - start
+    print(f'{"encode":<10} {elapsed:7.3f}s  '
+          f'{args.series / elapsed:>10,.0f} series/s')
+
+    timed('first', tracker.get_stats, receiver, args.series)
+    manager.touch(args.changed)
+    timed('changed', tracker.get_stats, receiver, args.series)
+
+    receiver.status = 503
+    manager.touch(args.changed)
+    timed('outage', tracker.get_stats, receiver, args.series)
+    spooled = sum(p.stat().st_size for p in tracker.spool.files())
+    print(f'{"":<10} {len(tracker.spool.files())} requests, '
+          f'{spooled / 2**20:.2f}MiB spooled in '
+          f'{pathlib.Path(tracker.spool.path)}')
+    receiver.status = 204
+    manager.touch(args.changed)
+    timed('recovery', tracker.get_stats, receiver, args.series)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Time trackers against synthetic storage nodes of a few sizes.
+
+    python -m benchmarks.bench_trackers [--scales small,medium]
+        [--trackers disk,process] [--scrapes N] [--dir PATH] [--json FILE]
+
+Each node gets generated under ``--dir`` (or a temp dir) the first time
+it's needed and reused after. For every tracker and scale, prints the
+median wall/CPU time per scrape and the peak memory of an instrumented
+scrape; ``--json`` saves the full ``swift_metrics.benchmark`` reports.
+"""
+import argparse
+import json
+import os
+import pathlib
+import queue
+import sys
+import tempfile
+import time
+import typing
+
+from swift_metrics import benchmark
+from swift_metrics.df_stats import DiskTracker
+from swift_metrics.iptables_counters import IPTablesTracker
+from swift_metrics.process_info import ProcessTracker
+from swift_metrics.swift_stats import SwiftRingAssignmentTracker
+
+from . import synthetic_node
+
+
+TRACKERS = {
+    'ring': SwiftRingAssignmentTracker,
+    'disk': DiskTracker,
+    'process': ProcessTracker,
+    'iptables': IPTablesTracker,
+}
+
+
+def node(base: pathlib.Path, scale: str) -> pathlib.Path:
+    root = base / scale
+    if not (root / 'bin').exists():
+        start = time.perf_counter()
+        synthetic_node.make_node(root, synthetic_node.SCALES[scale])
+        print(f'generated {scale} node in {root} '
+              f'({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+    return root
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default='small,medium',
+                        help=f'comma-separated, from '
+                             f'{",".join(synthetic_node.SCALES)}')
+    parser.add_argument('--trackers', default=','.join(TRACKERS),
+                        help='comma-separated (default: %(default)s)')
+    parser.add_argument('--scrapes', type=int, default=5)
+    parser.add_argument('--dir', help='reuse (or create) nodes here')
+    parser.add_argument('--json', help='write full reports here')
+    args = parser.parse_args()
+
+    base = pathlib.Path(args.dir or tempfile.mkdtemp(prefix='bench_node_'))
+    results: typing.List[typing.Dict[str, typing.Any]] = []
+    print(f'{"tracker":<10} {"scale":<8} {"stats":>7} {"wall":>9} '
+          f'{"cpu":>9} {"peak mem":>10}')
+    for scale in args.scales.split(','):
+        root = node(base, scale)
+        os.environ['PATH'] = f'{root / "bin"}:{os.environ["PATH"]}'
+        try:
+            for name in args.trackers.split(','):
+                tracker = TRACKERS[name](
+                    queue.Queue(), synthetic_node.conf(root))
+                result = benchmark.run(tracker, args.scrapes)
+                result['scale'] = scale
+                results.append(result)
+                print(f'{name:<10} {scale:<8} '
+                      f'{result["stats_per_scrape"]["max"]:>7} '
+                      f'{result["wall_seconds"]["median"]:>8.3f}s '
+                      f'{result["cpu_seconds"]["median"]:>8.3f}s '
+                      f'{result["allocations"]["peak_bytes"] / 2**20:>7.1f}'
+                      f'MiB')
+        finally:
+            os.environ['PATH'] = os.environ['PATH'].split(':', 1)[1]
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Generate a fake storage node for trackers to run against:
+
+* ``etc/``: swift.conf and account/container/object rings, with this node's
+  devices on 127.0.0.1 alongside some on other (fake) nodes
+* ``node/``: a devices dir with each device's partitions (primaries and a
+  few handoffs), suffixes and hashdirs, and a ``hashes.pkl`` per object
+  partition
+* ``proc/``: stat/io files for a tree of swift processes, plus uptime
+* ``bin/``: ``ps``, ``lsof``, ``df``, ``getconf`` and ``iptables-save``
+  stand-ins that print recorded output from ``out/``
+
+    python -m benchmarks.synthetic_node DIR [--scale small]
+
+``conf()`` gives the tracker config for a node; its ``bin/`` needs to go
+first on ``PATH``, too.
+"""
+import argparse
+import dataclasses
+import hashlib
+import os
+import pathlib
+import random
+import shlex
+import typing
+
+import swift.common.ring  # type: ignore
+import swift.common.utils  # type: ignore
+import swift.obj.diskfile  # type: ignore
+
+
+LOCAL_IP = '127.0.0.1'
+HASH_PATH_SUFFIX = 'synthetic'
+SERVERS = (  # ring, port, server process
+    ('account', 6202, 'swift-account-server'),
+    ('container', 6201, 'swift-container-server'),
+    ('object', 6200, 'swift-object-server'),
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class Scale:
+    devices: int  # local; there are as many again on other nodes
+    part_power: int
+    suffixes: int  # per partition
+    hashdirs: int  # per suffix
+    processes: int  # workers, split between the servers
+    connections: int  # per worker
+
+
+SCALES = {
+    'small': Scale(2, 8, 8, 2, 12, 4),
+    'medium': Scale(4, 10, 16, 2, 48, 16),
+    'large': Scale(8, 12, 32, 2, 192, 64),
+}
+
+
+def make_rings(etc: pathlib.Path, scale: Scale) -> None:
+    etc.mkdir(parents=True, exist_ok=True)
+    (etc / 'swift.conf').write_text(
+        f'[swift-hash]\nswift_hash_path_suffix = {HASH_PATH_SUFFIX}\n'
+        '[storage-policy:0]\nname = gold\ndefault = yes\n')
+    for ring_name, port, _ in SERVERS:
+        builder = swift.common.ring.RingBuilder(scale.part_power, 3, 1)
+        for i in range(scale.devices * 2):
+            builder.add_dev({
+                'id': i,
+                'region': 1,
+                'zone': i % 3,
+                'ip': LOCAL_IP if i < scale.devices else f'10.0.0.{i}',
+                'port': port,
+                'device': f'd{i}',
+                'weight': 100,
+            })
+        builder.rebalance(seed=scale.part_power)
+        builder.get_ring().save(str(etc / f'{ring_name}.ring.gz'))
+
+
+def make_devices(node: pathlib.Path, etc: pathlib.Path,
+                 scale: Scale) -> None:
+    rng = random.Random(scale.part_power)
+    swift.common.utils.set_swift_dir(str(etc))
+    for ring_name, _, _ in SERVERS:
+        ring = swift.common.ring.Ring(str(etc / f'{ring_name}.ring.gz'))
+        parts: typing.Dict[int, typing.Set[int]] = {
+            dev_id: set() for dev_id in range(scale.devices)}
+        for part2dev_id in ring._replica2part2dev_id:
+            for part, dev_id in enumerate(part2dev_id):
+                if dev_id in parts:
+                    parts[dev_id].add(part)
+        for dev_id, primaries in parts.items():
+            # and some handoffs left behind by a rebalance
+            others = sorted(set(range(ring.partition_count)) - primaries)
+            handoffs = rng.sample(
+                others, min(len(others), ring.partition_count // 20))
+            policy_dir = node / f'd{dev_id}' / f'{ring_name}s'
+            for part in primaries.union(handoffs):
+                make_partition(policy_dir / str(part), ring_name, scale, rng)
+
+
+def make_partition(part_dir: pathlib.Path, ring_name: str, scale: Scale,
+                   rng: random.Random) -> None:
+    hashes: typing.Dict[str, typing.Any] = {'valid': True}
+    for suffix in rng.sample(range(4096), scale.suffixes):
+        suffix_dir = part_dir / f'{suffix:03x}'
+        for _ in range(scale.hashdirs):
+            hash_ = f'{rng.getrandbits(116):029x}{suffix:03x}'
+            (suffix_dir / hash_).mkdir(parents=True)
+        # a few suffixes are always waiting on a rehash
+        hashes[suffix_dir.name] = (
+            None if rng.random() < 0.05
+            else hashlib.md5(suffix_dir.name.encode()).hexdigest())
+    if ring_name == 'object':
+        swift.obj.diskfile.write_hashes(str(part_dir), hashes)
+
+
+def make_proc(root: pathlib.Path, scale: Scale) -> None:
+    """
+    A swift process tree: a parent per server, with workers under each,
+    and the ``ps``/``lsof`` output that goes with it.
+    """
+    proc = root / 'proc'
+    out = root / 'out'
+    (out / 'lsof').mkdir(parents=True, exist_ok=True)
+    (proc / 'uptime').parent.mkdir(parents=True, exist_ok=True)
+    (proc / 'uptime').write_text('864000.00 1728000.00\n')
+    rng = random.Random(scale.processes)
+    ps_lines = []
+    pid = 1000
+    for _, port, server in SERVERS:
+        parent = pid
+        workers = range(parent + 1, parent + 1 + scale.processes // 3)
+        pid = workers.stop
+        for p in (parent, *workers):
+            utime, stime = rng.randrange(10 ** 6), rng.randrange(10 ** 5)
+            ps_lines.append(
+                f'{parent} {1 if p == parent else parent} {p} 1.5 '
+                f'{rng.randrange(10 ** 5, 10 ** 6)} '
+                f'{rng.randrange(10 ** 6, 10 ** 7)} 86400 '
+                f'{(utime + stime) // 100} /usr/bin/python3 '
+                f'/usr/bin/{server} /etc/swift/{server[6:]}.conf')
+            (proc / str(p)).mkdir(exist_ok=True)
+            stat = ['0'] * 52
+            stat[:3] = [str(p), f'({server[:15]})', 'S']
+            stat[13], stat[14], stat[21] = (
+                str(utime), str(stime), str(100 * 10 ** 5))
+            (proc / str(p) / 'stat').write_text(' '.join(stat) + '\n')
+            (proc / str(p) / 'io').write_text(
+                f'rchar: 0\nwchar: 0\n'
+                f'read_bytes: {rng.randrange(10 ** 12)}\n'
+                f'write_bytes: {rng.randrange(10 ** 12)}\n')
+            lines = [f'p{p}\x00']
+            for fd in range(scale.connections):
+                if fd % 4:
+                    name = (f'{LOCAL_IP}:{port}->'
+                            f'10.0.0.{fd % 250}:{40000 + fd}')
+                else:  # talking to another node's object server
+                    name = (f'{LOCAL_IP}:{40000 + fd}->'
+                            f'10.0.0.{fd % 250}:6200')
+                lines.append(
+                    f'f{fd + 10}\x00n{name}\x00TST=ESTABLISHED\x00'
+                    f'TQR={rng.randrange(4096)}\x00'
+                    f'TQS={rng.randrange(4096)}\x00')
+            (out / 'lsof' / str(p)).write_text('\n'.join(lines) + '\n')
+    (out / 'ps').write_text('\n'.join(ps_lines) + '\n')
+
+
+def make_commands(root: pathlib.Path, scale: Scale) -> None:
+    out = root / 'out'
+    out.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(scale.devices)
+    df = ['Filesystem 1B-blocks Used Available Use% Mounted on']
+    for i in range(scale.devices):
+        total = 8 * 10 ** 12
+        used = rng.randrange(total)
+        df.append(f'/dev/sd{chr(97 + i)} {total} {used} {total - used} '
+                  f'{100 * used // total}% {root / "node" / f"d{i}"}')
+    (out / 'df').write_text('\n'.join(df) + '\n')
+
+    save = ['*filter', ':INPUT ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]',
+            ':SWIFT_METRICS_INPUT - [0:0]', ':SWIFT_METRICS_OUTPUT - [0:0]',
+            '-A INPUT -j SWIFT_METRICS_INPUT',
+            '-A OUTPUT -j SWIFT_METRICS_OUTPUT']
+    for port in (6200, 6201, 6202, 8080, 11211):
+        for chain, opt in (('INPUT', 'dport'), ('OUTPUT', 'sport')):
+            save.append(
+                f'[{rng.randrange(10 ** 9)}:{rng.randrange(10 ** 13)}] '
+                f'-A SWIFT_METRICS_{chain} -p tcp -m tcp --{opt} {port}')
+    save.append('COMMIT')
+    (out / 'iptables-save').write_text('\n'.join(save) + '\n')
+
+    out_dir = shlex.quote(str(out))
+    scripts = {
+        'ps': f'cat {out_dir}/ps',
+        'df': f'cat {out_dir}/df',
+        'getconf': 'echo 100',
+        'iptables-save': f'cat {out_dir}/iptables-save',
+        'ip6tables-save': f'cat {out_dir}/iptables-save',
+        # find the -p PID argument
+        'lsof': ('while [ "$1" != -p ]; do shift; done\n'
+                 f'cat {out_dir}/lsof/"$2" 2>/dev/null || exit 1'),
+    }
+    bin_dir = root / 'bin'
+    bin_dir.mkdir(exist_ok=True)
+    for name, body in scripts.items():
+        path = bin_dir / name
+        path.write_text(f'#!/bin/sh\n{body}\n')
+        path.chmod(0o755)
+
+
+def make_node(root: pathlib.Path, scale: Scale) -> None:
+    make_rings(root / 'etc', scale)
+    make_devices(root / 'node', root / 'etc', scale)
+    make_proc(root, scale)
+    make_commands(root, scale)
+
+
+def conf(root: pathlib.Path) -> typing.Dict[str, str]:
+    """
+    Config that points every tracker at the node under ``root``. Commands
+    are found on ``PATH``, so put ``root / 'bin'`` at the front of that.
+    """
+    return {
+        'devices': str(root / 'node'),
+        'swift_dir': str(root / 'etc'),
+        'ring_ip': LOCAL_IP,
+        'cache_dir': str(root / 'cache'),
+        'proc_root': str(root / 'proc'),
+        'user': os.environ.get('USER', 'root'),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dir', type=pathlib.Path)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    args = parser.parse_args()
+    make_node(args.dir, SCALES[args.scale])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import eventlet
+import eventlet.greenthread
 import eventlet.hubs
+import eventlet.tpool
 eventlet.hubs.use_hub('poll')
 eventlet.monkey_patch()
 
+import argparse
 import collections.abc
 import dataclasses
+import functools
 import io
+import os
+import pathlib
 import queue
 import threading
 import time
@@ -17,23 +23,79 @@ import typing
 
 MEMCACHE_PORT = 11211
 RSYNC_PORT = 873
+# label value for series folded together to stay under a cardinality limit
+OVERFLOW = '__overflow__'
+TRUE_VALUES = ('1', 'on', 't', 'true', 'y', 'yes')
+
+T = typing.TypeVar('T')
+
+
+@dataclasses.dataclass(frozen=True)
+class PortInfo:
+    type: str
+    # which policy/device the port serves, when it's just the one; that is,
+    # for servers-per-port object ports
+    labels: typing.Tuple[typing.Tuple[str, str], ...] = ()
+
+
+# always the same, whatever the rings say
+WELL_KNOWN_PORTS = {
+    8080: PortInfo('proxy'),
+    MEMCACHE_PORT: PortInfo('memcache'),
+    RSYNC_PORT: PortInfo('rsync'),
+}
+SWIFT_TYPES = ('object', 'container', 'account', 'proxy')
+
+
+def default_ports() -> typing.Dict[int, PortInfo]:
+    """
+    Swift's default ports, for when there are no rings to go on.
+    """
+    ports = {p: PortInfo('object') for p in range(6200, 6301)}
+    ports[6201] = PortInfo('container')
+    ports[6202] = PortInfo('account')
+    return ports
+
+
+class PortMap:
+    """
+    What each port is for, as a dict lookup. Until it's given the ports
+    from the rings (see SwiftRingAssignmentTracker.reload_rings), it goes
+    by Swift's defaults.
+    """
+
+    def __init__(self) -> None:
+        self.ports: typing.Dict[int, PortInfo] = {}
+        self.update(None)
+
+    def update(
+        self,
+        ring_ports: typing.Optional[typing.Dict[int, PortInfo]],
+    ) -> None:
+        ports = default_ports() if not ring_ports else dict(ring_ports)
+        ports.update(WELL_KNOWN_PORTS)
+        self.ports = ports  # swapped in whole, so readers needn't lock
+
+    def info(self, port: int) -> PortInfo:
+        # ports may come back as strings, e.g. from a saved process tree
+        port = int(port)
+        info = self.ports.get(port)
+        if info is None:
+            return PortInfo(f'other ({port!r})')
+        return info
+
+
+PORTS = PortMap()
 
 
 def is_swift_port(port: int) -> bool:
-    return port == 8080 or 6200 <= port <= 6300
+    # a port shared between servers is labelled like ``container+object``
+    return all(type_ in SWIFT_TYPES
+               for type_ in PORTS.info(port).type.split('+'))
 
 
 def categorize_destination_port(port: int) -> str:
-    port = int(port)
-    if port == 6200 or 6203 <= port <= 6300:
-        return 'object'
-    return {
-        6201: 'container',
-        6202: 'account',
-        8080: 'proxy',
-        11211: 'memcache',
-        873: 'rsync',
-    }.get(port) or f'other ({port!r})'
+    return PORTS.info(port).type
 
 
 def parse_netloc(netloc: str) -> typing.Optional[typing.Tuple[str, int]]:
@@ -48,6 +110,8 @@ class Stat:
     name: typing.ClassVar[str]
     help: typing.ClassVar[str]
     type: typing.ClassVar[typing.Literal["gauge", "counter"]]
+    # most series the family may have in the store; None for the default
+    max_series: typing.ClassVar[typing.Optional[int]] = None
     value: typing.Any
     timestamp: typing.Optional[int] = None
     labels: typing.Tuple[typing.Tuple[str, str], ...] = ()
@@ -90,6 +154,18 @@ class ScrapeTime(Stat):
     help = "Amount of time required to gather information (seconds)"
 
 
+class TrackerOverrunsStat(Stat):
+    name = "tracker_overruns"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Scrapes that took longer than the tracker's interval"
+
+
+class TrackerLastSuccessStat(Stat):
+    name = "tracker_last_success_timestamp"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "When the tracker last finished a scrape without error (unix time)"
+
+
 class StatCollection(collections.abc.Iterable):
     def __init__(self, stats: typing.Iterable[Stat] = None):
         self._stats: typing.Dict[Stat, Stat] = {}
@@ -123,6 +199,95 @@ class StatCollection(collections.abc.Iterable):
         return ''.join(doc)
 
 
+def overflow_labels(
+    labels: typing.Tuple[typing.Tuple[str, str], ...],
+) -> typing.Tuple[typing.Tuple[str, str], ...]:
+    """
+    What to label a series with once its family's over the limit. Histogram
+    buckets stay separate so the overflow series is still a histogram.
+    """
+    return tuple((label, value if label == 'le' else OVERFLOW)
+                 for label, value in labels)
+
+
+class LimitedStatCollection(StatCollection):
+    """
+    A StatCollection that holds at most ``limit`` series per family (or the
+    family's ``max_series``, or whatever ``limits`` says for it by name).
+
+    New series past that get folded into one per family, with every label
+    set to ``OVERFLOW``, whose value is the sum of theirs. Folded series
+    are remembered until they're pruned so that when they're updated, only
+    the difference goes into the sum.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        limits: typing.Optional[typing.Dict[str, int]] = None,
+        stats: typing.Iterable[Stat] = None,
+    ):
+        self.limit = limit
+        self.limits = limits or {}
+        self.counts: typing.Counter[str] = collections.Counter()
+        # family -> new series folded into the overflow series
+        self.rejected: typing.Counter[str] = collections.Counter()
+        self._folded: typing.Dict[Stat, Stat] = {}
+        self._overflow_keys: typing.Set[Stat] = set()
+        super().__init__(stats)
+
+    def family_limit(self, stat: Stat) -> int:
+        return (self.limits.get(stat.name) or stat.max_series
+                or self.limit)
+
+    def update(self, *stats: Stat) -> None:
+        for stat in stats:
+            key = dataclasses.replace(stat, value=0, timestamp=None)
+            if key in self._stats:
+                self._stats[key] = stat
+            elif key in self._folded:
+                self._fold(key, stat)
+            elif self.counts[stat.name] < self.family_limit(stat):
+                self.counts[stat.name] += 1
+                self._stats[key] = stat
+            else:
+                self.rejected[stat.name] += 1
+                self._fold(key, stat)
+
+    def _fold(self, key: Stat, stat: Stat) -> None:
+        old = self._folded.get(key)
+        self._folded[key] = stat
+        labels = overflow_labels(stat.labels)
+        overflow_key = dataclasses.replace(key, labels=labels)
+        self._overflow_keys.add(overflow_key)
+        current = self._stats.get(overflow_key)
+        total = ((current.value if current else 0) + stat.value
+                 - (old.value if old else 0))
+        self._stats[overflow_key] = dataclasses.replace(
+            stat, value=total, labels=labels)
+
+    def prune(self, max_age_ms: int) -> None:
+        now = Stat.now()
+        folded = [s for s in self._folded.values()
+                  if s.timestamp and s.timestamp + max_age_ms >= now]
+        self._stats = {
+            k: v for k, v in self._stats.items()
+            if v.timestamp and v.timestamp + max_age_ms >= now
+            and k not in self._overflow_keys
+        }
+        self.counts = collections.Counter(k.name for k in self._stats)
+        # rebuild the overflow series from what's left; some may fit now
+        self._folded = {}
+        self._overflow_keys = set()
+        for stat in folded:
+            key = dataclasses.replace(stat, value=0, timestamp=None)
+            if self.counts[stat.name] < self.family_limit(stat):
+                self.counts[stat.name] += 1
+                self._stats[key] = stat
+            else:
+                self._fold(key, stat)
+
+
 class WriteOnceStatCollection(StatCollection):
     def update(self, *stats: Stat) -> None:
         for stat in stats:
@@ -132,12 +297,236 @@ class WriteOnceStatCollection(StatCollection):
             self._stats[key] = stat
 
 
+class TokenBucket:
+    """
+    Rate limiter for I/O-heavy scans: ``consume()`` sleeps as needed so that
+    on average no more than ``rate`` tokens are handed out per second. A rate
+    of zero means unlimited.
+    """
+
+    def __init__(self, rate: float, burst: typing.Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    def consume(self, tokens: float = 1) -> None:
+        if not self.rate:
+            return
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= tokens
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class CallTimeout(Exception):
+    pass
+
+
+def blocking_call(timeout: float, func: typing.Callable[..., T],
+                  *args: typing.Any) -> T:
+    """
+    Make a blocking call (like a listdir on a disk that may be failing) in a
+    native thread, so that if it hangs it only takes that thread with it
+    rather than every greenthread in the process.
+
+    :raises CallTimeout: if the call takes longer than ``timeout``
+    """
+    desc = f'{func.__name__}({", ".join(str(a) for a in args[:1])})'
+    if timeout <= 0:
+        raise CallTimeout(f'no time left for {desc}')
+    with eventlet.Timeout(timeout, CallTimeout(
+            f'{desc} timed out after {timeout:.1f}s')):
+        return eventlet.tpool.execute(func, *args)
+
+
+class DeviceCalls:
+    """
+    blocking_call()s against the disks under ``devices_path``, keeping
+    track of which disk each one is for.
+
+    A CallTimeout frees the greenthread that was waiting, but the native
+    thread stays stuck on the disk, and there are only so many of those. So
+    while a disk has a call stuck, it gets no more; after a timeout, it gets
+    left alone for a while, longer each time it happens again.
+    """
+
+    def __init__(
+        self,
+        devices_path: typing.Union[str, os.PathLike],
+        syscall_timeout: float,
+        min_backoff: float = 60,
+        max_backoff: float = 3600,
+    ):
+        self.devices_path = pathlib.PurePath(devices_path)
+        self.syscall_timeout = syscall_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # device -> calls still running in a native thread
+        self.in_flight: typing.Dict[str, typing.Set[object]] = \
+            collections.defaultdict(set)
+        self.backoff: typing.Dict[str, float] = {}
+        self.backoff_until: typing.Dict[str, float] = {}
+        self.timeouts: typing.Counter[str] = collections.Counter()
+
+    def device(self, path: typing.Union[str, os.PathLike]) -> str:
+        try:
+            return pathlib.PurePath(path).relative_to(
+                self.devices_path).parts[0]
+        except (ValueError, IndexError):
+            return ''
+
+    def check(self, device: str) -> None:
+        """
+        :raises CallTimeout: if ``device`` is still hung (or only recently
+                             was)
+        """
+        if self.in_flight[device]:
+            raise CallTimeout(f'{device}: still stuck in an earlier call')
+        if time.time() < self.backoff_until.get(device, 0):
+            raise CallTimeout(f'{device}: backing off after a timeout')
+
+    def back_off(self, device: str,
+                 last: typing.Optional[float] = None) -> None:
+        """
+        Leave ``device`` alone for twice as long as last time (or than
+        ``last``), within min_backoff and max_backoff.
+        """
+        if last is None:
+            last = self.backoff.get(device, 0)
+        self.backoff[device] = min(max(last * 2, self.min_backoff),
+                                   self.max_backoff)
+        self.backoff_until[device] = time.time() + self.backoff[device]
+
+    def call(self, func: typing.Callable[..., T],
+             path: typing.Union[str, os.PathLike], *args: typing.Any,
+             deadline: float = float('inf')) -> T:
+        """
+        ``func(path, *args)`` in a native thread.
+
+        :raises CallTimeout: if it took too long (more than
+                             ``syscall_timeout``, or past ``deadline``), or
+                             the disk ``path`` is on is still hung (or only
+                             recently was)
+        """
+        device = self.device(path)
+        self.check(device)
+        timeout = min(self.syscall_timeout, deadline - time.time())
+        if timeout <= 0:
+            raise CallTimeout(f'{device}: deadline exceeded')
+        token = object()
+
+        @functools.wraps(func)
+        def run(*args: typing.Any) -> T:
+            try:
+                return func(*args)
+            finally:
+                self.in_flight[device].discard(token)
+
+        self.in_flight[device].add(token)
+        try:
+            result = blocking_call(timeout, run, path, *args)
+        except CallTimeout:
+            self.timeouts[device] += 1
+            self.back_off(device)
+            raise
+        self.backoff.pop(device, None)
+        return result
+
+
+class ListingCache:
+    """
+    Directory listings -- or whatever gets derived from them -- cached against
+    each directory's mtime, so a walk over an unchanged tree costs one stat
+    per directory rather than a listdir.
+
+    Call ``finish_pass()`` at the end of each walk; entries that weren't
+    looked at during it are forgotten, unless ``keep()`` says otherwise.
+    """
+
+    def __init__(self, io_budget: TokenBucket, calls: DeviceCalls):
+        self.io_budget = io_budget
+        self.calls = calls
+        # path -> (mtime, whatever we derived from its listing)
+        self.listings: typing.Dict[str, typing.Tuple[int, typing.Any]] = {}
+        self.seen: typing.Dict[str, typing.Tuple[int, typing.Any]] = {}
+
+    def get(
+        self,
+        path: typing.Union[str, os.PathLike],
+        derive: typing.Callable[[typing.List[str]], typing.Any] = list,
+    ) -> typing.Any:
+        """
+        Get whatever ``derive`` makes of the names in ``path``, reusing what
+        it made last time if the directory hasn't changed since.
+
+        :raises OSError: if the directory can't be listed
+        :raises CallTimeout: if the disk seems to be hung
+        """
+        self.io_budget.consume()
+        mtime = self.calls.call(os.stat, path).st_mtime_ns
+        cached = self.listings.get(str(path))
+        if cached is None or cached[0] != mtime:
+            self.io_budget.consume()
+            cached = (mtime, derive(self.calls.call(os.listdir, path)))
+        self.seen[str(path)] = cached
+        return cached[1]
+
+    def keep(self, path: typing.Union[str, os.PathLike]) -> None:
+        """
+        Hang on to everything we knew about ``path`` and below, even if we
+        didn't get to look at it this pass (say, because its disk failed).
+        """
+        prefix = f'{path}{os.sep}'
+        self.seen.update(
+            (k, v) for k, v in self.listings.items()
+            if k == str(path) or k.startswith(prefix))
+
+    def remember(
+        self,
+        listings: typing.Dict[str, typing.Tuple[int, typing.Any]],
+    ) -> None:
+        """
+        Take on listings somebody else made (say, a batch of them from a
+        single trip to the thread pool), so they're reused next pass.
+        """
+        self.seen.update(listings)
+
+    def finish_pass(self) -> None:
+        self.listings, self.seen = self.seen, {}
+
+
 class Tracker(threading.Thread):
     interval = 10  # seconds
+    # whether it's cheap enough to collect when the manager is scraped,
+    # rather than every interval; see fresh_stats
+    scrape_collectable: typing.ClassVar[bool] = False
 
     def __init__(self, stats_queue: queue.Queue, conf: dict):
         self.stats_queue = stats_queue
         self.ever_reported = threading.Event()
+        self.overruns = 0
+        self.last_collected: typing.Optional[float] = None
+        # family -> series, as of the last scrape
+        self.series: typing.Counter[str] = collections.Counter()
+        self.on_scrape = self.scrape_collectable and str(conf.get(
+            'collect_on_scrape', 'true')).lower() in TRUE_VALUES
+        # how old a collection a scrape will take instead of a new one
+        self.max_staleness = float(conf.get('max_staleness', '5'))
+        # how long a scrape will wait on a collection before making do
+        # with the last one
+        self.scrape_deadline = float(conf.get('scrape_deadline', '2'))
+        # how often to collect anyway, so nothing gets pruned while no one
+        # scrapes; keep it under Manager.MAX_AGE
+        self.idle_interval = float(conf.get('idle_interval', '120'))
+        self.cached: typing.Optional[WriteOnceStatCollection] = None
+        self.inflight: typing.Optional[eventlet.greenthread.GreenThread] = \
+            None
+        self.collect_lock = threading.Lock()
+        self.stopping = threading.Event()
         super().__init__()
         self.daemon = True
         self.configure(conf)
@@ -151,36 +540,141 @@ class Tracker(threading.Thread):
         )
 
     def run(self) -> None:
-        while True:
+        while not self.stopping.is_set():
             start = time.time()
-            any_stats = False
-            try:
-                stats = self.get_stats()
-            except Exception:
-                traceback.print_exc()
-                stats = WriteOnceStatCollection()
-            for stat in stats:
-                self.stats_queue.put(stat)
-                any_stats = True
-            if any_stats:
-                # Some trackers don't report until their *second* scrape
-                self.ever_reported.set()
+            if self.on_scrape:
+                self.fresh_stats()
+                interval = self.idle_interval
+            else:
+                self.scrape_once()
+                interval = self.interval
             delta = time.time() - start
-            self.stats_queue.put(ScrapeTime(
-                delta,
-                Stat.now(),
-                self.scrape_time_labels(),
-            ))
-            if self.interval - delta > 0:
-                time.sleep(self.interval - delta)
+            if interval - delta > 0:
+                self.stopping.wait(interval - delta)
+
+    def stop(self) -> None:
+        """Have run() return once any scrape in progress finishes"""
+        self.stopping.set()
+
+    def scrape_once(self) -> typing.Optional[WriteOnceStatCollection]:
+        """
+        Call get_stats() and queue what it returns, along with how the
+        scrape went.
+
+        :returns: the stats, or None if get_stats() failed
+        """
+        start = time.time()
+        stats: typing.Optional[WriteOnceStatCollection]
+        try:
+            stats = self.get_stats()
+        except Exception:
+            traceback.print_exc()
+            stats = None
+        else:
+            self.last_collected = time.time()
+            self.series = collections.Counter(s.name for s in stats)
+        for stat in stats or ():
+            self.stats_queue.put(stat)
+        if stats:
+            # Some trackers don't report until their *second* scrape
+            self.ever_reported.set()
+        delta = time.time() - start
+        if delta > self.interval:
+            self.overruns += 1
+        now = Stat.now()
+        labels = self.scrape_time_labels()
+        self.stats_queue.put(ScrapeTime(delta, now, labels))
+        self.stats_queue.put(TrackerOverrunsStat(
+            self.overruns, now, labels))
+        if self.last_collected is not None:
+            self.stats_queue.put(TrackerLastSuccessStat(
+                self.last_collected, now, labels))
+        return stats
+
+    def _collect_for_scrape(self) -> WriteOnceStatCollection:
+        stats = self.scrape_once()
+        with self.collect_lock:
+            if stats is not None:
+                self.cached = stats
+            self.inflight = None
+            return self.cached or WriteOnceStatCollection()
+
+    def fresh_stats(self) -> WriteOnceStatCollection:
+        """
+        Stats no older than ``max_staleness`` if we can get them within
+        ``scrape_deadline``, or the last ones we got if not. Concurrent
+        callers share the one collection.
+        """
+        with self.collect_lock:
+            if self.cached is not None and self.last_collected is not None \
+                    and time.time() - self.last_collected \
+                    <= self.max_staleness:
+                return self.cached
+            if self.inflight is None:
+                self.inflight = eventlet.spawn(self._collect_for_scrape)
+            inflight = self.inflight
+        try:
+            with eventlet.Timeout(self.scrape_deadline):
+                return inflight.wait()
+        except eventlet.Timeout:
+            # it'll finish in the background, for the next scrape
+            return self.cached or WriteOnceStatCollection()
 
     def get_stats(self) -> WriteOnceStatCollection:
         raise NotImplementedError
 
+    def collect(self) -> WriteOnceStatCollection:
+        """
+        Do one scrape right here in the calling thread, without start()ing
+        the tracker; this is what benchmarks measure. As in run(), reporting
+        anything sets ``ever_reported``, so later scrapes take the same
+        paths they would in production.
+        """
+        stats = self.get_stats()
+        if stats:
+            self.ever_reported.set()
+        return stats
+
     @classmethod
-    def main(cls) -> None:
+    def main(cls, args: typing.Optional[typing.List[str]] = None) -> None:
+        parser = argparse.ArgumentParser(
+            description=f'Print stats from {cls.__name__} as they come in, '
+                        'or benchmark its scrapes.')
+        parser.add_argument('--conf', action='append', default=[],
+                            metavar='KEY=VALUE',
+                            help='config for the tracker; may be repeated')
+        parser.add_argument('--benchmark', type=int, metavar='SCRAPES',
+                            help='run this many scrapes back to back and '
+                                 'report what they cost as JSON')
+        parser.add_argument('--warmup', type=int, default=1,
+                            metavar='SCRAPES',
+                            help='untimed scrapes to run first, so the '
+                                 'timed ones see a tracker past its first '
+                                 'pass (default: %(default)s)')
+        parser.add_argument('--instrumented', type=int, default=1,
+                            metavar='SCRAPES',
+                            help='profiled scrapes to run after the timed '
+                                 'ones (default: %(default)s)')
+        parser.add_argument('--profile', metavar='FILE',
+                            help='dump cProfile stats from the instrumented '
+                                 'scrapes')
+        parser.add_argument('--collapsed', metavar='FILE',
+                            help='write collapsed stacks (for flamegraph.pl) '
+                                 'sampled during the instrumented scrapes')
+        parser.add_argument('--sample-interval', type=float, default=0.001,
+                            metavar='SECONDS')
+        parser.add_argument('--json', metavar='FILE',
+                            help='where to write results (default: stdout)')
+        opts = parser.parse_args(args)
+        conf = dict(c.partition('=')[::2] for c in opts.conf)
+
+        if opts.benchmark is not None:
+            from . import benchmark
+            benchmark.main(cls(queue.Queue(), conf), opts)
+            return
+
         statq: queue.Queue[Stat] = queue.Queue()
-        thread = cls(statq, {})
+        thread = cls(statq, conf)
         thread.start()
         stats = StatCollection()
         while thread.is_alive():
@@ -1,38 +1,162 @@
+from . import LimitedStatCollection
 from . import Stat
 from . import StatCollection
 from . import WriteOnceStatCollection
+from .commands import CommandTracker
 from .df_stats import DiskTracker
+from .history import History
 from .iptables_counters import IPTablesTracker
 from .ntp_stats import TimeSyncTracker
 from .process_info import ProcessTracker
+from .remote_write import RemoteWriteTracker
+from .swift_backlog import SwiftBacklogTracker
+from .swift_db_stats import SwiftDBTracker
+from .swift_recon import SwiftReconTracker
 from .swift_stats import SwiftRingAssignmentTracker
 from .swift_statsd_metrics import StatsdTracker
-from .swift_object_replication import SwiftObjectReplicationTracker
 
 import queue
 import sys
 import threading
 import time
+import typing
 import urllib.parse
 import wsgiref.simple_server
 
+import eventlet.greenpool
+
+
+class QueueDepthStat(Stat):
+    name = "exporter_queue_depth"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Stats waiting for the manager to pick them up"
+
+
+class SeriesStat(Stat):
+    name = "exporter_series"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Series each tracker reported in its last scrape, by family"
+
+
+class StoredSeriesStat(Stat):
+    name = "exporter_stored_series"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Series held for scraping"
+
+
+class StoreBytesStat(Stat):
+    name = "exporter_store_bytes"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Approximate memory used by the series held for scraping"
+
+
+class PrunedSeriesStat(Stat):
+    name = "exporter_pruned_series"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Series dropped for not being updated in time"
+
+
+class SeriesRejectedStat(Stat):
+    name = "exporter_series_rejected"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "New series folded into an overflow series, by family"
+
+
+class TrackerReadyStat(Stat):
+    name = "tracker_ready"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Whether the tracker has reported anything since startup"
+
+
+class RenderSecondsStat(Stat):
+    name = "exporter_render_seconds"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Time taken to render the previous /metrics response"
+
+
+class BodyBytesStat(Stat):
+    name = "exporter_body_bytes"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Size of the previous /metrics response"
+
+
+class HistorySeriesStat(Stat):
+    name = "exporter_history_series"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Series with a history ring buffer"
+
+
+class HistoryBytesStat(Stat):
+    name = "exporter_history_bytes"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Memory taken by history ring buffers"
+
+
+class HistoryRejectedStat(Stat):
+    name = "exporter_history_rejected"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Samples not kept for being over the history's series limit"
+
+
+USAGE = ('usage: python -m swift_metrics [server | push URL] '
+         '[history NAME,...] [state DIR]')
+
+
+def arg_after(word: str) -> str:
+    """
+    The command-line argument after ``word``; checked before any tracker
+    starts, so a missing one is a usage error rather than a traceback.
+    """
+    i = sys.argv.index(word) + 1
+    if i >= len(sys.argv):
+        sys.exit(f'{word} needs an argument\n{USAGE}')
+    return sys.argv[i]
+
+
+def store_bytes(stats: StatCollection) -> int:
+    """
+    Roughly what ``stats`` costs to hold on to: its dict, plus each key and
+    value and their labels. Label strings are mostly shared, so don't count.
+    """
+    size = sys.getsizeof(stats._stats)
+    for key, stat in stats._stats.items():
+        size += (sys.getsizeof(key) + sys.getsizeof(key.labels)
+                 + sys.getsizeof(stat) + sys.getsizeof(stat.value))
+    return size
+
 
 class Manager(threading.Thread):
     WORKER_CLASSES = (
         DiskTracker,
         IPTablesTracker,
         SwiftRingAssignmentTracker,
-        SwiftObjectReplicationTracker,
+        SwiftBacklogTracker,
+        SwiftDBTracker,
+        SwiftReconTracker,
         StatsdTracker,
         ProcessTracker,
         TimeSyncTracker,
+        CommandTracker,
     )
     MAX_AGE = 150  # seconds
+    # most series any one family may have; see Stat.max_series
+    SERIES_LIMIT = 10000
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        history: typing.Optional[History] = None,
+        conf: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> None:
         self.statq: queue.Queue[Stat] = queue.Queue()
-        self.stats = StatCollection()
-        self.workers = [cls(self.statq, {}) for cls in self.WORKER_CLASSES]
+        self.history = history
+        self.stats = LimitedStatCollection(self.SERIES_LIMIT)
+        # the same conf for every tracker; each takes what it knows
+        self.workers = [cls(self.statq, dict(conf or {}))
+                        for cls in self.WORKER_CLASSES]
+        self.pruned = 0
+        # of the last /metrics response
+        self.render_seconds: typing.Optional[float] = None
+        self.body_bytes: typing.Optional[int] = None
         super().__init__()
         self.daemon = True
 
@@ -41,40 +165,172 @@ class Manager(threading.Thread):
             t.start()
         last = time.time()
         while all(t.is_alive() for t in self.workers):
-            self.stats.update(self.statq.get())
+            stat = self.statq.get()
+            self.stats.update(stat)
+            if self.history is not None:
+                self.history.record(stat)
             now = time.time()
             if now - last > self.MAX_AGE:
+                before = len(self.stats)
                 self.stats.prune(self.MAX_AGE * 1000)
+                self.pruned += before - len(self.stats)
+                if self.history is not None:
+                    self.history.prune()
                 last = min(
                     (s.timestamp / 1000 for s in self.stats
                      if s.timestamp is not None),
                     default=now)
 
-    def get_stats(self) -> WriteOnceStatCollection:
-        for t in self.workers:
-            t.ever_reported.wait()
+    def waiting(self) -> typing.List[str]:
+        """
+        Trackers that haven't reported anything yet.
+        """
+        return [type(t).__name__ for t in self.workers
+                if not t.ever_reported.is_set()]
+
+    def ready(self) -> bool:
+        return not self.waiting()
+
+    def get_stats(self, wait: bool = False) -> WriteOnceStatCollection:
+        """
+        Everything we've got so far. Unless ``wait``, that may not include
+        trackers still on their first scrape; tracker_ready says which.
+        """
+        if wait:
+            for t in self.workers:
+                t.ever_reported.wait()
+        fresh = StatCollection()
+        for t_stats in eventlet.greenpool.GreenPool().imap(
+                lambda t: t.fresh_stats(),
+                [t for t in self.workers if t.on_scrape]):
+            fresh.merge(t_stats)
         for _ in range(3):
             if self.statq.empty():
                 break
             time.sleep(0.05)
-        return WriteOnceStatCollection(self.stats)
+        # what was just collected wins over what's still in the store
+        current = StatCollection(self.stats)
+        current.merge(fresh)
+        stats = WriteOnceStatCollection(current)
+        stats.merge(self.self_stats())
+        return stats
+
+    def self_stats(self) -> WriteOnceStatCollection:
+        """
+        How the exporter itself is doing.
+        """
+        now = Stat.now()
+        stats = WriteOnceStatCollection((
+            QueueDepthStat(self.statq.qsize(), now),
+            StoredSeriesStat(len(self.stats), now),
+            StoreBytesStat(store_bytes(self.stats), now),
+            PrunedSeriesStat(self.pruned, now),
+        ))
+        stats.merge(
+            SeriesRejectedStat(n, now, (("family", family),))
+            for family, n in sorted(self.stats.rejected.items())
+        )
+        for t in self.workers:
+            stats.update(TrackerReadyStat(
+                int(t.ever_reported.is_set()), now, t.scrape_time_labels()))
+            stats.merge(
+                SeriesStat(n, now, (
+                    ("tracker", type(t).__name__),
+                    ("family", family),
+                ))
+                for family, n in sorted(t.series.items())
+            )
+        if self.history is not None:
+            stats.update(
+                HistorySeriesStat(len(self.history.rings), now),
+                HistoryBytesStat(self.history.memory(), now),
+                HistoryRejectedStat(self.history.rejected, now),
+            )
+        if self.render_seconds is not None:
+            stats.update(
+                RenderSecondsStat(self.render_seconds, now),
+                BodyBytesStat(self.body_bytes, now),
+            )
+        return stats
 
 
-m = Manager()
+push_url = None
+if 'push' in sys.argv and not ('server' in sys.argv or 'serve' in sys.argv):
+    push_url = arg_after('push')
+history = None
+if 'history' in sys.argv:
+    # sample every 10s for an hour; see Tracker.interval
+    history = History(arg_after('history').split(','))
+conf = {}
+if 'state' in sys.argv:
+    # keep statsd counters and process samples across restarts
+    conf['state_dir'] = arg_after('state')
+m = Manager(history, conf)
 m.start()
 
 
 if 'server' in sys.argv or 'serve' in sys.argv:
+    def history_app(env, start_response):  # type: ignore
+        params = urllib.parse.parse_qs(env.get('QUERY_STRING'))
+        if m.history is None or 'name' not in params:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        since = 0.0
+        if 'seconds' in params:
+            try:
+                since = time.time() - float(params['seconds'][0])
+            except ValueError:
+                start_response('400 Bad Request',
+                               [('Content-Type', 'text/plain')])
+                return [b'seconds must be a number']
+        if params.get('format') == ['csv']:
+            body = m.history.csv(params['name'], since).encode('utf-8')
+            content_type = 'text/csv'
+        else:
+            body = m.history.json(params['name'], since).encode('utf-8')
+            content_type = 'application/json'
+        start_response('200 OK', [
+            ('Content-Length', str(len(body))),
+            ('Content-Type', content_type),
+        ])
+        return [body]
+
+    def ready_app(env, start_response):  # type: ignore
+        """
+        200 once every tracker has reported; until then, 503 and which ones
+        are still waiting.
+        """
+        waiting = m.waiting()  # once, so the status and body agree
+        if waiting:
+            status = '503 Service Unavailable'
+            body = ''.join(f'waiting on {name}\n' for name in waiting)
+        else:
+            status, body = '200 OK', 'ready\n'
+        body_bytes = body.encode('utf-8')
+        start_response(status, [
+            ('Content-Length', str(len(body_bytes))),
+            ('Content-Type', 'text/plain'),
+        ])
+        return [body_bytes]
+
     def app(env, start_response):  # type: ignore
+        if env['PATH_INFO'] == '/ready':
+            return ready_app(env, start_response)
+        if env['PATH_INFO'] == '/metrics/history':
+            return history_app(env, start_response)
         if env['PATH_INFO'] != '/metrics':
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return [b'Not Found']
         params = urllib.parse.parse_qs(env.get('QUERY_STRING'))
         stats = m.get_stats()
+        start = time.time()
         if 'name' in params:
             stats = WriteOnceStatCollection(
                 s for s in stats if s.name in params['name'])
         body = stats.doc().encode('utf-8')
+        if 'name' not in params:
+            m.render_seconds = time.time() - start
+            m.body_bytes = len(body)
         start_response('200 OK', [
             ('Content-Length', str(len(body))),
             ('Content-Type', 'text/plain'),
@@ -84,5 +340,14 @@ if 'server' in sys.argv or 'serve' in sys.argv:
     with wsgiref.simple_server.make_server('', 8000, app) as httpd:
         httpd.serve_forever()
 
+elif push_url is not None:
+    pusher = RemoteWriteTracker(m.statq, {
+        'url': push_url,
+        'manager': m,
+    })
+    pusher.start()
+    pusher.join()
+
 else:
-    print(m.get_stats().doc(), end='')
+    # one-shot; better late than missing trackers
+    print(m.get_stats(wait=True).doc(), end='')
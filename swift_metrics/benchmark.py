@@ -0,0 +1,254 @@
+"""
+Measure what a tracker's scrapes cost; see ``Tracker.main``'s
+``--benchmark``.
+
+Timed scrapes run bare, so wall/CPU/rusage numbers aren't skewed by
+instrumentation. Then a few instrumented scrapes run under tracemalloc and
+cProfile (and, if asked, a wall-clock stack sampler) to find where memory
+and time -- particularly time blocked in syscalls -- go.
+"""
+import collections
+import cProfile
+import importlib.metadata
+import json
+import platform
+import pstats
+import resource
+import signal
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+import typing
+
+
+RUSAGE_FIELDS = (
+    'ru_utime',
+    'ru_stime',
+    'ru_maxrss',
+    'ru_minflt',
+    'ru_majflt',
+    'ru_inblock',
+    'ru_oublock',
+    'ru_nvcsw',
+    'ru_nivcsw',
+)
+# Profile entries for C functions that (usually) mean a trip into the kernel
+SYSCALL_MODULES = (
+    'posix.',
+    'select.',
+    '_socket.',
+    '_io.',
+    'fcntl.',
+    '_sqlite3.',
+    'time.sleep',
+    '_thread.lock',
+    '_posixsubprocess.',
+)
+
+
+def summarize(values: typing.Sequence[float]) -> typing.Dict[str, float]:
+    return {
+        'min': min(values),
+        'median': statistics.median(values),
+        'mean': statistics.mean(values),
+        'max': max(values),
+        'total': sum(values),
+    }
+
+
+def rusage_delta(
+    before: resource.struct_rusage,
+    after: resource.struct_rusage,
+) -> typing.Dict[str, float]:
+    delta = {f: getattr(after, f) - getattr(before, f) for f in RUSAGE_FIELDS}
+    delta['ru_maxrss'] = after.ru_maxrss  # a high-water mark, not a counter
+    return delta
+
+
+class StackSampler:
+    """
+    Count the main thread's stack every ``interval`` seconds of wall-clock
+    time (so time blocked on disks shows up, too), for flame graphs.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.samples: typing.Counter[str] = collections.Counter()
+
+    def sample(self, signum: int,
+               frame: typing.Optional[types.FrameType]) -> None:
+        stack = []
+        # only the frames below whoever entered us are interesting
+        while frame is not None and frame is not self.root:
+            module = frame.f_globals.get('__name__', '?')
+            stack.append(f'{module}:{frame.f_code.co_name}')
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def __enter__(self) -> 'StackSampler':
+        self.root = sys._getframe(1)
+        self.old_handler = signal.signal(signal.SIGALRM, self.sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.old_handler)
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w') as fp:
+            for stack, count in sorted(self.samples.items()):
+                fp.write(f'{stack} {count}\n')
+
+
+def syscall_phases(
+    profile: cProfile.Profile,
+    limit: int = 10,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    The C functions we spent the most time in that look like syscalls.
+    """
+    phases = []
+    for (filename, _, func), (_, ncalls, tottime, _, _) in pstats.Stats(
+            profile).stats.items():  # type: ignore
+        if filename != '~':
+            continue  # not a builtin
+        name = func.strip('<>{}')
+        for prefix in ('built-in method ', 'method '):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        if not any(m in name for m in SYSCALL_MODULES):
+            continue
+        phases.append({'function': name, 'calls': ncalls,
+                       'seconds': tottime})
+    phases.sort(key=lambda p: p['seconds'], reverse=True)
+    return phases[:limit]
+
+
+def run(
+    tracker: typing.Any,
+    scrapes: int,
+    instrumented: int = 1,
+    profile_path: typing.Optional[str] = None,
+    collapsed_path: typing.Optional[str] = None,
+    sample_interval: float = 0.001,
+    top_allocations: int = 10,
+    warmup: int = 1,
+) -> typing.Dict[str, typing.Any]:
+    """
+    Run ``warmup`` untimed scrapes of ``tracker``, then ``scrapes`` timed
+    ones, then ``instrumented`` profiled ones, and return the results as
+    something JSON-able.
+
+    Some trackers do their first pass differently (the ring tracker reads
+    hashes rather than consolidating them, for one), so warming up is what
+    gets the steady state measured.
+    """
+    for _ in range(warmup):
+        tracker.collect()
+    walls = []
+    cpus = []
+    stat_counts = []
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    for _ in range(scrapes):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        stats = tracker.collect()
+        cpus.append(time.process_time() - cpu)
+        walls.append(time.perf_counter() - wall)
+        stat_counts.append(len(stats))
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    profile = cProfile.Profile()
+    sampler = StackSampler(sample_interval)
+    peaks = []
+    tracemalloc.start(25)
+    try:
+        snapshot_before = tracemalloc.take_snapshot()
+        for _ in range(instrumented):
+            tracemalloc.reset_peak()
+            if collapsed_path:
+                with sampler:
+                    profile.runcall(tracker.collect)
+            else:
+                profile.runcall(tracker.collect)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        snapshot_after = tracemalloc.take_snapshot()
+        ours = [
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ]
+        snapshot_before = snapshot_before.filter_traces(ours)
+        snapshot_after = snapshot_after.filter_traces(ours)
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    if profile_path:
+        profile.dump_stats(profile_path)
+    if collapsed_path:
+        sampler.dump(collapsed_path)
+
+    try:
+        version = importlib.metadata.version('swift_metrics')
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    module = type(tracker).__module__
+    if module == '__main__':
+        # run with python -m; we want the name it'd be imported as
+        module = getattr(sys.modules['__main__'].__spec__, 'name', module)
+    return {
+        'tracker': f'{module}.{type(tracker).__name__}',
+        'version': version,
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'warmup_scrapes': warmup,
+        'scrapes': scrapes,
+        'stats_per_scrape': summarize(stat_counts) if stat_counts else None,
+        'wall_seconds': summarize(walls) if walls else None,
+        'cpu_seconds': summarize(cpus) if cpus else None,
+        'rusage_self': rusage_delta(self_before, self_after),
+        'rusage_children': rusage_delta(children_before, children_after),
+        'instrumented_scrapes': instrumented,
+        'allocations': {
+            'peak_bytes': max(peaks, default=0),
+            'retained_bytes': retained,
+            'top': [
+                {
+                    'where': str(diff.traceback[0]),
+                    'bytes': diff.size_diff,
+                    'count': diff.count_diff,
+                }
+                for diff in snapshot_after.compare_to(
+                    snapshot_before, 'lineno')[:top_allocations]
+            ],
+        },
+        'syscalls': syscall_phases(profile),
+    }
+
+
+def main(
+    tracker: typing.Any,
+    args: typing.Any,
+) -> None:
+    result = run(
+        tracker,
+        args.benchmark,
+        instrumented=args.instrumented,
+        profile_path=args.profile,
+        collapsed_path=args.collapsed,
+        sample_interval=args.sample_interval,
+        warmup=args.warmup,
+    )
+    if args.json in (None, '-'):
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.json, 'w') as fp:
+            json.dump(result, fp, indent=2)
@@ -0,0 +1,218 @@
+"""
+One place to run external commands from, so a hung ``df`` or a slow
+``lsof`` can't wedge a tracker (or pile up children) forever.
+
+Every command gets a timeout, after which its whole process group is
+killed; only ``MAX_CONCURRENT`` commands run at once across all trackers;
+and how long each command takes (and how it fails) is tracked for
+``CommandTracker`` to report.
+"""
+import bisect
+import collections
+import os
+import signal
+import subprocess
+import threading
+import time
+import typing
+
+import eventlet
+
+from . import Stat
+from . import Tracker
+from . import WriteOnceStatCollection
+
+
+class CommandRunsStat(Stat):
+    name = "command_runs"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "External commands run"
+
+
+class CommandFailuresStat(Stat):
+    name = "command_failures"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "External commands that timed out, failed to start, or failed"
+
+
+class CommandSecondsStat(Stat):
+    name = "command_seconds"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Time spent running external commands (including waiting to)"
+
+
+class CommandLatencyHistogram(Stat):
+    name = "command_seconds_bucket"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "External commands that finished within some number of seconds"
+
+
+LATENCY_BUCKETS = (  # seconds
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    30,
+    float('inf'),
+)
+
+MAX_CONCURRENT = 4
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+
+# command name -> counts
+runs: typing.Counter[str] = collections.Counter()
+seconds: typing.Counter[str] = collections.Counter()
+latencies: typing.Dict[str, typing.List[int]] = collections.defaultdict(
+    lambda: [0] * len(LATENCY_BUCKETS))
+# (command name, reason) -> count
+failures: typing.Counter[typing.Tuple[str, str]] = collections.Counter()
+
+
+def set_max_concurrent(n: int) -> None:
+    """
+    Only safe before any trackers start running commands.
+    """
+    global MAX_CONCURRENT, _slots
+    MAX_CONCURRENT = n
+    _slots = threading.BoundedSemaphore(n)
+
+
+def record(name: str, start: float, reason: typing.Optional[str]) -> None:
+    elapsed = time.time() - start
+    runs[name] += 1
+    seconds[name] += elapsed
+    latencies[name][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+    if reason:
+        failures[name, reason] += 1
+
+
+def abandon(proc: subprocess.Popen) -> None:
+    """
+    Stop waiting on a killed command. One stuck in uninterruptible IO (say,
+    a ``df`` of a failing disk) won't die until that IO finishes, if ever;
+    a greenthread reaps it whenever it does.
+    """
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        if pipe is not None:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+    eventlet.spawn_n(proc.wait)
+
+
+def run(
+    cmd: typing.Sequence[typing.Union[str, os.PathLike]],
+    timeout: float,
+    check: bool = True,
+    input: typing.Optional[str] = None,
+    encoding: typing.Optional[str] = 'utf-8',
+    name: typing.Optional[str] = None,
+) -> subprocess.CompletedProcess:
+    """
+    Like ``subprocess.run(cmd, capture_output=True, ...)``, but:
+
+    * waiting for one of the ``MAX_CONCURRENT`` slots counts against
+      ``timeout``, too
+    * the command runs in its own session, and on timeout the whole process
+      group gets SIGKILLed, so children can't outlive it
+
+    :raises subprocess.TimeoutExpired: if we ran out of time
+    :raises subprocess.CalledProcessError: if ``check`` and the command
+        exited non-zero (which is the only time that counts as a failure)
+    :raises OSError: if the command couldn't be started
+    """
+    name = name or os.path.basename(str(cmd[0]))
+    start = time.time()
+    if not _slots.acquire(timeout=timeout):
+        record(name, start, 'busy')
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    reason = None
+    try:
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                encoding=encoding,
+                start_new_session=True,
+            )
+        except OSError:
+            reason = 'spawn'
+            raise
+        # Popen.communicate(timeout=...) raises a TimeoutExpired from
+        # eventlet's copy of subprocess, which isn't the one we can catch
+        timer = eventlet.Timeout(max(timeout - (time.time() - start), 0))
+        try:
+            stdout, stderr = proc.communicate(input)
+        except eventlet.Timeout as t:
+            if t is not timer:
+                raise
+            reason = 'timeout'
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            abandon(proc)
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except BaseException:
+            proc.kill()
+            abandon(proc)
+            raise
+        finally:
+            timer.cancel()
+        result = subprocess.CompletedProcess(
+            cmd, proc.returncode, stdout, stderr)
+        if check and proc.returncode:
+            reason = 'exit'
+            result.check_returncode()
+        return result
+    finally:
+        _slots.release()
+        record(name, start, reason)
+
+
+class CommandTracker(Tracker):
+    """
+    Report how the external commands other trackers run are doing.
+    """
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        if 'max_concurrent_commands' in conf:
+            set_max_concurrent(int(conf['max_concurrent_commands']))
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        now = Stat.now()
+        stats = WriteOnceStatCollection()
+        for name in sorted(runs):
+            labels = (("command", name),)
+            stats.update(
+                CommandRunsStat(runs[name], now, labels),
+                CommandSecondsStat(seconds[name], now, labels),
+            )
+            cumulative = 0
+            for threshold, n in zip(LATENCY_BUCKETS, latencies[name]):
+                cumulative += n
+                stats.update(CommandLatencyHistogram(
+                    cumulative, now, labels + (
+                        ("le", "+Inf" if threshold == float('inf')
+                         else str(threshold)),
+                    )))
+        stats.merge(
+            CommandFailuresStat(n, now, (
+                ("command", name),
+                ("reason", reason),
+            ))
+            for (name, reason), n in sorted(failures.items())
+        )
+        if not stats:
+            self.ever_reported.set()
+        return stats
+
+
+if __name__ == "__main__":
+    CommandTracker.main()
@@ -1,8 +1,8 @@
 import os
 import pathlib
-import subprocess
 import typing
 
+from . import commands
 from . import Stat
 from . import Tracker
 from . import WriteOnceStatCollection
@@ -15,8 +15,11 @@ class DiskStat(Stat):
 
 
 class DiskTracker(Tracker):
+    scrape_collectable = True
+
     def configure(self, conf: typing.Dict[str, str]) -> None:
         self.devices_path = pathlib.Path(conf.get('devices', '/srv/node'))
+        self.command_timeout = float(conf.get('command_timeout', '30'))
 
     def get_stats(self) -> WriteOnceStatCollection:
         mounts = tuple(self.devices_path / x
@@ -24,11 +27,9 @@ class DiskTracker(Tracker):
         lines = [
             # ('device', 'total', 'used', 'free', '%used', 'mount')
             line.split()
-            for line in subprocess.run(
+            for line in commands.run(
                 ("df", "-B", "1") + mounts,
-                capture_output=True,
-                check=True,
-                encoding="utf-8",
+                self.command_timeout,
             ).stdout.split("\n")
             if any(str(m) in line for m in mounts)
         ]
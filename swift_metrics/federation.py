@@ -0,0 +1,338 @@
+"""
+Scrape many swift_metrics endpoints and serve cluster-level rollups of them,
+so Prometheus needn't store every per-device/per-pid series just to sum
+them up again:
+
+    python -m swift_metrics.federation --targets-file nodes.txt \\
+        --rollup partitions:policy,type --listen :8001
+
+Targets are scraped concurrently, each over its own keep-alive connection,
+and their responses parsed as they stream in; only the families being
+rolled up have their labels parsed at all. Histogram buckets keep their
+``le``. Counters are summed from each series' increases, so one node
+restarting doesn't make the cluster total go backwards; gauges are summed
+from each node's latest values, and a node that fails a scrape keeps its
+last ones for ``stale_after`` seconds.
+"""
+import argparse
+import collections
+import functools
+import http.client
+import queue
+import re
+import time
+import traceback
+import typing
+import wsgiref.simple_server
+
+import eventlet
+import eventlet.greenpool
+
+from . import Stat
+from . import StatCollection
+from . import Tracker
+from . import WriteOnceStatCollection
+
+
+class TargetUpStat(Stat):
+    name = "federation_target_up"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Whether the last scrape of a target worked"
+
+
+class TargetScrapeSecondsStat(Stat):
+    name = "federation_target_scrape_seconds"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "How long the last scrape of a target took"
+
+
+class TargetSamplesStat(Stat):
+    name = "federation_target_samples"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Samples in the last scrape of a target"
+
+
+DEFAULT_ROLLUPS = ';'.join((
+    'partitions:policy,type',
+    'suffixes:policy,type,status',
+    'swift_requests:target_layer,policy_idx,status',
+    'swift_bytes_sent:target_layer,policy_idx',
+    'swift_server_timing_bucket:server,target_layer,method',
+    'disk_space:type',
+))
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+CHUNK_SIZE = 1 << 16
+
+# (family, values of the rollup's labels)
+RollupKey = typing.Tuple[str, typing.Tuple[str, ...]]
+
+
+def parse_rollups(spec: str) -> typing.Dict[str, typing.Tuple[str, ...]]:
+    """
+    ``family:label,label;family:label`` -> {family: labels}
+    """
+    rollups = {}
+    for rule in spec.split(';'):
+        family, _, labels = rule.strip().partition(':')
+        if not family:
+            continue
+        by = tuple(label for label in labels.split(',') if label)
+        if family.endswith('_bucket') and 'le' not in by:
+            by += ('le',)
+        rollups[family] = by
+    return rollups
+
+
+def parse_labels(text: str) -> typing.Dict[str, str]:
+    return {k: v.replace('\\"', '"').replace('\\n', '\n')
+            .replace('\\\\', '\\') for k, v in LABEL_RE.findall(text)}
+
+
+def iter_lines(
+    resp: http.client.HTTPResponse,
+) -> typing.Iterator[str]:
+    """
+    Lines of a response body as they arrive, without holding on to all of
+    it at once.
+    """
+    tail = b''
+    while True:
+        chunk = resp.read(CHUNK_SIZE)
+        if not chunk:
+            if resp.length:
+                # read(amt) just stops short if the connection drops
+                raise http.client.IncompleteRead(tail, resp.length)
+            break
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if tail:
+        yield tail.decode('utf-8')
+
+
+@functools.lru_cache(maxsize=None)
+def rollup_stat(family: str, type_: str) -> typing.Type[Stat]:
+    return type(f'Rollup_{family}', (Stat,), {
+        'name': family,
+        'type': type_,
+        'help': f'{family}, summed across nodes',
+    })
+
+
+class Target:
+    def __init__(self, netloc: str) -> None:
+        host, _, path = netloc.partition('/')
+        self.netloc = host
+        self.path = f'/{path or "metrics"}'
+        self.conn: typing.Optional[http.client.HTTPConnection] = None
+        self.up = False
+        self.last_success = 0.0
+        self.scrape_seconds = 0.0
+        self.samples = 0
+        # this target's share of each gauge rollup, as of its last scrape
+        self.gauges: typing.Dict[RollupKey, float] = {}
+        # counter series -> its last value, to work out increases from
+        self.counters: typing.Dict[typing.Tuple[str, str], float] = {}
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class FederationTracker(Tracker):
+    """
+    Each interval, scrape every target and report the rollups.
+    """
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        targets = [t.strip() for t in conf.get('targets', '').split(',')]
+        if conf.get('targets_file'):
+            with open(conf['targets_file']) as fp:
+                targets.extend(line.split('#')[0].strip() for line in fp)
+        self.targets = [Target(t) for t in dict.fromkeys(targets) if t]
+        self.rollups = parse_rollups(conf.get('rollups', DEFAULT_ROLLUPS))
+        self.interval = float(conf.get('interval', '30'))
+        self.timeout = float(conf.get('scrape_timeout', '20'))
+        self.stale_after = float(conf.get('stale_after', '300'))
+        self.pool = eventlet.greenpool.GreenPool(
+            int(conf.get('concurrency', '64')))
+        # family -> type, from the targets' TYPE lines
+        self.types: typing.Dict[str, str] = {}
+        # running totals of counter increases, across all targets
+        self.counter_totals: typing.Dict[RollupKey, float] = \
+            collections.defaultdict(float)
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        for _ in self.pool.imap(self.scrape, self.targets):
+            pass
+
+        now = Stat.now()
+        gauge_totals: typing.Dict[RollupKey, float] = \
+            collections.defaultdict(float)
+        for target in self.targets:
+            if time.time() - target.last_success > self.stale_after:
+                continue
+            for key, value in target.gauges.items():
+                gauge_totals[key] += value
+
+        stats = WriteOnceStatCollection()
+        for totals in (gauge_totals, self.counter_totals):
+            stats.merge(
+                rollup_stat(family, self.family_type(family))(
+                    value, now, tuple(zip(self.rollups[family], values)))
+                for (family, values), value in totals.items()
+            )
+        for target in self.targets:
+            labels = (("target", target.netloc),)
+            stats.update(
+                TargetUpStat(int(target.up), now, labels),
+                TargetScrapeSecondsStat(target.scrape_seconds, now, labels),
+                TargetSamplesStat(target.samples, now, labels),
+            )
+        return stats
+
+    def family_type(self, name: str) -> str:
+        if name in self.types:
+            return self.types[name]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and self.types.get(
+                    name[:-len(suffix)]) in ('histogram', 'summary'):
+                return 'counter'
+        return 'gauge'
+
+    def scrape(self, target: Target) -> None:
+        start = time.time()
+        try:
+            with eventlet.Timeout(self.timeout):
+                gauges, samples = self.read(target)
+        except (Exception, eventlet.Timeout):
+            traceback.print_exc()
+            target.close()
+            target.up = False
+        else:
+            target.gauges = gauges
+            target.samples = samples
+            target.up = True
+            target.last_success = time.time()
+        target.scrape_seconds = time.time() - start
+
+    def read(self, target: Target) -> typing.Tuple[
+            typing.Dict[RollupKey, float], int]:
+        for attempt in (1, 2):
+            if target.conn is None:
+                target.conn = http.client.HTTPConnection(target.netloc)
+            try:
+                target.conn.request('GET', target.path)
+                resp = target.conn.getresponse()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # the server may have closed our kept-alive connection
+                # since we last used it; one retry on a fresh one
+                target.close()
+                if attempt == 2:
+                    raise
+        if resp.status != 200:
+            resp.read()
+            raise ValueError(f'{target.netloc}: {resp.status}')
+
+        gauges: typing.Dict[RollupKey, float] = collections.defaultdict(float)
+        counters: typing.Dict[typing.Tuple[str, str], float] = {}
+        # only added to counter_totals once we've read the whole body; a
+        # partial read would count them again from the old baselines
+        increases: typing.Dict[RollupKey, float] = \
+            collections.defaultdict(float)
+        samples = 0
+        for line in iter_lines(resp):
+            if line.startswith('#'):
+                parts = line.split(None, 3)
+                if len(parts) == 4 and parts[1] == 'TYPE':
+                    self.types.setdefault(parts[2], parts[3])
+                continue
+            if not line:
+                continue
+            samples += 1
+            brace = line.find('{')
+            if brace == -1:
+                name, _, rest = line.partition(' ')
+                label_text = ''
+            else:
+                name = line[:brace]
+                label_text, _, rest = line[brace + 1:].rpartition('}')
+            by = self.rollups.get(name)
+            if by is None:
+                continue
+            value = float(rest.split()[0])
+            labels = parse_labels(label_text)
+            key = (name, tuple(labels.get(label, '') for label in by))
+            if self.family_type(name) == 'counter':
+                # only what it went up by, counting a drop as a reset
+                last = target.counters.get((name, label_text), 0.0)
+                increases[key] += value - last if value >= last else value
+                counters[name, label_text] = value
+            else:
+                gauges[key] += value
+        if resp.will_close:
+            target.close()
+        target.counters = counters
+        for key, increase in increases.items():
+            self.counter_totals[key] += increase
+        return gauges, samples
+
+
+def main(args: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--targets', default='',
+                        help='comma-separated host:port[/path]')
+    parser.add_argument('--targets-file',
+                        help='file with one host:port[/path] per line')
+    parser.add_argument('--rollup', action='append',
+                        metavar='FAMILY:LABEL,...',
+                        help='sum FAMILY by these labels; may be repeated '
+                             '(default: some cluster-level favorites)')
+    parser.add_argument('--listen', default=':8001', metavar='[HOST]:PORT')
+    parser.add_argument('--interval', default='30')
+    parser.add_argument('--concurrency', default='64')
+    parser.add_argument('--scrape-timeout', default='20')
+    opts = parser.parse_args(args)
+
+    statq: queue.Queue[Stat] = queue.Queue()
+    tracker = FederationTracker(statq, {
+        'targets': opts.targets,
+        'targets_file': opts.targets_file or '',
+        'rollups': ';'.join(opts.rollup) if opts.rollup else DEFAULT_ROLLUPS,
+        'interval': opts.interval,
+        'concurrency': opts.concurrency,
+        'scrape_timeout': opts.scrape_timeout,
+    })
+    tracker.start()
+    stats = StatCollection()
+
+    def app(env, start_response):  # type: ignore
+        if env['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        tracker.ever_reported.wait()
+        while True:
+            try:
+                stats.update(statq.get_nowait())
+            except queue.Empty:
+                break
+        # targets and rollup keys that went away
+        stats.prune(int(max(tracker.stale_after, 3 * tracker.interval)
+                        * 1000))
+        body = stats.doc().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Length', str(len(body))),
+            ('Content-Type', 'text/plain'),
+        ])
+        return [body]
+
+    host, _, port = opts.listen.rpartition(':')
+    with wsgiref.simple_server.make_server(host, int(port), app) as httpd:
+        httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+import collections
+import functools
+import os
+import pathlib
+import pickle
+import select
+import signal
+import struct
+import time
+import traceback
+import typing
+
+import eventlet.hubs
+import eventlet.patcher
+import swift.common.utils  # type: ignore
+import swift.common.utils.libc  # type: ignore
+import swift.obj.diskfile  # type: ignore
+
+from . import CallTimeout
+
+
+FRAME_HEADER = struct.Struct('!I')
+# eventlet's green os.write() waits for a broken pipe to become writable,
+# which never happens if the worker died; we select() before reading anyway
+_os = eventlet.patcher.original('os')
+# killed workers not yet reaped; one stuck in D-state won't die until its IO
+# finishes, if ever, and we mustn't wait on it
+_unreaped: typing.Set[int] = set()
+
+
+def reap() -> None:
+    for pid in list(_unreaped):
+        try:
+            done, _ = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            done = pid
+        if done:
+            _unreaped.discard(pid)
+
+
+def io_priority(io_class: str, priority: str) -> int:
+    """
+    The ioprio_set() value for an ionice class (named as for swift's
+    ``ionice_class`` option) and priority; 0, the default, if no class.
+    """
+    if not io_class:
+        return 0
+    libc = swift.common.utils.libc
+    return libc.IOPRIO_PRIO_VALUE(libc.IO_CLASS_ENUM[io_class], int(priority))
+
+
+@functools.lru_cache(maxsize=None)
+def _ioprio_set() -> typing.Callable[[int], int]:
+    libc = swift.common.utils.libc
+    syscall = swift.common.utils.load_libc_function('syscall', errcheck=True)
+    # once; NR_ioprio_set() runs platform.architecture(), which may well
+    # run file(1) on the interpreter
+    try:
+        nr = libc.NR_ioprio_set()
+    except OSError:
+        # an arch swift doesn't know the syscall number for
+        return lambda value: 0
+    return functools.partial(syscall, nr, libc.IOPRIO_WHO_PROCESS, 0)
+
+
+def set_io_priority(value: int) -> None:
+    """
+    ioprio_set() for just the calling native thread; swift's
+    modify_priority() does the whole process. Best effort.
+    """
+    try:
+        _ioprio_set()(value)
+    except OSError:
+        pass
+
+
+def write_frame(fd: int, obj: typing.Any) -> None:
+    data = pickle.dumps(obj)
+    data = FRAME_HEADER.pack(len(data)) + data
+    while data:
+        data = data[_os.write(fd, data):]
+
+
+def read_exact(fd: int, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = _os.read(fd, size - len(buf))
+        if not chunk:
+            raise EOFError
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(fd: int) -> typing.Any:
+    size, = FRAME_HEADER.unpack(read_exact(fd, FRAME_HEADER.size))
+    return pickle.loads(read_exact(fd, size))
+
+
+def hash_worker(swift_user: str, io_priority: int, req_fd: int,
+                resp_fd: int) -> None:
+    """
+    Child side of a HashWorker: consolidate hashes for each partition path
+    we're sent until the parent goes away.
+    """
+    parent = os.getppid()
+    if io_priority:
+        # we're the only thread, so this is the whole child
+        set_io_priority(io_priority)
+    # Don't let the parent's greenthreads get scheduled in here
+    eventlet.hubs.use_hub(type(eventlet.hubs.get_hub()))
+    swift.common.utils.drop_privileges(swift_user)
+    while True:
+        readable, _, _ = select.select([req_fd], [], [], 1)
+        if not readable:
+            if os.getppid() != parent:
+                return
+            continue
+        try:
+            part_path = read_frame(req_fd)
+        except EOFError:
+            return
+        try:
+            result = (True, swift.obj.diskfile.consolidate_hashes(part_path))
+        except Exception as e:
+            result = (False, repr(e))
+        write_frame(resp_fd, result)
+
+
+class HashWorker:
+    """
+    A long-lived child, running as the swift user, that consolidates hashes
+    for partitions sent to it over a pipe.
+    """
+
+    def __init__(self, swift_user: str, io_priority: int = 0) -> None:
+        req_r, self.req_w = os.pipe()
+        self.resp_r, resp_w = os.pipe()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                os.close(self.req_w)
+                os.close(self.resp_r)
+                hash_worker(swift_user, io_priority, req_r, resp_w)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        os.close(req_r)
+        os.close(resp_w)
+
+    def close(self) -> None:
+        for fd in (self.req_w, self.resp_r):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        _unreaped.add(self.pid)
+        reap()
+
+
+class HashWorkerPool:
+    """
+    A few HashWorkers for a single disk, kept busy with one partition each.
+
+    Any partition a worker fails on (because it died, timed out, or raised)
+    gets its hashes read instead of consolidated; ``failures`` and
+    ``fallbacks`` count how often that happens.
+    """
+
+    def __init__(
+        self,
+        swift_user: str,
+        size: int,
+        timeout: float,
+        read_hashes: typing.Callable[
+            [pathlib.Path], dict] = swift.obj.diskfile.read_hashes,
+        io_priority: int = 0,
+    ) -> None:
+        self.swift_user = swift_user
+        self.io_priority = io_priority
+        self.size = size
+        self.timeout = timeout
+        self.read_hashes = read_hashes
+        self.idle: typing.List[HashWorker] = []
+        self.failures: typing.Counter[str] = collections.Counter()
+        self.fallbacks = 0
+
+    def close(self) -> None:
+        while self.idle:
+            self.idle.pop().close()
+
+    def fail(self, worker: typing.Optional[HashWorker], reason: str,
+             part_path: pathlib.Path) -> typing.Tuple[pathlib.Path, dict]:
+        if worker is not None:
+            worker.close()
+        self.failures[reason] += 1
+        self.fallbacks += 1
+        return part_path, self.read_hashes(part_path)
+
+    def consolidate(
+        self,
+        part_paths: typing.Iterable[pathlib.Path],
+        deadline: float = float('inf'),
+    ) -> typing.Iterator[typing.Tuple[pathlib.Path, dict]]:
+        """
+        Consolidate hashes for each partition, yielding ``(part_path,
+        hashes)`` pairs in whatever order the workers finish them.
+
+        :raises CallTimeout: if we're still at it at ``deadline``
+        """
+        reap()
+        todo = iter(part_paths)
+        # response fd -> (worker, part_path, deadline)
+        busy: typing.Dict[
+            int, typing.Tuple[HashWorker, pathlib.Path, float]] = {}
+        try:
+            while True:
+                if time.time() >= deadline:
+                    raise CallTimeout('hash workers: scan deadline exceeded')
+                while len(busy) < self.size:
+                    part_path = next(todo, None)
+                    if part_path is None:
+                        break
+                    try:
+                        worker = (self.idle.pop() if self.idle
+                                  else HashWorker(self.swift_user,
+                                                  self.io_priority))
+                    except OSError:
+                        yield self.fail(None, 'spawn', part_path)
+                        continue
+                    try:
+                        write_frame(worker.req_w, str(part_path))
+                    except OSError:
+                        yield self.fail(worker, 'died', part_path)
+                        continue
+                    busy[worker.resp_r] = (
+                        worker, part_path, time.time() + self.timeout)
+                if not busy:
+                    return
+
+                timeout = min(deadline, *(
+                    d for _, _, d in busy.values())) - time.time()
+                readable, _, _ = select.select(
+                    list(busy), [], [], max(timeout, 0))
+                for fd in readable:
+                    worker, part_path, _ = busy.pop(fd)
+                    try:
+                        ok, result = read_frame(fd)
+                    except Exception:
+                        yield self.fail(worker, 'died', part_path)
+                        continue
+                    self.idle.append(worker)
+                    if ok:
+                        yield part_path, result
+                    else:
+                        yield self.fail(None, 'error', part_path)
+
+                now = time.time()
+                for fd, (worker, part_path, due) in list(busy.items()):
+                    if due <= now:
+                        del busy[fd]
+                        yield self.fail(worker, 'timeout', part_path)
+        finally:
+            # abandoned mid-pass; outstanding responses would confuse
+            # whoever used these workers next
+            for worker, _, _ in busy.values():
+                worker.close()
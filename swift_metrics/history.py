@@ -0,0 +1,180 @@
+"""
+Recent samples of selected series, kept by the manager so there's
+something to look at during an incident even if Prometheus is down or only
+scraping every minute:
+
+    python -m swift_metrics server history swift_requests,disk_space
+    curl 'localhost:8000/metrics/history?name=swift_requests&format=csv'
+
+Each series gets a fixed-size ring buffer of timestamps and values, backed
+by arrays of doubles, and there's a cap on how many series get one, so
+memory use is known up front: about 16 bytes per sample.
+"""
+import array
+import csv
+import io
+import json
+import math
+import threading
+import time
+import typing
+
+from . import Stat
+
+SeriesKey = typing.Tuple[str, typing.Tuple[typing.Tuple[str, str], ...]]
+
+
+class Ring:
+    """
+    The last ``size`` (timestamp, value) pairs recorded, oldest first.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.timestamps = array.array('d', bytes(8 * size))
+        self.values = array.array('d', bytes(8 * size))
+        self.next = 0
+        self.count = 0
+
+    def append(self, timestamp: float, value: float) -> None:
+        self.timestamps[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def last_timestamp(self) -> typing.Optional[float]:
+        if not self.count:
+            return None
+        return self.timestamps[self.next - 1]
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[float, float]]:
+        start = (self.next - self.count) % len(self.values)
+        for i in range(self.count):
+            j = (start + i) % len(self.values)
+            yield self.timestamps[j], self.values[j]
+
+
+def with_rates(
+    samples: typing.Iterable[typing.Tuple[float, float]],
+) -> typing.Iterator[typing.Tuple[float, float, typing.Optional[float]]]:
+    """
+    (timestamp, value, per-second rate since the previous sample), treating
+    a drop in value as the counter having been reset.
+    """
+    last: typing.Optional[typing.Tuple[float, float]] = None
+    for timestamp, value in samples:
+        rate = None
+        if last is not None and timestamp > last[0]:
+            increase = value - last[1] if value >= last[1] else value
+            rate = increase / (timestamp - last[0])
+        yield timestamp, value, rate
+        last = timestamp, value
+
+
+class History:
+    def __init__(self, names: typing.Iterable[str], size: int = 360,
+                 max_series: int = 1000, max_age: float = 3600) -> None:
+        self.names = frozenset(names)
+        self.size = size
+        self.max_series = max_series
+        # series not seen for this long are dropped to make room; by
+        # default, as long as a full ring of 10s samples covers
+        self.max_age = max_age
+        self.rings: typing.Dict[SeriesKey, Ring] = {}
+        self.types: typing.Dict[str, str] = {}
+        self.rejected = 0  # samples of series over max_series
+        self.lock = threading.Lock()
+
+    def record(self, stat: Stat) -> None:
+        if stat.name not in self.names:
+            return
+        key = (stat.name, stat.labels)
+        timestamp = (stat.timestamp if stat.timestamp is not None
+                     else Stat.now()) / 1000
+        with self.lock:
+            ring = self.rings.get(key)
+            if ring is None:
+                if len(self.rings) >= self.max_series:
+                    self.rejected += 1
+                    return
+                ring = self.rings[key] = Ring(self.size)
+                self.types[stat.name] = stat.type
+            if ring.last_timestamp() == timestamp:
+                return  # the same sample, queued again
+            ring.append(timestamp, float(stat.value))
+
+    def prune(self, now: typing.Optional[float] = None) -> int:
+        """
+        Drop the rings of series that have gone away, so that churning
+        labels don't use up ``max_series`` for good. Returns how many.
+        """
+        cutoff = (time.time() if now is None else now) - self.max_age
+        with self.lock:
+            stale = [key for key, ring in self.rings.items()
+                     if (ring.last_timestamp() or 0) < cutoff]
+            for key in stale:
+                del self.rings[key]
+            names = {name for name, _ in self.rings}
+            for name in list(self.types):
+                if name not in names:
+                    del self.types[name]
+        return len(stale)
+
+    def series(
+        self,
+        names: typing.Iterable[str],
+        since: float = 0,
+    ) -> typing.Iterator[typing.Tuple[
+            SeriesKey, str, typing.List[typing.Tuple[
+                float, float, typing.Optional[float]]]]]:
+        """
+        (series, type, samples) for each series in ``names``; samples are
+        (timestamp, value, rate), with rates only for counters.
+        """
+        names = set(names)
+        with self.lock:
+            selected = [(key, self.types[key[0]], list(ring))
+                        for key, ring in self.rings.items()
+                        if key[0] in names]
+        for key, type_, samples in selected:
+            if type_ == 'counter':
+                rated = list(with_rates(samples))
+            else:
+                rated = [(t, v, None) for t, v in samples]
+            yield key, type_, [s for s in rated if s[0] >= since]
+
+    def json(self, names: typing.Iterable[str], since: float = 0) -> str:
+        return json.dumps({'series': [
+            {
+                'name': name,
+                'labels': dict(labels),
+                'type': type_,
+                'samples': [
+                    [t, json_value(v)] if type_ != 'counter'
+                    else [t, json_value(v), r if r is None else json_value(r)]
+                    for t, v, r in samples
+                ],
+            }
+            for (name, labels), type_, samples in self.series(names, since)
+        ]})
+
+    def csv(self, names: typing.Iterable[str], since: float = 0) -> str:
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(('name', 'labels', 'timestamp', 'value', 'rate'))
+        for (name, labels), _, samples in self.series(names, since):
+            label_text = ','.join(f'{k}={v}' for k, v in labels)
+            for timestamp, value, rate in samples:
+                writer.writerow((name, label_text, timestamp, value,
+                                 '' if rate is None else rate))
+        return buf.getvalue()
+
+    def memory(self) -> int:
+        """
+        Bytes taken by the ring buffers' arrays.
+        """
+        return 16 * self.size * len(self.rings)
+
+
+def json_value(value: float) -> typing.Optional[float]:
+    # JSON has no NaN or infinities
+    return value if math.isfinite(value) else None
@@ -1,8 +1,11 @@
+import collections
+import shlex
 import subprocess
+import traceback
 import typing
 
-from . import categorize_destination_port
-from . import parse_netloc
+from . import commands
+from . import PORTS
 from . import Stat
 from . import Tracker
 from . import WriteOnceStatCollection
@@ -20,43 +23,98 @@ class IPTablesBytesStat(Stat):
     help = "Bytes sent/received"
 
 
+Counters = typing.DefaultDict[
+    typing.Tuple[str, int], typing.List[int]]  # (chain, port) -> [pkts, bytes]
+
+
+def parse_save(
+    out: str,
+    chains: typing.Collection[str],
+    counters: Counters,
+) -> None:
+    """
+    Add up the counters from ``iptables-save -c`` output for single-port
+    rules in the given chains. Rules look like::
+
+        [pkts:bytes] -A CHAIN -p tcp -m tcp --dport 6200 -m comment ...
+    """
+    for line in out.splitlines():
+        if not line.startswith('['):
+            continue
+        count, _, rule = line.partition(' ')
+        try:
+            args = shlex.split(rule)
+        except ValueError:
+            continue  # unbalanced quotes? not one of ours
+        if len(args) < 2 or args[0] != '-A' or args[1] not in chains:
+            continue
+        port = None
+        for opt, val in zip(args, args[1:]):
+            if opt in ('--dport', '--sport', '--destination-port',
+                       '--source-port'):
+                port = val
+        if port is None or not port.isdigit():
+            continue  # ranges and multiport can't be split up per port
+        pkts, _, byts = count.strip('[]').partition(':')
+        totals = counters[args[1], int(port)]
+        totals[0] += int(pkts)
+        totals[1] += int(byts)
+
+
 class IPTablesTracker(Tracker):
+    """
+    Report per-port traffic from the counters on our accounting chains.
+
+    Each scrape is one ``iptables-save -c`` and one ``ip6tables-save -c``,
+    so all of a family's counters are read atomically; v4 and v6 traffic get
+    added together per port.
+    """
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        self.chains = {
+            conf.get('input_chain', 'SWIFT_METRICS_INPUT'): 'rx',
+            conf.get('output_chain', 'SWIFT_METRICS_OUTPUT'): 'tx',
+        }
+        self.commands = [
+            cmd for cmd in (
+                conf.get('iptables_save', 'iptables-save'),
+                conf.get('ip6tables_save', 'ip6tables-save'),
+            ) if cmd
+        ]
+        self.command_timeout = float(conf.get('command_timeout', '10'))
+
     def get_stats(self) -> WriteOnceStatCollection:
-        out = subprocess.run(
-            ['iptables', '-L', '-n', '-v', '-x'],
-            capture_output=True,
-            check=True,
-            encoding='utf-8',
-        ).stdout
+        counters: Counters = collections.defaultdict(lambda: [0, 0])
+        for i, cmd in enumerate(list(self.commands)):
+            try:
+                out = commands.run(
+                    [cmd, '-c', '-t', 'filter'],
+                    self.command_timeout,
+                ).stdout
+            except (OSError, subprocess.SubprocessError) as e:
+                if not i:
+                    raise
+                # no IPv6 on this box? v4 is still worth reporting
+                traceback.print_exc()
+                if isinstance(e, OSError):
+                    self.commands.remove(cmd)  # don't bother next time
+                continue
+            parse_save(out, self.chains, counters)
+
         now = Stat.now()
         stats = WriteOnceStatCollection()
-        for chain in [x.strip() for x in out.split('Chain') if x.strip()]:
-            stat_for = {'INPUT': 'rx', 'OUTPUT': 'tx'}.get(
-                chain.split(' ', 1)[0])
-            if not stat_for:
-                continue
-            for line in chain.split('\n')[2:]:
-                pkts, byts, _, _, _, _, _, _, _, netloc = line.split()
-                parsed = parse_netloc(netloc)
-                if parsed is None:
-                    continue
-                port = parsed[1]
-                stats.update(
-                    IPTablesPacketsStat(
-                        int(pkts), now, (
-                            ("port", str(port)),
-                            ("type", categorize_destination_port(port)),
-                            ("for", stat_for),
-                        ),
-                    ),
-                    IPTablesBytesStat(
-                        int(byts), now, (
-                            ("port", str(port)),
-                            ("type", categorize_destination_port(port)),
-                            ("for", stat_for),
-                        ),
-                    ),
-                )
+        for (chain, port), (pkts, byts) in sorted(counters.items()):
+            info = PORTS.info(port)
+            labels = (
+                ("port", str(port)),
+                ("type", info.type),
+                *info.labels,
+                ("for", self.chains[chain]),
+            )
+            stats.update(
+                IPTablesPacketsStat(pkts, now, labels),
+                IPTablesBytesStat(byts, now, labels),
+            )
         return stats
 
 
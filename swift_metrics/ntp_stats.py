@@ -1,6 +1,13 @@
-import subprocess
+import ctypes
+import ctypes.util
+import os
+import random
+import socket
+import struct
+import traceback
 import typing
 
+from . import commands
 from . import Stat
 from . import Tracker
 from . import WriteOnceStatCollection
@@ -9,25 +16,73 @@ from . import WriteOnceStatCollection
 class DistanceStat(Stat):
     name = "ntp_root_distance"
     type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
-    help = "timesyncd root distance in microseconds"
+    help = "NTP root distance in microseconds"
 
 
 class OffsetStat(Stat):
     name = "ntp_offset"
     type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
-    help = "timesyncd offset in microseconds"
+    help = "NTP offset in microseconds"
 
 
 class DelayStat(Stat):
     name = "ntp_delay"
     type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
-    help = "timesyncd delay in microseconds"
+    help = "NTP root delay in microseconds"
 
 
 class JitterStat(Stat):
     name = "ntp_jitter"
     type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
-    help = "timesyncd jitter in microseconds"
+    help = "NTP jitter in microseconds"
+
+
+class StratumStat(Stat):
+    name = "ntp_stratum"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "chronyd's stratum"
+
+
+class LeapStatusStat(Stat):
+    name = "ntp_leap_status"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "chronyd's leap status (0 normal, 1 insert, 2 delete, 3 unsynced)"
+
+
+class FrequencyStat(Stat):
+    name = "ntp_frequency_ppm"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "chronyd's estimate of the clock's frequency error in ppm"
+
+
+class KernelOffsetStat(Stat):
+    name = "clock_offset"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Offset the kernel is still slewing away, in microseconds"
+
+
+class KernelMaxErrorStat(Stat):
+    name = "clock_max_error"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Kernel's maximum clock error in microseconds"
+
+
+class KernelEstErrorStat(Stat):
+    name = "clock_est_error"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Kernel's estimated clock error in microseconds"
+
+
+class KernelFrequencyStat(Stat):
+    name = "clock_frequency_ppm"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Kernel's clock frequency adjustment in ppm"
+
+
+class KernelSyncStat(Stat):
+    name = "clock_synchronized"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Whether the kernel considers the clock synchronized"
 
 
 def parse_time(time_str):
@@ -49,14 +104,243 @@ def parse_time(time_str):
     raise ValueError(f'Could not parse time: {time_str!r}')
 
 
+class Timeval(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_usec', ctypes.c_long),
+    ]
+
+
+class Timex(ctypes.Structure):
+    """
+    ``struct timex`` from <sys/timex.h>; ctypes' alignment rules give us the
+    same padding the kernel expects.
+    """
+    _fields_ = [
+        ('modes', ctypes.c_uint),
+        ('offset', ctypes.c_long),
+        ('freq', ctypes.c_long),
+        ('maxerror', ctypes.c_long),
+        ('esterror', ctypes.c_long),
+        ('status', ctypes.c_int),
+        ('constant', ctypes.c_long),
+        ('precision', ctypes.c_long),
+        ('tolerance', ctypes.c_long),
+        ('time', Timeval),
+        ('tick', ctypes.c_long),
+        ('ppsfreq', ctypes.c_long),
+        ('jitter', ctypes.c_long),
+        ('shift', ctypes.c_int),
+        ('stabil', ctypes.c_long),
+        ('jitcnt', ctypes.c_long),
+        ('calcnt', ctypes.c_long),
+        ('errcnt', ctypes.c_long),
+        ('stbcnt', ctypes.c_long),
+        ('tai', ctypes.c_int),
+        ('_reserved', ctypes.c_int * 11),
+    ]
+
+
+STA_UNSYNC = 0x0040
+STA_NANO = 0x2000
+TIME_ERROR = 5
+
+
+def load_adjtimex() -> typing.Optional[typing.Callable[[Timex], int]]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        adjtimex = libc.adjtimex
+    except (OSError, AttributeError):
+        return None  # not linux? no kernel stats, then
+    adjtimex.argtypes = [ctypes.POINTER(Timex)]
+    adjtimex.restype = ctypes.c_int
+    return adjtimex
+
+
+# chrony's command protocol; see candm.h
+CHRONY_PROTO_VERSION = 6
+CHRONY_REQ_TRACKING = 33
+CHRONY_RPY_TRACKING = 5
+CHRONY_REQUEST = struct.Struct('!BBBBHHIII')  # header; no data for tracking
+CHRONY_REPLY = struct.Struct('!BBBBHHHHHHIII')
+CHRONY_TRACKING = struct.Struct(
+    '!I'       # ref_id
+    '16sHH'    # ip_addr: addr, family, padding
+    'HH'       # stratum, leap_status
+    'III'      # ref_time: sec high, sec low, nsec
+    'iiiiiiiii'  # current_correction ... last_update_interval (Floats)
+    'i'        # EOR
+)
+# requests get padded out to the length of the reply, so chronyd can't be
+# used for amplification
+CHRONY_REQUEST_LENGTH = CHRONY_REPLY.size + CHRONY_TRACKING.size
+# systemd-timesyncd's RuntimeDirectory; there while it's running
+TIMESYNCD_RUNTIME_DIR = '/run/systemd/timesync'
+
+
+def chrony_float(x: int) -> float:
+    """
+    Decode chrony's 32-bit network float: a 7-bit exponent over a 25-bit
+    coefficient, both two's complement.
+    """
+    x &= 0xffffffff
+    exp = x >> 25
+    if exp >= 1 << 6:
+        exp -= 1 << 7
+    coef = x % (1 << 25)
+    if coef >= 1 << 24:
+        coef -= 1 << 25
+    return coef * 2.0 ** (exp - 25)
+
+
+def chrony_tracking(
+    address: str,
+    timeout: float,
+) -> typing.Dict[str, float]:
+    """
+    Ask chronyd how it's tracking, like ``chronyc tracking`` does. Addresses
+    with a ``/`` are chronyd's unix command socket (which needs us to bind a
+    socket of our own next to it); anything else is ``host:port``.
+    """
+    sequence = random.getrandbits(32)
+    request = CHRONY_REQUEST.pack(
+        CHRONY_PROTO_VERSION, 1, 0, 0, CHRONY_REQ_TRACKING, 0, sequence, 0, 0,
+    ).ljust(CHRONY_REQUEST_LENGTH, b'\0')
+
+    local_path = None
+    if '/' in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        local_path = os.path.join(
+            os.path.dirname(address),
+            f'swift_metrics.{os.getpid()}.{sequence}.sock')
+        target: typing.Any = address
+    else:
+        host, _, port = address.rpartition(':')
+        sock = socket.socket(
+            socket.AF_INET6 if ':' in host else socket.AF_INET,
+            socket.SOCK_DGRAM)
+        target = (host.strip('[]'), int(port))
+    try:
+        if local_path:
+            sock.bind(local_path)
+        sock.settimeout(timeout)
+        sock.connect(target)
+        sock.send(request)
+        while True:
+            reply = sock.recv(1024)
+            if len(reply) < CHRONY_REPLY.size:
+                continue
+            (version, _, _, _, _, rpy, status, _, _, _,
+             seq, _, _) = CHRONY_REPLY.unpack_from(reply)
+            if seq == sequence:
+                break
+    finally:
+        sock.close()
+        if local_path:
+            try:
+                os.unlink(local_path)
+            except OSError:
+                pass
+
+    if version != CHRONY_PROTO_VERSION or rpy != CHRONY_RPY_TRACKING:
+        raise ValueError(f'Unexpected chrony reply {version}/{rpy}')
+    if status != 0:
+        raise ValueError(f'chrony replied with status {status}')
+    if len(reply) < CHRONY_REQUEST_LENGTH:
+        raise ValueError(f'Short chrony reply ({len(reply)} bytes)')
+    fields = CHRONY_TRACKING.unpack_from(reply, CHRONY_REPLY.size)
+    (current_correction, last_offset, rms_offset, freq_ppm, _, _,
+     root_delay, root_dispersion, _) = map(chrony_float, fields[9:18])
+    return {
+        'stratum': fields[4],
+        'leap_status': fields[5],
+        'current_correction': current_correction,
+        'last_offset': last_offset,
+        'rms_offset': rms_offset,
+        'freq_ppm': freq_ppm,
+        'root_delay': root_delay,
+        'root_dispersion': root_dispersion,
+    }
+
+
 class TimeSyncTracker(Tracker):
-    def get_stats(self) -> WriteOnceStatCollection:
+    """
+    Report the kernel's view of the clock (with one ``adjtimex`` call) and,
+    depending on ``ntp_source``, what the NTP daemon thinks:
+
+    * ``auto`` (the default) is ``chrony`` if chronyd's socket is there,
+      else ``timedatectl`` if timesyncd is running, else ``none``
+    * ``chrony`` asks chronyd over ``chrony_address``, if that socket
+      exists
+    * ``timedatectl`` runs ``timedatectl timesync-status``, for timesyncd,
+      which only tells anyone else how it's doing over D-Bus
+    * ``none`` just reports the kernel's stats
+    """
+    scrape_collectable = True
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        self.ntp_source = conf.get('ntp_source', 'auto')
+        self.chrony_address = conf.get(
+            'chrony_address', '/run/chrony/chronyd.sock')
+        self.chrony_timeout = float(conf.get('chrony_timeout', '1'))
+        self.command_timeout = float(conf.get('command_timeout', '10'))
+        self.adjtimex = load_adjtimex()
+
+    def kernel_stats(self) -> WriteOnceStatCollection:
+        if self.adjtimex is None:
+            return WriteOnceStatCollection()
+        tx = Timex()
+        state = self.adjtimex(ctypes.byref(tx))
+        if state < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        scale = 1000 if tx.status & STA_NANO else 1  # offset's ns or us
+        now = Stat.now()
+        return WriteOnceStatCollection((
+            KernelOffsetStat(tx.offset / scale, now),
+            KernelMaxErrorStat(tx.maxerror, now),
+            KernelEstErrorStat(tx.esterror, now),
+            # freq is ppm with a 16-bit fractional part
+            KernelFrequencyStat(tx.freq / 65536, now),
+            KernelSyncStat(int(
+                not tx.status & STA_UNSYNC and state != TIME_ERROR), now),
+        ))
+
+    def detect_source(self) -> str:
+        """
+        What ``auto`` means right now; daemons come and go, so this gets
+        checked every scrape.
+        """
+        if '/' not in self.chrony_address or os.path.exists(
+                self.chrony_address):
+            return 'chrony'
+        if os.path.isdir(TIMESYNCD_RUNTIME_DIR):
+            return 'timedatectl'
+        return 'none'
+
+    def chrony_stats(self) -> WriteOnceStatCollection:
+        if '/' in self.chrony_address and not os.path.exists(
+                self.chrony_address):
+            return WriteOnceStatCollection()  # no chronyd here
+        info = chrony_tracking(self.chrony_address, self.chrony_timeout)
+        now = Stat.now()
+        return WriteOnceStatCollection((
+            OffsetStat(round(info['current_correction'] * 1e6), now),
+            DelayStat(round(info['root_delay'] * 1e6), now),
+            DistanceStat(round(
+                (info['root_delay'] / 2 + info['root_dispersion']) * 1e6),
+                now),
+            JitterStat(round(info['rms_offset'] * 1e6), now),
+            StratumStat(info['stratum'], now),
+            LeapStatusStat(info['leap_status'], now),
+            FrequencyStat(info['freq_ppm'], now),
+        ))
+
+    def timedatectl_stats(self) -> WriteOnceStatCollection:
         info = {}
-        for line in subprocess.run(
+        for line in commands.run(
             ['timedatectl', 'timesync-status'],
-            capture_output=True,
-            check=True,
-            encoding='utf-8'
+            self.command_timeout,
         ).stdout.split('\n'):
             if line:
                 key, value = line.split(': ', 1)
@@ -73,6 +357,23 @@ class TimeSyncTracker(Tracker):
             ) if key in info
         )
 
+    def get_stats(self) -> WriteOnceStatCollection:
+        stats = self.kernel_stats()
+        source = self.ntp_source
+        if source == 'auto':
+            source = self.detect_source()
+        if source == 'chrony':
+            try:
+                stats.merge(self.chrony_stats())
+            except (OSError, ValueError):
+                # chronyd down? still worth reporting the kernel's view
+                traceback.print_exc()
+        elif source == 'timedatectl':
+            stats.merge(self.timedatectl_stats())
+        if not stats:
+            self.ever_reported.set()
+        return stats
+
 
 if __name__ == "__main__":
     TimeSyncTracker.main()
@@ -1,17 +1,21 @@
 import itertools
 import os
-import subprocess
+import pathlib
 import sys
+import time
+import traceback
 import typing
 
-from . import categorize_destination_port
+from . import commands
 from . import is_swift_port
 from . import MEMCACHE_PORT
 from . import parse_netloc
+from . import PORTS
 from . import RSYNC_PORT
 from . import Stat
 from . import Tracker
 from . import WriteOnceStatCollection
+from .state_file import open_state_file
 
 
 class PCPUStat(Stat):
@@ -71,14 +75,55 @@ class ClientConnectionBufferStat(Stat):
 class ProcessTracker(Tracker):
     def configure(self, conf: typing.Dict[str, str]) -> None:
         self.swift_user = conf.get('user', 'swift')
+        self.proc_root = pathlib.Path(conf.get('proc_root', '/proc'))
         self.process_tree: typing.Dict[int, typing.Dict[str, typing.Any]] = {}
 
-        self.clk_tck = int(subprocess.run(
+        self.command_timeout = float(conf.get('command_timeout', '10'))
+
+        self.clk_tck = int(commands.run(
             ['getconf', 'CLK_TCK'],
-            check=True,
-            capture_output=True,
+            self.command_timeout,
         ).stdout)
 
+        # Keep the last scrape's samples across restarts, so the first scrape
+        # after one needn't be thrown away -- unless they're so old that
+        # pids may have been reused
+        self.state_max_age = float(conf.get('state_max_age', '300'))
+        state_dir = conf.get('state_dir', '')
+        self.state = open_state_file(conf.get(
+            'state_file',
+            state_dir and os.path.join(state_dir, 'process.state')))
+        if self.state is not None:
+            self.restore()
+
+    def checkpoint(self) -> None:
+        assert self.state is not None
+        try:
+            self.state.save({
+                'saved_at': time.time(),
+                'processes': {
+                    pid: {k: v for k, v in pid_dict.items()
+                          if k != 'children'}
+                    for pid, pid_dict in self.process_tree.items()
+                    if 'pcpu' in pid_dict
+                },
+            })
+        except Exception:
+            traceback.print_exc()
+
+    def restore(self) -> None:
+        assert self.state is not None
+        try:
+            state = self.state.load()
+        except Exception:
+            traceback.print_exc()
+            return
+        if not state or time.time() - state['saved_at'] > self.state_max_age:
+            return
+        self.process_tree = {
+            int(pid): pid_dict
+            for pid, pid_dict in state['processes'].items()}
+
     def get_stats(self) -> WriteOnceStatCollection:
         cmd = [
             'ps', '--no-headers',
@@ -87,12 +132,11 @@ class ProcessTracker(Tracker):
         ]
         sids = set()
         new_process_tree: typing.Dict[int, typing.Dict[str, typing.Any]] = {}
-        for line in subprocess.run(
+        for line in commands.run(
             cmd,
+            self.command_timeout,
             # There may be no swift processes running, causing ps to exit 1
             check=False,
-            capture_output=True,
-            encoding='utf8',
         ).stdout.strip().split('\n'):
             if not line:
                 continue
@@ -109,12 +153,14 @@ class ProcessTracker(Tracker):
             cmdname = os.path.basename(cmdname)
 
             try:
-                proc_info = open(f'/proc/{pid}/stat').read().split()
+                proc_info = (self.proc_root / str(pid) / 'stat').read_text(
+                    ).split()
                 utime = float(proc_info[13]) / self.clk_tck
                 ktime = float(proc_info[14]) / self.clk_tck
                 starttime = float(proc_info[21]) / self.clk_tck
                 # get this fresh for each pid in case there's some delay
-                uptime = float(open(f'/proc/uptime').read().split()[0])
+                uptime = float(
+                    (self.proc_root / 'uptime').read_text().split()[0])
             except OSError:
                 pass
             else:
@@ -142,15 +188,18 @@ class ProcessTracker(Tracker):
                 'cmd': cmdname,
                 'args': args,
             })
-            pid_dict.update(get_disk_io_stats(pid))
+            pid_dict.update(get_disk_io_stats(pid, self.proc_root))
             if pid != sid:
-                pid_dict.update(get_connection_stats(pid))
+                pid_dict.update(get_connection_stats(
+                    pid, self.command_timeout))
             new_process_tree.setdefault(ppid, {}).setdefault(
                 'children', {})[pid] = pid_dict
 
         now = Stat.now()
         old_process_tree, self.process_tree = \
             self.process_tree, new_process_tree
+        if self.state is not None:
+            self.checkpoint()
         if not old_process_tree:
             # first run; trust nothing
             return WriteOnceStatCollection()
@@ -168,13 +217,16 @@ class ProcessTracker(Tracker):
         return stats
 
 
-def get_disk_io_stats(pid: int) -> typing.Dict[str, int]:
+def get_disk_io_stats(
+    pid: int,
+    proc_root: pathlib.Path = pathlib.Path('/proc'),
+) -> typing.Dict[str, int]:
     io_stats = {
         'read_bytes': 0,
         'write_bytes': 0,
     }
     try:
-        with open(f'/proc/{pid}/io') as fp:
+        with open(proc_root / str(pid) / 'io') as fp:
             for line in fp:
                 if line.startswith('read_bytes: '):
                     io_stats['read_bytes'] = int(line.split()[1])
@@ -185,15 +237,18 @@ def get_disk_io_stats(pid: int) -> typing.Dict[str, int]:
     return io_stats
 
 
-def get_connection_stats(pid: int) -> typing.Dict[str, typing.Any]:
+def get_connection_stats(
+    pid: int,
+    timeout: float,
+) -> typing.Dict[str, typing.Any]:
     result: typing.Dict[str, typing.Any] = {}
-    info = subprocess.run([
+    info = commands.run([
         'lsof', '-a', '-n', '-P',
         '-p', str(pid),
         '-i',
         '-T', 'sq',
         '-F', 'fnT0',
-    ], encoding='utf8', capture_output=True).stdout.strip('\n')
+    ], timeout, check=False).stdout.strip('\n')
     if not info:
         return result
 
@@ -285,55 +340,53 @@ def make_stats(
         )),
     ))
     for port, port_dict in pid_dict.get('server', {}).items():
+        info = PORTS.info(port)
+        port_labels = (('port', str(port)), ('type', info.type), *info.labels)
         for state, state_dict in port_dict.items():
             stats.update(
                 ServerConnectionCountStat(state_dict['connections'], now, (
                     ("pid", pid_dict['pid']),
                     ("command", pid_dict['cmd']),
-                    ('port', str(port)),
-                    ('type', categorize_destination_port(port)),
+                    *port_labels,
                     ('state', state),
                 )),
                 ServerConnectionBufferStat(state_dict['recv_buffer'], now, (
                     ("pid", pid_dict['pid']),
                     ("command", pid_dict['cmd']),
-                    ('port', str(port)),
-                    ('type', categorize_destination_port(port)),
+                    *port_labels,
                     ('state', state),
                     ('for', 'rx'),
                 )),
                 ServerConnectionBufferStat(state_dict['send_buffer'], now, (
                     ("pid", pid_dict['pid']),
                     ("command", pid_dict['cmd']),
-                    ('port', str(port)),
-                    ('type', categorize_destination_port(port)),
+                    *port_labels,
                     ('state', state),
                     ('for', 'tx'),
                 )),
             )
     for port, port_dict in pid_dict.get('client', {}).items():
+        # the far end's port; whatever we know of it is about our devices
+        port_labels = (('port', str(port)), ('type', PORTS.info(port).type))
         for state, state_dict in port_dict.items():
             stats.update(
                 ClientConnectionCountStat(state_dict['connections'], now, (
                     ("pid", pid_dict['pid']),
                     ("command", pid_dict['cmd']),
-                    ('port', str(port)),
-                    ('type', categorize_destination_port(port)),
+                    *port_labels,
                     ('state', state),
                 )),
                 ClientConnectionBufferStat(state_dict['recv_buffer'], now, (
                     ("pid", pid_dict['pid']),
                     ("command", pid_dict['cmd']),
-                    ('port', str(port)),
-                    ('type', categorize_destination_port(port)),
+                    *port_labels,
                     ('state', state),
                     ('for', 'rx'),
                 )),
                 ClientConnectionBufferStat(state_dict['send_buffer'], now, (
                     ("pid", pid_dict['pid']),
                     ("command", pid_dict['cmd']),
-                    ('port', str(port)),
-                    ('type', categorize_destination_port(port)),
+                    *port_labels,
                     ('state', state),
                     ('for', 'tx'),
                 )),
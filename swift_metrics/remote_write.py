@@ -0,0 +1,448 @@
+"""
+Push the manager's series to a Prometheus remote-write endpoint, for nodes
+that can't be scraped (say, from behind NAT):
+
+    python -m swift_metrics push https://prometheus.example.com/api/v1/write
+
+Each push only sends series whose value changed since they were last sent,
+plus any that haven't been sent in ``resend_interval`` so they don't go
+stale. Requests that fail get retried with backoff; if that doesn't work,
+they're spooled to disk (up to ``max_spool_bytes``, oldest dropped first)
+and sent, in order, once the endpoint's back -- less any samples that have
+got older than ``max_sample_age`` by then, which the endpoint would reject
+(and with them, everything else in the request).
+
+Requests are protobuf, encoded by hand to save a dependency, compressed
+with python-snappy if it's installed. If it isn't, we still produce valid
+snappy -- just without any actual compression.
+"""
+import collections
+import functools
+import http.client
+import os
+import pathlib
+import socket
+import struct
+import time
+import traceback
+import typing
+import urllib.parse
+
+from . import Stat
+from . import Tracker
+from . import WriteOnceStatCollection
+
+try:
+    import snappy  # type: ignore
+except ImportError:
+    snappy = None
+
+
+class RemoteWriteSamplesStat(Stat):
+    name = "remote_write_samples"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Samples pushed to remote write, by what became of them"
+
+
+class RemoteWriteRequestsStat(Stat):
+    name = "remote_write_requests"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Remote write requests, by response status"
+
+
+class RemoteWriteSpoolBytesStat(Stat):
+    name = "remote_write_spool_bytes"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Requests waiting on disk for the remote write endpoint"
+
+
+INT64_MASK = (1 << 64) - 1
+DOUBLE = struct.Struct('<d')
+
+SeriesKey = typing.Tuple[str, typing.Tuple[typing.Tuple[str, str], ...]]
+
+
+SMALL_VARINTS = [bytes([n]) for n in range(0x80)]
+
+
+def varint(n: int) -> bytes:
+    if n < 0x80:
+        return SMALL_VARINTS[n]  # tags, and most lengths
+    out = bytearray()
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def length_delimited(field: int, data: bytes) -> bytes:
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def encode_label(name: str, value: str) -> bytes:
+    """
+    One Label message, wrapped as a TimeSeries ``labels`` field. The same
+    few label pairs turn up on many series, so these get cached.
+    """
+    return length_delimited(1, length_delimited(1, name.encode('utf-8'))
+                            + length_delimited(2, value.encode('utf-8')))
+
+
+def encode_labels(
+    name: str,
+    labels: typing.Iterable[typing.Tuple[str, typing.Any]],
+    extra: typing.Dict[str, str],
+) -> bytes:
+    """
+    The ``labels`` fields of a TimeSeries message. Remote write wants them
+    sorted by name; later labels win over ``extra`` ones.
+    """
+    all_labels = dict(extra)
+    all_labels.update((k, str(v)) for k, v in labels)
+    all_labels['__name__'] = name
+    return b''.join(
+        encode_label(k, v) for k, v in sorted(all_labels.items()))
+
+
+def encode_sample(value: float, timestamp_ms: int) -> bytes:
+    """
+    The ``samples`` field of a TimeSeries message, with one Sample in it.
+    """
+    return length_delimited(
+        2,
+        b'\x09' + DOUBLE.pack(value) + b'\x10' +
+        varint(timestamp_ms & INT64_MASK))
+
+
+def read_varint(data: bytes, pos: int) -> typing.Tuple[int, int]:
+    """
+    :returns: the varint at ``pos``, and the position after it
+    """
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def split_timeseries(body: bytes) -> typing.Iterator[bytes]:
+    """
+    The TimeSeries fields of an (uncompressed) WriteRequest, as encoded.
+    """
+    pos = 0
+    while pos < len(body):
+        start = pos
+        _, pos = read_varint(body, pos)  # always field 1, length-delimited
+        length, pos = read_varint(body, pos)
+        pos += length
+        yield body[start:pos]
+
+
+def sample_timestamp(timeseries: bytes) -> typing.Optional[int]:
+    """
+    The timestamp of the (first) sample in one of split_timeseries()'s
+    TimeSeries fields.
+    """
+    _, pos = read_varint(timeseries, 0)
+    _, pos = read_varint(timeseries, pos)
+    while pos < len(timeseries):
+        tag, pos = read_varint(timeseries, pos)
+        length, pos = read_varint(timeseries, pos)
+        if tag == 2 << 3 | 2:  # samples
+            sample = timeseries[pos:pos + length]
+            if sample[:1] == b'\x09' and sample[9:10] == b'\x10':
+                timestamp, _ = read_varint(sample, 10)
+                if timestamp >= 1 << 63:
+                    timestamp -= 1 << 64
+                return timestamp
+        pos += length
+    return None
+
+
+def snappy_literal(data: bytes) -> bytes:
+    """
+    Snappy block format with everything stored as literals: no smaller,
+    but any snappy decoder can read it.
+    """
+    out = [varint(len(data))]
+    for i in range(0, len(data), 1 << 16):
+        chunk = data[i:i + (1 << 16)]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(bytes([n << 2]))
+        elif n < 1 << 8:
+            out.append(bytes([60 << 2, n]))
+        else:
+            out.append(bytes([61 << 2]) + n.to_bytes(2, 'little'))
+        out.append(chunk)
+    return b''.join(out)
+
+
+def compress(data: bytes) -> bytes:
+    if snappy is not None:
+        return snappy.compress(data)
+    return snappy_literal(data)
+
+
+class Spool:
+    """
+    Requests waiting to be sent, one file each, named so they sort oldest
+    first and remember how many samples they hold. They're kept
+    uncompressed, so samples can be picked out of them.
+    """
+
+    def __init__(self, path: pathlib.Path, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0  # samples thrown away to stay under max_bytes
+
+    def files(self) -> typing.List[pathlib.Path]:
+        try:
+            return sorted(self.path.glob('*.req'))
+        except OSError:
+            return []
+
+    def size(self) -> int:
+        total = 0
+        for path in self.files():
+            try:
+                total += path.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def put(self, body: bytes, samples: int) -> None:
+        path = self.path / f'{time.time_ns():020d}.{samples}.req'
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as fp:
+                fp.write(body)
+            os.replace(tmp_path, path)
+        except OSError:
+            traceback.print_exc()
+            self.dropped += samples
+            return
+        self.trim()
+
+    def trim(self) -> None:
+        files = self.files()
+        sizes = [p.stat().st_size for p in files]
+        total = sum(sizes)
+        for path, size in zip(files, sizes):
+            if total <= self.max_bytes:
+                break
+            self.dropped += samples_in(path)
+            path.unlink()
+            total -= size
+
+
+def samples_in(path: pathlib.Path) -> int:
+    return int(path.name.split('.')[1])
+
+
+class RemoteWriteTracker(Tracker):
+    """
+    Every ``push_interval``, push what the manager has to a remote-write
+    endpoint; report how that's going like any other tracker would.
+    """
+
+    def configure(self, conf: typing.Dict[str, typing.Any]) -> None:
+        # slight abuse, as with SwiftDiskRingAssignmentTracker
+        self.manager = conf['manager']
+        url = urllib.parse.urlsplit(conf['url'])
+        self.conn_class = (http.client.HTTPSConnection
+                           if url.scheme == 'https'
+                           else http.client.HTTPConnection)
+        self.netloc = url.netloc
+        self.path = url.path + (f'?{url.query}' if url.query else '')
+        self.conn: typing.Optional[http.client.HTTPConnection] = None
+        self.interval = float(conf.get('push_interval', '15'))
+        self.timeout = float(conf.get('push_timeout', '10'))
+        self.resend_interval = float(conf.get('resend_interval', '120'))
+        self.max_samples = int(conf.get('max_samples_per_send', '2000'))
+        self.max_retries = int(conf.get('max_retries', '3'))
+        self.min_backoff = float(conf.get('min_backoff', '0.5'))
+        self.max_backoff = float(conf.get('max_backoff', '30'))
+        # Prometheus won't take samples more than about an hour older than
+        # the newest it has
+        self.max_sample_age = float(conf.get('max_sample_age', '3000'))
+        self.spool = Spool(
+            pathlib.Path(conf.get(
+                'spool_dir', '/var/cache/swift_metrics/remote_write')),
+            int(conf.get('max_spool_bytes', str(64 << 20))))
+        # remote write has no targets to get these from
+        self.extra_labels = {
+            'instance': conf.get('instance', socket.gethostname()),
+            'job': conf.get('job', 'swift_metrics'),
+        }
+        # series -> (value, when it was last sent)
+        self.sent: typing.Dict[
+            SeriesKey, typing.Tuple[typing.Any, float]] = {}
+        self.label_cache: typing.Dict[SeriesKey, bytes] = {}
+        self.samples: typing.Counter[str] = collections.Counter()
+        self.requests: typing.Counter[str] = collections.Counter()
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        backlog = self.drain_spool()
+        for body, samples in self.batches(self.manager.get_stats()):
+            if backlog:
+                # keep it behind what's spooled; Prometheus won't take
+                # samples older than ones it already has
+                self.spool.put(body, samples)
+                self.samples['spooled'] += samples
+            elif not self.send(compress(body), samples):
+                self.spool.put(body, samples)
+                self.samples['spooled'] += samples
+                backlog = True
+
+        now = Stat.now()
+        stats = WriteOnceStatCollection(
+            RemoteWriteSamplesStat(self.samples[result], now, (
+                ("result", result),
+            ))
+            for result in ('sent', 'rejected', 'spooled', 'expired')
+        )
+        stats.update(
+            RemoteWriteSamplesStat(self.spool.dropped, now, (
+                ("result", "dropped"),
+            )),
+            RemoteWriteSpoolBytesStat(self.spool.size(), now),
+        )
+        stats.merge(
+            RemoteWriteRequestsStat(n, now, (("code", code),))
+            for code, n in sorted(self.requests.items())
+        )
+        return stats
+
+    def batches(
+        self,
+        stats: typing.Iterable[Stat],
+    ) -> typing.Iterator[typing.Tuple[bytes, int]]:
+        """
+        Uncompressed WriteRequests of up to ``max_samples`` series that
+        changed (or are due a resend), and how many samples each has.
+        """
+        now = time.time()
+        now_ms = Stat.now()
+        seen = set()
+        batch: typing.List[bytes] = []
+        for stat in stats:
+            key = (stat.name, stat.labels)
+            seen.add(key)
+            last = self.sent.get(key)
+            if last is not None and last[0] == stat.value \
+                    and now - last[1] < self.resend_interval:
+                continue
+            labels = self.label_cache.get(key)
+            if labels is None:
+                labels = encode_labels(
+                    stat.name, stat.labels, self.extra_labels)
+                self.label_cache[key] = labels
+            batch.append(length_delimited(1, labels + encode_sample(
+                float(stat.value),
+                stat.timestamp if stat.timestamp is not None else now_ms)))
+            self.sent[key] = (stat.value, now)
+            if len(batch) >= self.max_samples:
+                yield b''.join(batch), len(batch)
+                batch = []
+        if batch:
+            yield b''.join(batch), len(batch)
+        # forget series that went away
+        for cache in (self.sent, self.label_cache):
+            for key in set(cache) - seen:
+                del cache[key]
+
+    def drain_spool(self) -> bool:
+        """
+        Send what's spooled, oldest first.
+
+        :returns: whether anything's still spooled
+        """
+        for path in self.spool.files():
+            try:
+                body = path.read_bytes()
+            except OSError:
+                continue  # trimmed out from under us
+            body, samples = self.unexpired(body)
+            # the spool's whole point is to get through outages; don't
+            # sit retrying each file
+            if samples and not self.send(compress(body), samples, retries=0):
+                return True
+            path.unlink()
+        return False
+
+    def unexpired(self, body: bytes) -> typing.Tuple[bytes, int]:
+        """
+        ``body`` without the samples older than ``max_sample_age``, and how
+        many samples that leaves; the rest count as expired.
+        """
+        cutoff = Stat.now() - self.max_sample_age * 1000
+        kept = []
+        expired = 0
+        for timeseries in split_timeseries(body):
+            timestamp = sample_timestamp(timeseries)
+            if timestamp is not None and timestamp < cutoff:
+                expired += 1
+            else:
+                kept.append(timeseries)
+        self.samples['expired'] += expired
+        return b''.join(kept), len(kept)
+
+    def send(self, body: bytes, samples: int,
+             retries: typing.Optional[int] = None) -> bool:
+        """
+        POST a request, retrying with backoff on errors that might be
+        temporary.
+
+        :returns: False if it should be tried again later, True otherwise
+                  (even if the endpoint rejected it)
+        """
+        if retries is None:
+            retries = self.max_retries
+        backoff = self.min_backoff
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            try:
+                status = self.post(body)
+            except (OSError, http.client.HTTPException):
+                traceback.print_exc()
+                self.requests['error'] += 1
+                self.close()
+                continue
+            self.requests[str(status)] += 1
+            if status < 300:
+                self.samples['sent'] += samples
+                return True
+            if status != 429 and status < 500:
+                # a bad request won't get any better by sending it again
+                self.samples['rejected'] += samples
+                return True
+        return False
+
+    def post(self, body: bytes) -> int:
+        if self.conn is None:
+            self.conn = self.conn_class(self.netloc, timeout=self.timeout)
+        self.conn.request('POST', self.path, body, {
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'User-Agent': 'swift_metrics',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        })
+        resp = self.conn.getresponse()
+        resp.read()
+        if resp.will_close:
+            self.close()
+        return resp.status
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -1,23 +1,216 @@
+"""
+Install (or update) the accounting chains IPTablesTracker reads.
+
+Rules live in their own SWIFT_METRICS_INPUT/SWIFT_METRICS_OUTPUT chains,
+jumped to from INPUT/OUTPUT; nothing else in the firewall gets touched. Each
+run diffs what's installed against what the rings and config call for and
+applies just the difference with one ``iptables-restore --noflush`` per
+address family, so rules that stay keep their counters.
+
+    python -m swift_metrics.setup_port_counters [--dry-run] [--swift-dir ...]
+"""
+import argparse
+import collections
+import pathlib
+import shlex
 import subprocess
+import sys
+import typing
+
+import swift.common.ring  # type: ignore
+import swift.common.utils  # type: ignore
+
+from . import PortInfo
+
+
+INPUT_CHAIN = 'SWIFT_METRICS_INPUT'
+OUTPUT_CHAIN = 'SWIFT_METRICS_OUTPUT'
+DEFAULT_EXTRA_PORTS = '8080,11211,873'  # proxy, memcache, rsync
+# ports we mostly talk to other nodes on, rather than serve
+DEFAULT_CLIENT_PORTS = '873'
+
+
+def ring_ports(
+    swift_dir: pathlib.Path,
+    my_ips: typing.Collection[str],
+) -> typing.Set[int]:
+    """
+    Every port (and replication port) the rings have local devices on,
+    including servers-per-port object ports.
+    """
+    ports = set()
+    for path in sorted(swift_dir.glob('*.ring.gz')):
+        ring = swift.common.ring.Ring(str(path), reload_time=float('inf'))
+        for dev in ring.devs:
+            if dev is None:
+                continue
+            if dev['ip'] in my_ips:
+                ports.add(dev['port'])
+            if dev.get('replication_ip', dev['ip']) in my_ips:
+                ports.add(dev.get('replication_port', dev['port']))
+    return ports
+
+
+def ring_port_map(
+    rings: typing.Dict[str, swift.common.ring.Ring],
+    my_ips: typing.Collection[str],
+) -> typing.Dict[int, PortInfo]:
+    """
+    What each port (and replication port) in the rings is for, given rings
+    by name (``object-1``, ``container``, ...). Local ports serving a
+    single policy or device, like servers-per-port object ports, say which.
+
+    A port's type comes from our own devices when we have any on it, since
+    those are the servers listening on it here; other nodes may well use
+    the same port for something else.
+    """
+    types: typing.Dict[int, typing.Set[str]] = collections.defaultdict(set)
+    local_types: typing.Dict[int, typing.Set[str]] = \
+        collections.defaultdict(set)
+    # port -> {(policy, device)}, for our own devices
+    local: typing.Dict[int, typing.Set[typing.Tuple[str, str]]] = \
+        collections.defaultdict(set)
+    for name, ring in sorted(rings.items()):
+        type_, _, policy = name.partition('-')
+        if type_ == 'object':
+            policy = policy or '0'
+        for dev in ring.devs:
+            if dev is None:
+                continue
+            for ip, port in (
+                (dev['ip'], dev['port']),
+                (dev.get('replication_ip', dev['ip']),
+                 dev.get('replication_port', dev['port'])),
+            ):
+                types[port].add(type_)
+                if ip in my_ips:
+                    local_types[port].add(type_)
+                    local[port].add((policy, dev['device']))
+
+    ports = {}
+    for port, port_types in types.items():
+        labels = []
+        if local.get(port):
+            policies, devices = (set(x) for x in zip(*local[port]))
+            if len(policies) == 1 and '' not in policies:
+                labels.append(('policy', policies.pop()))
+            if len(devices) == 1:
+                labels.append(('device', devices.pop()))
+        # only a strange deployment shares a port between servers
+        ports[port] = PortInfo(
+            '+'.join(sorted(local_types.get(port) or port_types)),
+            tuple(labels))
+    return ports
+
+
+def desired_rules(
+    ports: typing.Iterable[int],
+    client_ports: typing.Collection[int],
+) -> typing.Set[str]:
+    """
+    Rules, in the form ``iptables-save`` prints them, so they can be
+    compared against what's installed.
+    """
+    rules = set()
+    for port in ports:
+        rules.add(f'-A {INPUT_CHAIN} -p tcp -m tcp --dport {port}')
+        if port in client_ports:
+            rules.add(f'-A {OUTPUT_CHAIN} -p tcp -m tcp --dport {port}')
+        else:
+            rules.add(f'-A {OUTPUT_CHAIN} -p tcp -m tcp --sport {port}')
+    return rules
+
+
+def restore_script(saved: str, rules: typing.Set[str]) -> str:
+    """
+    Build the ``iptables-restore --noflush`` input that gets from ``saved``
+    (``iptables-save -t filter`` output) to having exactly ``rules`` in our
+    chains. Returns an empty string if there's nothing to do.
+
+    Note that we only declare chains that don't exist yet -- declaring one
+    under --noflush flushes it, which would reset all its counters.
+    """
+    chains = set()
+    installed = set()
+    jumps = set()
+    for line in saved.splitlines():
+        if line.startswith(':'):
+            chains.add(line[1:].split()[0])
+        elif line.startswith('-A '):
+            args = shlex.split(line)
+            if args[1] in (INPUT_CHAIN, OUTPUT_CHAIN):
+                installed.add(' '.join(shlex.quote(a) for a in args))
+            elif args[2:] in (['-j', INPUT_CHAIN], ['-j', OUTPUT_CHAIN]):
+                jumps.add((args[1], args[3]))
+
+    lines = [f':{chain} - [0:0]' for chain in (INPUT_CHAIN, OUTPUT_CHAIN)
+             if chain not in chains]
+    lines.extend('-D' + rule[2:] for rule in sorted(installed - rules))
+    lines.extend(sorted(rules - installed))
+    for parent, chain in (('INPUT', INPUT_CHAIN), ('OUTPUT', OUTPUT_CHAIN)):
+        if (parent, chain) not in jumps:
+            lines.append(f'-I {parent} 1 -j {chain}')
+    if not lines:
+        return ''
+    return '\n'.join(['*filter'] + lines + ['COMMIT', ''])
+
+
+def apply(family: str, rules: typing.Set[str], dry_run: bool) -> None:
+    saved = subprocess.run(
+        [f'{family}-save', '-t', 'filter'],
+        capture_output=True,
+        check=True,
+        encoding='utf-8',
+    ).stdout
+    script = restore_script(saved, rules)
+    if not script:
+        print(f'{family}: up to date')
+        return
+    if dry_run:
+        print(f'{family}: would apply')
+        print(script, end='')
+        return
+    subprocess.run(
+        [f'{family}-restore', '--noflush'],
+        input=script,
+        check=True,
+        encoding='utf-8',
+    )
+    print(f'{family}: applied {len(script.splitlines()) - 2} changes')
+
 
+def parse_ports(value: str) -> typing.Set[int]:
+    return {int(p) for p in value.split(',') if p.strip()}
 
-def flush():
-    subprocess.run(['iptables', '-F', 'INPUT'], check=True)
-    subprocess.run(['iptables', '-F', 'OUTPUT'], check=True)
 
+def main(args: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--swift-dir', type=pathlib.Path,
+                        default=pathlib.Path('/etc/swift'))
+    parser.add_argument('--extra-ports', type=parse_ports,
+                        default=DEFAULT_EXTRA_PORTS,
+                        help='comma-separated ports to track in addition to '
+                             'the ones in the rings (default: %(default)s)')
+    parser.add_argument('--client-ports', type=parse_ports,
+                        default=DEFAULT_CLIENT_PORTS,
+                        help='ports to track outgoing connections to, '
+                             'rather than responses from (default: '
+                             '%(default)s)')
+    parser.add_argument('--no-ipv6', action='store_true')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print what would change, but change nothing')
+    opts = parser.parse_args(args)
 
-def track(port):
-    subprocess.run(['iptables', '-A', 'INPUT', '-p', 'tcp', '--dport', str(port)], check=True)
-    subprocess.run(['iptables', '-A', 'OUTPUT', '-p', 'tcp', '--dport' if port == 873 else '--sport', str(port)], check=True)
+    ports = opts.extra_ports | ring_ports(
+        opts.swift_dir, set(swift.common.utils.whataremyips()))
+    rules = desired_rules(ports, opts.client_ports)
+    apply('iptables', rules, opts.dry_run)
+    if not opts.no_ipv6:
+        try:
+            apply('ip6tables', rules, opts.dry_run)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f'ip6tables: skipped ({e})', file=sys.stderr)
 
 
 if __name__ == '__main__':
-    flush()
-    track(8080)
-    track(6201)
-    track(6202)
-    track(6203)
-    track(6204)
-
-    track(11211)  # memcache
-    track(873)  # rsync
+    main()
@@ -0,0 +1,137 @@
+"""
+Somewhere for trackers to checkpoint state that should survive a restart,
+like counters built up from StatsD packets.
+
+The file is memory-mapped and holds two slots. Each save goes to whichever
+slot has the older generation, so there's always a complete checkpoint to
+fall back on if we die mid-write; on load, the newest slot whose checksum
+works out wins. Saving is a memcpy into the page cache -- no fsync, since
+it's process restarts we care about, not the machine's.
+"""
+import json
+import mmap
+import os
+import pathlib
+import struct
+import traceback
+import typing
+import zlib
+
+
+MAGIC = b'SMST'
+VERSION = 1
+HEADER = struct.Struct('<4sII')  # magic, version, slot size
+SLOT_HEADER = struct.Struct('<QII')  # generation, length, crc32
+MIN_SLOT_SIZE = 1 << 16
+
+
+class StateFile:
+    def __init__(self, path: typing.Union[str, os.PathLike]) -> None:
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.map: typing.Optional[mmap.mmap] = None
+        self.slot_size = 0
+        self.generation = 0
+        size = os.fstat(self.fd).st_size
+        try:
+            if size < HEADER.size:
+                raise ValueError('new file')
+            magic, version, slot_size = HEADER.unpack(
+                os.pread(self.fd, HEADER.size, 0))
+            if magic != MAGIC or version != VERSION or \
+                    size != HEADER.size + 2 * (SLOT_HEADER.size + slot_size):
+                raise ValueError('not a state file we can read')
+            self.remap(slot_size)
+        except ValueError:
+            self.resize(MIN_SLOT_SIZE)
+
+    def slot_offset(self, slot: int) -> int:
+        return HEADER.size + slot * (SLOT_HEADER.size + self.slot_size)
+
+    def remap(self, slot_size: int) -> None:
+        if self.map is not None:
+            self.map.close()
+        self.slot_size = slot_size
+        self.map = mmap.mmap(self.fd, self.slot_offset(2))
+
+    def resize(self, slot_size: int) -> None:
+        """
+        Start over with empty slots of a new size.
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.slot_size = slot_size
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, self.slot_offset(2))
+        os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION, slot_size), 0)
+        self.remap(slot_size)
+
+    def slots(self) -> typing.List[typing.Tuple[int, int, int]]:
+        """
+        (generation, length, crc32) for each slot.
+        """
+        assert self.map is not None
+        return [SLOT_HEADER.unpack_from(self.map, self.slot_offset(slot))
+                for slot in (0, 1)]
+
+    def load(self) -> typing.Any:
+        """
+        The most recently saved state, or None if there isn't any.
+        """
+        assert self.map is not None
+        slots = self.slots()
+        for slot in sorted((0, 1), key=lambda s: slots[s][0], reverse=True):
+            generation, length, crc = slots[slot]
+            if not generation or length > self.slot_size:
+                continue
+            start = self.slot_offset(slot) + SLOT_HEADER.size
+            data = self.map[start:start + length]
+            if zlib.crc32(data) != crc:
+                continue  # torn write
+            self.generation = generation
+            try:
+                return json.loads(data)
+            except ValueError:
+                traceback.print_exc()
+        return None
+
+    def save(self, state: typing.Any) -> None:
+        data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+        if len(data) > self.slot_size:
+            self.resize(max(self.slot_size * 2, 1 << len(data).bit_length()))
+        assert self.map is not None
+        slots = self.slots()
+        slot = 0 if slots[0][0] <= slots[1][0] else 1
+        self.generation = max(slots[0][0], slots[1][0], self.generation) + 1
+        offset = self.slot_offset(slot)
+        # invalidate the slot before touching its data...
+        SLOT_HEADER.pack_into(self.map, offset, 0, 0, 0)
+        start = offset + SLOT_HEADER.size
+        self.map[start:start + len(data)] = data
+        # ... and only say it's good once it is
+        SLOT_HEADER.pack_into(self.map, offset, self.generation, len(data),
+                              zlib.crc32(data))
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+
+
+def open_state_file(
+    path: typing.Optional[str],
+) -> typing.Optional[StateFile]:
+    """
+    A StateFile at ``path``, or None if that's empty or the file can't be
+    opened -- losing state across restarts is no reason not to run.
+    """
+    if not path:
+        return None
+    try:
+        return StateFile(path)
+    except OSError:
+        traceback.print_exc()
+        return None
@@ -0,0 +1,165 @@
+import array
+import bisect
+import pathlib
+import time
+import traceback
+import typing
+
+from . import CallTimeout
+from . import DeviceCalls
+from . import ListingCache
+from . import Stat
+from . import TokenBucket
+from . import Tracker
+from . import WriteOnceStatCollection
+
+
+class AsyncPendingCountStat(Stat):
+    name = "async_pendings"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Container updates waiting to be sent by the object-updater"
+
+
+class AsyncPendingAgeHistogram(Stat):
+    name = "async_pending_age_bucket"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Async pendings no older than some number of seconds"
+
+
+class QuarantinedCountStat(Stat):
+    name = "quarantined"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Quarantined objects/DBs"
+
+
+class TmpCountStat(Stat):
+    name = "tmp_entries"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Entries in a device's tmp dir"
+
+
+AGE_BUCKETS = (  # seconds
+    60,
+    300,
+    900,
+    3600,
+    14400,
+    86400,
+    604800,
+    float('inf'),
+)
+
+
+def parse_async_timestamps(names: typing.Iterable[str]) -> array.array:
+    """
+    Pull the timestamps out of async pending file names (which look like
+    ``<hash>-<timestamp>``), sorted so we can bisect them by age later.
+    """
+    timestamps = []
+    for name in names:
+        try:
+            timestamps.append(
+                float(name.rpartition('-')[2].partition('_')[0]))
+        except ValueError:
+            # probably some tempfile
+            continue
+    return array.array('d', sorted(timestamps))
+
+
+class SwiftBacklogTracker(Tracker):
+    """
+    Count async pendings (with an age histogram), quarantined objects/DBs
+    and tmp entries per device.
+
+    Every directory's listing is cached against its mtime, so a pass over an
+    unchanged tree costs one stat per directory rather than a listdir.
+    """
+    interval = 60  # seconds
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        self.devices_path = pathlib.Path(conf.get('devices', '/srv/node'))
+        self.listings = ListingCache(
+            TokenBucket(float(conf.get('scan_ops_per_second', '0'))),
+            DeviceCalls(
+                self.devices_path,
+                float(conf.get('syscall_timeout', '60')),
+                self.interval,
+                float(conf.get('max_scan_backoff', '3600'))))
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        stats = WriteOnceStatCollection()
+        for disk in sorted(self.devices_path.iterdir()):
+            try:
+                stats.merge(self.device_stats(disk))
+            except (OSError, CallTimeout):
+                # failed disk? keep what we knew about it for next time
+                traceback.print_exc()
+                self.listings.keep(disk)
+        self.listings.finish_pass()
+
+        if not stats:
+            # Normally, the super() code handles this -- but even if we don't
+            # have any data, we want to count as reported
+            self.ever_reported.set()
+        return stats
+
+    def device_stats(self, disk: pathlib.Path) -> WriteOnceStatCollection:
+        stats = WriteOnceStatCollection()
+        for name in self.listings.get(disk, sorted):
+            path = disk / name
+            if name.startswith('async_pending'):
+                stats.merge(self.async_pending_stats(path))
+            elif name == 'quarantined':
+                now = Stat.now()
+                stats.merge(
+                    QuarantinedCountStat(
+                        len(self.listings.get(path / typ)), now, (
+                            ("device", disk.name),
+                            ("type", typ),
+                        )
+                    ) for typ in self.listings.get(path, sorted)
+                )
+            elif name == 'tmp':
+                stats.update(TmpCountStat(
+                    len(self.listings.get(path)), Stat.now(), (
+                        ("device", disk.name),
+                    )
+                ))
+        return stats
+
+    def async_pending_stats(
+            self, path: pathlib.Path) -> WriteOnceStatCollection:
+        count = 0
+        ages = [0] * len(AGE_BUCKETS)
+        now = time.time()
+        for suffix in self.listings.get(path):
+            try:
+                timestamps = self.listings.get(
+                    path / suffix, parse_async_timestamps)
+            except (FileNotFoundError, NotADirectoryError):
+                # updater cleaned it up out from under us, or some tempfile
+                continue
+            count += len(timestamps)
+            for i, threshold in enumerate(AGE_BUCKETS):
+                ages[i] += len(timestamps) - bisect.bisect_left(
+                    timestamps, now - threshold)
+
+        labels = (
+            ("device", path.parent.name),
+            ("policy", path.name),
+        )
+        stat_now = Stat.now()
+        stats = WriteOnceStatCollection((
+            AsyncPendingCountStat(count, stat_now, labels),
+        ))
+        stats.merge(
+            AsyncPendingAgeHistogram(n, stat_now, labels + (
+                ("le", "+Inf" if threshold == float('inf')
+                 else str(threshold)),
+            )) for threshold, n in zip(AGE_BUCKETS, ages)
+        )
+        return stats
+
+
+if __name__ == "__main__":
+    SwiftBacklogTracker.main()
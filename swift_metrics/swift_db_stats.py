@@ -0,0 +1,353 @@
+import heapq
+import json
+import os
+import pathlib
+import sqlite3
+import traceback
+import typing
+
+from . import CallTimeout
+from . import DeviceCalls
+from . import ListingCache
+from . import Stat
+from . import TokenBucket
+from . import Tracker
+from . import WriteOnceStatCollection
+
+
+class DBCountStat(Stat):
+    name = "dbs"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Account/container DBs on a device"
+
+
+class DBSizeHistogram(Stat):
+    name = "db_size_bytes_bucket"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Account/container DBs no larger than some number of bytes"
+
+
+class DBPendingBytesStat(Stat):
+    name = "db_pending_bytes"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Bytes of .pending updates waiting to be merged into DBs"
+
+
+class DBShardStateStat(Stat):
+    name = "db_shard_states"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Container DBs in each sharding state"
+
+
+class DBShardingEnabledStat(Stat):
+    name = "db_sharding_enabled"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Container DBs with sharding enabled in their metadata"
+
+
+class LargestContainerStat(Stat):
+    name = "largest_containers"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Object counts for the node's largest container DBs"
+
+
+class DBReadFailureStat(Stat):
+    name = "db_read_failures"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Times we failed to read a DB's stats"
+
+
+SIZE_BUCKETS = (  # bytes
+    2 ** 20,
+    10 * 2 ** 20,
+    100 * 2 ** 20,
+    2 ** 30,
+    10 * 2 ** 30,
+    float('inf'),
+)
+
+
+class DBInfo(typing.NamedTuple):
+    account: str
+    container: str
+    object_count: int
+    bytes_used: int
+    sharding_enabled: bool
+
+
+def read_db_info(path: str, db_type: str, timeout: float) -> DBInfo:
+    """
+    Pull the stats we care about out of an account or container DB.
+
+    The DB is opened read-only, so we never create journals, run migrations,
+    or otherwise get in the way of the servers that own it.
+    """
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=timeout)
+    try:
+        if db_type == 'containers':
+            row = conn.execute(
+                'SELECT account, container, object_count, bytes_used, '
+                'metadata FROM container_stat').fetchone()
+        else:
+            row = conn.execute(
+                "SELECT account, '', object_count, bytes_used, "
+                "metadata FROM account_stat").fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        raise sqlite3.DatabaseError(f'{path} has no stats row')
+    account, container, object_count, bytes_used, metadata = row
+    try:
+        sharding = json.loads(metadata or '{}').get(
+            'X-Container-Sysmeta-Sharding', [''])[0]
+    except (ValueError, AttributeError, IndexError, TypeError):
+        sharding = ''
+    return DBInfo(
+        account,
+        container,
+        object_count or 0,
+        bytes_used or 0,
+        str(sharding).lower() in ('1', 'on', 't', 'true', 'y', 'yes'),
+    )
+
+
+class PartitionWalk(typing.NamedTuple):
+    # path -> (mtime_ns, names) for the partition and suffix dirs
+    listings: typing.Dict[str, typing.Tuple[int, typing.List[str]]]
+    # (hash, path, name -> (mtime_ns, size)) for each hash dir
+    hash_dirs: typing.List[typing.Tuple[
+        str, str, typing.Dict[str, typing.Tuple[int, int]]]]
+    ops: int
+
+
+def walk_partition(
+    part_path: str,
+    known: typing.Dict[str, typing.Tuple[int, typing.Any]],
+) -> PartitionWalk:
+    """
+    Stat every file in a partition's hash dirs, in one trip to the thread
+    pool. Partition and suffix dirs are only listed if their mtimes changed
+    from what's ``known``; anything that vanishes out from under us is left
+    out.
+    """
+    listings: typing.Dict[str, typing.Tuple[int, typing.List[str]]] = {}
+    hash_dirs = []
+    ops = 0
+
+    def listing(path: str) -> typing.List[str]:
+        nonlocal ops
+        ops += 1
+        mtime = os.stat(path).st_mtime_ns
+        cached = known.get(path)
+        if cached is None or cached[0] != mtime:
+            ops += 1
+            cached = (mtime, os.listdir(path))
+        listings[path] = cached
+        return cached[1]
+
+    for suffix in listing(part_path):
+        suffix_path = os.path.join(part_path, suffix)
+        try:
+            hashes = listing(suffix_path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for hash_ in hashes:
+            hash_path = os.path.join(suffix_path, hash_)
+            files = {}
+            try:
+                with os.scandir(hash_path) as it:
+                    for entry in it:
+                        ops += 1
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        files[entry.name] = (st.st_mtime_ns, st.st_size)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            ops += 1
+            hash_dirs.append((hash_, hash_path, files))
+    return PartitionWalk(listings, hash_dirs, ops)
+
+
+def shard_state(hash_: str, names: typing.Iterable[str]) -> str:
+    """
+    Figure out where a container is in the sharding process from what's in
+    its hash dir, the same way swift does: ``<hash>.db`` is the original DB,
+    ``<hash>_<epoch>.db`` the one shard ranges get cleaved into.
+    """
+    retiring = fresh = False
+    for name in names:
+        if name == f'{hash_}.db':
+            retiring = True
+        elif name.startswith(f'{hash_}_') and name.endswith('.db'):
+            fresh = True
+    if retiring and fresh:
+        return 'sharding'
+    if fresh:
+        return 'sharded'
+    return 'unsharded'
+
+
+class SwiftDBTracker(Tracker):
+    """
+    Inventory the account and container DBs on each device.
+
+    Every DB and .pending file gets stat'ed each pass (so we notice them
+    changing), but a DB only gets opened if its mtime or size changed since
+    we last read it. All of it is paced by ``scan_ops_per_second``.
+    """
+    interval = 300  # seconds
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        self.devices_path = pathlib.Path(conf.get('devices', '/srv/node'))
+        self.syscall_timeout = float(conf.get('syscall_timeout', '60'))
+        self.db_timeout = float(conf.get('db_timeout', '1'))
+        self.top_containers = int(conf.get('top_containers', '10'))
+        self.io_budget = TokenBucket(
+            float(conf.get('scan_ops_per_second', '0')))
+        self.calls = DeviceCalls(
+            self.devices_path, self.syscall_timeout, self.interval,
+            float(conf.get('max_scan_backoff', '3600')))
+        self.listings = ListingCache(self.io_budget, self.calls)
+        # db path -> (mtime_ns, size, info)
+        self.db_info: typing.Dict[str, typing.Tuple[int, int, DBInfo]] = {}
+        self.seen_dbs: typing.Dict[str, typing.Tuple[int, int, DBInfo]] = {}
+        self.read_failures = 0
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        stats = WriteOnceStatCollection()
+        largest: typing.List[typing.Tuple[int, str, DBInfo]] = []
+        for disk in sorted(self.devices_path.iterdir()):
+            for db_type in ('accounts', 'containers'):
+                try:
+                    stats.merge(self.db_type_stats(disk, db_type, largest))
+                except (OSError, CallTimeout):
+                    # failed disk? keep what we knew about it for next time
+                    traceback.print_exc()
+                    self.listings.keep(disk / db_type)
+                    prefix = f'{disk / db_type}{os.sep}'
+                    self.seen_dbs.update(
+                        (k, v) for k, v in self.db_info.items()
+                        if k.startswith(prefix))
+        self.listings.finish_pass()
+        self.db_info, self.seen_dbs = self.seen_dbs, {}
+
+        now = Stat.now()
+        stats.merge(
+            LargestContainerStat(info.object_count, now, (
+                ("device", device),
+                ("account", info.account),
+                ("container", info.container),
+            ))
+            for _, device, info in heapq.nlargest(
+                self.top_containers, largest, key=lambda x: x[0])
+        )
+        stats.update(DBReadFailureStat(self.read_failures, now))
+        return stats
+
+    def db_type_stats(
+        self,
+        disk: pathlib.Path,
+        db_type: str,
+        largest: typing.List[typing.Tuple[int, str, DBInfo]],
+    ) -> WriteOnceStatCollection:
+        path = disk / db_type
+        try:
+            parts = self.listings.get(path)
+        except (FileNotFoundError, NotADirectoryError):
+            # not an account/container disk
+            return WriteOnceStatCollection()
+        count = pending = sharding_enabled = 0
+        sizes = [0] * len(SIZE_BUCKETS)
+        states = {'unsharded': 0, 'sharding': 0, 'sharded': 0}
+        for part in parts:
+            try:
+                walk = self.calls.call(
+                    walk_partition, str(path / part), self.listings.listings)
+            except (FileNotFoundError, NotADirectoryError):
+                # rebalanced away out from under us, or some tempfile
+                continue
+            self.listings.remember(walk.listings)
+            self.io_budget.consume(walk.ops)
+            for hash_, hash_path, files in walk.hash_dirs:
+                dbs = [name for name in files if name.endswith('.db')]
+                if not dbs:
+                    # mid-replication, or just a tempfile left behind
+                    continue
+                count += 1
+                states[shard_state(hash_, files)] += 1
+                pending += sum(
+                    size for name, (_, size) in files.items()
+                    if name.endswith('.db.pending'))
+                size = sum(files[name][1] for name in dbs)
+                for i, threshold in enumerate(SIZE_BUCKETS):
+                    if size <= threshold:
+                        sizes[i] += 1
+
+                # the newest DB is the one taking updates
+                info = self.read_info(
+                    os.path.join(hash_path, max(dbs)), files[max(dbs)],
+                    db_type)
+                if info is None:
+                    continue
+                if info.sharding_enabled:
+                    sharding_enabled += 1
+                if db_type == 'containers':
+                    largest.append((info.object_count, disk.name, info))
+                    if len(largest) > 2 * self.top_containers:
+                        largest[:] = heapq.nlargest(
+                            self.top_containers, largest,
+                            key=lambda x: x[0])
+
+        labels = (
+            ("device", disk.name),
+            ("type", db_type),
+        )
+        now = Stat.now()
+        stats = WriteOnceStatCollection((
+            DBCountStat(count, now, labels),
+            DBPendingBytesStat(pending, now, labels),
+        ))
+        stats.merge(
+            DBSizeHistogram(n, now, labels + (
+                ("le", "+Inf" if threshold == float('inf')
+                 else str(threshold)),
+            )) for threshold, n in zip(SIZE_BUCKETS, sizes)
+        )
+        if db_type == 'containers':
+            stats.merge(
+                DBShardStateStat(n, now, labels + (("state", state),))
+                for state, n in states.items()
+            )
+            stats.update(DBShardingEnabledStat(sharding_enabled, now, labels))
+        return stats
+
+    def read_info(
+        self,
+        path: str,
+        mtime_size: typing.Tuple[int, int],
+        db_type: str,
+    ) -> typing.Optional[DBInfo]:
+        cached = self.db_info.get(path)
+        if cached is not None and cached[:2] == mtime_size:
+            self.seen_dbs[path] = cached
+            return cached[2]
+        self.io_budget.consume()
+        try:
+            info = self.calls.call(
+                read_db_info, path, db_type, self.db_timeout)
+        except sqlite3.Error:
+            # locked, corrupt, or replaced mid-read; try again next pass,
+            # but keep reporting what we knew
+            self.read_failures += 1
+            if cached is None:
+                return None
+            self.seen_dbs[path] = cached
+            return cached[2]
+        self.seen_dbs[path] = mtime_size + (info,)
+        return info
+
+
+if __name__ == "__main__":
+    SwiftDBTracker.main()
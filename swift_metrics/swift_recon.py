@@ -0,0 +1,309 @@
+import heapq
+import json
+import os
+import traceback
+import typing
+
+from . import Stat
+from . import Tracker
+from . import WriteOnceStatCollection
+
+
+class ObjectReplicationStat(Stat):
+    name = "object_replication"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "attempted/success/failure/etc stats"
+
+
+class ReconStat(Stat):
+    name = "recon"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Numbers from swift's recon caches"
+
+
+class ReconFailureNodesStat(Stat):
+    name = "recon_failure_nodes"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Replication failures for the most-failing peer devices"
+
+
+class ReconLastModifiedStat(Stat):
+    name = "recon_last_modified"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "When a recon cache was last written"
+
+
+RECON_FILES = ('account', 'container', 'object', 'drive', 'relinker')
+
+# (substring of a top-level key, section it belongs to); first match wins
+SECTIONS = (
+    ('reconstruct', 'reconstructor'),
+    ('replicat', 'replicator'),
+    ('audit', 'auditor'),
+    ('updater', 'updater'),
+    ('async_pending', 'updater'),
+    ('expir', 'expirer'),
+    ('sharding', 'sharder'),
+    ('relink', 'relinker'),
+)
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+# (stat class, value, labels, timestamp or None for "whenever we report it")
+Derived = typing.Tuple[typing.Type[Stat], float, Labels, typing.Optional[int]]
+# (labels, peer ip, peer device, failures)
+FailureNodes = typing.List[typing.Tuple[Labels, str, str, int]]
+
+
+def section_for(key: str) -> str:
+    for fragment, section in SECTIONS:
+        if fragment in key:
+            return section
+    return 'other'
+
+
+def flatten(
+    data: typing.Any,
+    prefix: str,
+) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """
+    Yield ``(dotted.path, value)`` for every leaf under ``data``. Lists (like
+    the sharder's candidate lists) are skipped.
+    """
+    if isinstance(data, dict):
+        for k, v in data.items():
+            yield from flatten(v, f'{prefix}.{k}' if prefix else str(k))
+    elif not isinstance(data, list):
+        yield prefix, data
+
+
+def is_number(value: typing.Any) -> bool:
+    # bools are ints, but recon's flags aren't quantities
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def derive_section(
+    server: str,
+    key: str,
+    value: typing.Any,
+    labels: Labels,
+    derived: typing.List[Derived],
+    failure_nodes: FailureNodes,
+    prefix: typing.Optional[str] = None,
+) -> None:
+    """
+    Derive stats from the ``value`` stored under top-level ``key``. Labels
+    are the dotted path to each number, starting from ``prefix`` (which
+    defaults to ``key``).
+    """
+    if prefix is None:
+        prefix = key
+    labels = (("server", server), ("section", section_for(key))) + labels
+    for path, v in flatten(value, prefix):
+        if 'failure_nodes.' in path:
+            continue
+        if is_number(v):
+            derived.append((ReconStat, v, labels + (("label", path),), None))
+    for nodes in find_dicts(value, 'failure_nodes'):
+        for peer, devs in nodes.items():
+            if not isinstance(devs, dict):
+                continue
+            for peer_device, count in devs.items():
+                if is_number(count):
+                    failure_nodes.append((labels, peer, peer_device, count))
+
+
+def find_dicts(data: typing.Any, name: str) -> typing.Iterator[dict]:
+    """
+    Yield every dict called ``name`` under ``data``.
+    """
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == name and isinstance(v, dict):
+                yield v
+            else:
+                yield from find_dicts(v, name)
+
+
+def derive_stats(
+    server: str,
+    data: typing.Dict[str, typing.Any],
+) -> typing.Tuple[typing.List[Derived], FailureNodes]:
+    """
+    Turn one recon cache into stats. Per-device sections (``*_per_disk``,
+    ``*_per_device``, and auditor stats when there are auditor workers) get
+    a ``device`` label rather than the device showing up in ``label``.
+    """
+    derived: typing.List[Derived] = []
+    failure_nodes: FailureNodes = []
+
+    if server == 'drive':
+        for key, value in data.items():
+            if not is_number(value):
+                continue
+            if key == 'drive_audit_errors':
+                labels: Labels = (("label", key),)
+            else:
+                labels = (("mount_point", key), ("label", "errors"))
+            derived.append((ReconStat, value, (
+                ("server", server), ("section", "drive_audit"),
+            ) + labels, None))
+        return derived, failure_nodes
+
+    if server == 'relinker':
+        for device, dev_data in (data.get('devices') or {}).items():
+            policies = dev_data.pop('policies', {}) or {}
+            derive_section(server, 'relinker', dev_data, (
+                ("device", device),
+            ), derived, failure_nodes, '')
+            for policy, pol_data in policies.items():
+                derive_section(server, 'relinker', pol_data, (
+                    ("device", device),
+                    ("policy", str(policy)),
+                ), derived, failure_nodes, '')
+        workers = data.get('workers') or {}
+        derived.append((ReconStat, len(workers), (
+            ("server", server), ("section", "relinker"),
+            ("label", "workers"),
+        ), None))
+        derived.append((ReconStat, sum(
+            1 for w in workers.values()
+            if isinstance(w, dict) and w.get('return_code') not in (None, 0)
+        ), (
+            ("server", server), ("section", "relinker"),
+            ("label", "workers.failed"),
+        ), None))
+        return derived, failure_nodes
+
+    for key, value in data.items():
+        if key.endswith(('_per_disk', '_per_device')):
+            prefix = ''
+        elif (key.startswith('object_auditor_stats_')
+              and isinstance(value, dict)
+              and any(isinstance(v, dict) for v in value.values())):
+            prefix = key
+        else:
+            derive_section(server, key, value, (), derived, failure_nodes)
+            continue
+        for device, dev_data in (value or {}).items():
+            derive_section(server, key, dev_data, (
+                ("device", device),
+            ), derived, failure_nodes, prefix)
+
+    # Kept as-is so existing dashboards don't break
+    for device, dev_data in (
+            data.get('object_replication_per_disk') or {}).items():
+        if 'object_replication_last' not in dev_data:
+            continue  # cleared out for a device that's gone away
+        ts = int(dev_data['object_replication_last'] * 1000)  # ms
+        derived.extend(
+            (ObjectReplicationStat, v, (
+                ("device", device),
+                ("label", k),
+            ), ts)
+            for k, v in dev_data.get('replication_stats', {}).items()
+            if k != 'failure_nodes'
+        )
+    return derived, failure_nodes
+
+
+class SwiftReconTracker(Tracker):
+    """
+    Export what swift's daemons write to their recon caches: replicator,
+    updater, auditor, sharder, expirer and reconstructor stats, drive-audit
+    errors and relinker progress.
+
+    A cache only gets re-parsed when its inode, mtime or size changes;
+    otherwise we report what we derived from it last time.
+    """
+
+    def configure(self, conf: typing.Dict[str, str]) -> None:
+        self.recon_cache_path = conf.get(
+            'recon_cache_path', '/var/cache/swift')
+        self.failure_nodes_top = int(conf.get('failure_nodes_top', '10'))
+        # server -> ((st_ino, st_mtime_ns, st_size), derived, failure nodes)
+        self.cache: typing.Dict[str, typing.Tuple[
+            typing.Tuple[int, int, int],
+            typing.List[Derived],
+            FailureNodes,
+        ]] = {}
+
+    def load(self, server: str) -> typing.Optional[os.stat_result]:
+        path = os.path.join(self.recon_cache_path, f'{server}.recon')
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.cache.pop(server, None)
+            return None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self.cache.get(server)
+        if cached is not None and cached[0] == key:
+            return st
+        try:
+            with open(path, 'r') as fp:
+                data = json.load(fp)
+            derived, failure_nodes = derive_stats(server, data)
+        except (IOError, ValueError):
+            # mid-rewrite? bad recon data? keep whatever we had
+            return st if cached is not None else None
+        except Exception:
+            traceback.print_exc()
+            return st if cached is not None else None
+        self.cache[server] = (key, derived, failure_nodes)
+        return st
+
+    def get_stats(self) -> WriteOnceStatCollection:
+        stats = WriteOnceStatCollection()
+        for server in RECON_FILES:
+            st = self.load(server)
+            if st is None:
+                continue
+            now = Stat.now()
+            stats.update(ReconLastModifiedStat(
+                st.st_mtime, now, (("server", server),)))
+            _, derived, failure_nodes = self.cache[server]
+            stats.merge(
+                cls(value, now if ts is None else ts, labels)
+                for cls, value, labels, ts in derived
+            )
+            stats.merge(self.failure_node_stats(failure_nodes, now))
+        if not stats:
+            self.ever_reported.set()
+        return stats
+
+    def failure_node_stats(
+        self,
+        failure_nodes: FailureNodes,
+        now: int,
+    ) -> WriteOnceStatCollection:
+        """
+        Report the ``failure_nodes_top`` peer devices with the most failures
+        per section, lumping the rest into ``peer="__other__"``.
+        """
+        by_labels: typing.Dict[Labels, typing.Dict[
+            typing.Tuple[str, str], int]] = {}
+        for labels, peer, peer_device, count in failure_nodes:
+            counts = by_labels.setdefault(labels, {})
+            counts[peer, peer_device] = (
+                counts.get((peer, peer_device), 0) + count)
+
+        stats = WriteOnceStatCollection()
+        for labels, counts in by_labels.items():
+            top = heapq.nlargest(
+                self.failure_nodes_top, counts.items(), key=lambda x: x[1])
+            stats.merge(
+                ReconFailureNodesStat(count, now, labels + (
+                    ("peer", peer),
+                    ("peer_device", peer_device),
+                )) for (peer, peer_device), count in top
+            )
+            other = sum(counts.values()) - sum(c for _, c in top)
+            if other:
+                stats.update(ReconFailureNodesStat(other, now, labels + (
+                    ("peer", "__other__"),
+                    ("peer_device", "__other__"),
+                )))
+        return stats
+
+
+if __name__ == "__main__":
+    SwiftReconTracker.main()
@@ -1,9 +1,14 @@
-import fcntl
-import glob
+import collections
+import functools
+import math
 import os
 import pathlib
 import pickle
 import queue
+import random
+import threading
+import time
+import traceback
 import typing
 
 import swift.common.exceptions
@@ -11,10 +16,21 @@ import swift.common.ring  # type: ignore
 import swift.common.utils  # type: ignore
 import swift.obj.diskfile  # type: ignore
 
+from . import CallTimeout
+from . import DeviceCalls
+from . import PORTS
 from . import Stat
 from . import StatCollection
+from . import TokenBucket
 from . import Tracker
 from . import WriteOnceStatCollection
+from .hash_workers import HashWorkerPool
+from .hash_workers import io_priority
+from .hash_workers import set_io_priority
+from .setup_port_counters import ring_port_map
+
+
+T = typing.TypeVar('T')
 
 
 class PartitionCountStat(Stat):
@@ -35,8 +51,148 @@ class HashdirCountStat(Stat):
     help = "Primary/handoff hashdir count"
 
 
-class ColsolidateFailure(RuntimeError):
-    pass
+class HashWorkerFailureStat(Stat):
+    name = "hash_worker_failures"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Hash consolidation requests that failed, by reason"
+
+
+class HashFallbackStat(Stat):
+    name = "hash_fallbacks"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Partitions whose hashes were read rather than consolidated"
+
+
+class PartitionsScannedStat(Stat):
+    name = "partitions_scanned"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Partitions scanned over the lifetime of the exporter"
+
+
+class ScanDurationStat(Stat):
+    name = "device_scan_duration"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Time spent scanning a device, not counting time queued (seconds)"
+
+
+class DeviceScanHealthStat(Stat):
+    name = "device_scan_health"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Whether the last scan of a device finished in time (1) or not (0)"
+
+
+class DeviceScanTimeoutStat(Stat):
+    name = "device_scan_timeouts"
+    type: typing.ClassVar[typing.Literal["counter"]] = "counter"
+    help = "Scans of a device abandoned for running past their deadline"
+
+
+class DeviceLastScanStat(Stat):
+    name = "device_last_successful_scan"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "When the last successful scan of a device finished (unix time)"
+
+
+class SampleRelativeErrorStat(Stat):
+    name = "scan_sample_relative_error"
+    type: typing.ClassVar[typing.Literal["gauge"]] = "gauge"
+    help = "Relative error (95% confidence) of sampled suffix/hashdir counts"
+
+
+# Don't bother sampling strata that would give fewer partitions than this
+MIN_SAMPLE_SIZE = 30
+
+
+def estimate_total(
+    values: typing.List[int],
+    population: int,
+) -> typing.Tuple[float, float]:
+    """
+    Estimate a population total from a simple random sample of it.
+
+    :returns: the estimate and its relative error at 95% confidence
+    """
+    n = len(values)
+    if not n:
+        return 0.0, 1.0 if population else 0.0
+    mean = sum(values) / n
+    total = population * mean
+    if n >= population or not total:
+        return total, 0.0
+    if n < 2:
+        return total, 1.0
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+    stderr = population * math.sqrt((1 - n / population) * variance / n)
+    return total, 1.96 * stderr / total
+
+
+def mtimes(*paths: pathlib.Path) -> typing.Tuple[int, ...]:
+    result = []
+    for path in paths:
+        try:
+            result.append(path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            result.append(0)
+    return tuple(result)
+
+
+def count_suffixes(
+    part: pathlib.Path,
+    hashes: dict,
+    track_hashdirs: bool,
+) -> typing.Tuple[typing.Tuple[int, int, int], int]:
+    """
+    :returns: (valid suffixes, invalid suffixes, hashdirs), and how many
+              listdirs/stats that took
+    """
+    valid = invalid = hashdirs = ops = 0
+    if hashes['valid']:
+        for h in hashes:
+            if not swift.obj.diskfile.valid_suffix(h):
+                continue
+            if hashes[h] is None:
+                invalid += 1
+            else:
+                valid += 1
+            if track_hashdirs:
+                ops += 1
+                hashdirs += (part / h).stat().st_nlink - 2
+    else:
+        ops += 1
+        for suf in part.iterdir():
+            if not swift.obj.diskfile.valid_suffix(suf.name):
+                continue
+            invalid += 1
+            if track_hashdirs:
+                ops += 1
+                hashdirs += suf.stat().st_nlink - 2
+    return (valid, invalid, hashdirs), ops
+
+
+class PrimaryPartitionIndex:
+    """
+    Bitmap of the partitions a device holds a primary assignment for.
+
+    Built once from the ring's replica-to-partition table so that classifying
+    a partition directory is a bit test rather than a ``get_part_nodes`` call.
+    """
+
+    def __init__(self, ring: swift.common.ring.Ring,
+                 dev_id: typing.Optional[int]) -> None:
+        self.mtime = ring._mtime
+        self.bits = bytearray((ring.partition_count + 7) // 8)
+        if dev_id is None:
+            # dev not in ring; always handoff
+            return
+        for part2dev_id in ring._replica2part2dev_id:
+            for part, part_dev_id in enumerate(part2dev_id):
+                if part_dev_id == dev_id:
+                    self.bits[part >> 3] |= 1 << (part & 7)
+
+    def __contains__(self, part: int) -> bool:
+        byte = part >> 3
+        return byte < len(self.bits) and bool(
+            self.bits[byte] & (1 << (part & 7)))
 
 
 class SwiftRingAssignmentTracker(Tracker):
@@ -44,21 +200,58 @@ class SwiftRingAssignmentTracker(Tracker):
         swift.common.utils.DEFAULT_LOCK_TIMEOUT = float(
             conf.get('lock_timeout', '60'))
         self.devices_path = pathlib.Path(conf.get('devices', '/srv/node'))
-        self.rings = {
-            os.path.basename(r).split('.')[0]: swift.common.ring.Ring(r)
-            for r in glob.glob('/etc/swift/*.ring.gz')}
-        # TODO: support ring_ip config opt
-        self.my_ips = set(swift.common.utils.whataremyips())
+        self.swift_dir = pathlib.Path(conf.get('swift_dir', '/etc/swift'))
+        if (self.swift_dir / 'swift.conf').exists():
+            # so rings get the hash path prefix/suffix from the same place
+            swift.common.utils.set_swift_dir(str(self.swift_dir))
+        self.swift_user = conf.get('user', 'swift')
+        self.hash_workers = int(conf.get('hash_workers', '1'))
+        self.hash_timeout = float(conf.get('hash_timeout', '120'))
+        # Only rescan partitions whose dir/hashes file mtimes changed,
+        # with a full rescan every so often just in case
+        self.incremental_scan = swift.common.utils.config_true_value(
+            conf.get('incremental_scan', 'false'))
+        self.full_scan_interval = float(
+            conf.get('full_scan_interval', '86400'))
+        self.cache_dir = pathlib.Path(
+            conf.get('cache_dir', '/var/cache/swift_metrics'))
+        # Give up on a device whose scan takes longer than this (or that
+        # gets stuck in a single syscall this long), and leave it alone for
+        # a while -- longer each time it happens again
+        self.scan_deadline = float(conf.get('scan_deadline', '3600'))
+        self.calls = DeviceCalls(
+            self.devices_path,
+            float(conf.get('syscall_timeout', '60')),
+            SwiftDiskRingAssignmentTracker.interval,
+            float(conf.get('max_scan_backoff', '3600')),
+        )
+        # Only scan 1/N of the partitions each pass and extrapolate
+        self.sample_passes = int(conf.get('sample_passes', '1'))
+        # only this many disks get walked at once...
+        self.scan_slots = threading.BoundedSemaphore(
+            int(conf.get('scan_concurrency', '4')))
+        # ... each doing no more than this many listdirs/stats per second
+        self.scan_ops_per_second = float(
+            conf.get('scan_ops_per_second', '0'))
+        # Scans get out of the way of client traffic, the replicator and
+        # rsync. Only they do their I/O in this class -- the native threads
+        # making their calls, while they do, and the hash workers -- so the
+        # other trackers' I/O can't be starved along with them.
+        self.io_priority = io_priority(
+            conf.get('ionice_class', 'IOPRIO_CLASS_IDLE'),
+            conf.get('ionice_priority', '0'))
+        self.rings: typing.Dict[str, swift.common.ring.Ring] = {}
+        # ring name -> (inode, mtime) of the file it was loaded from
+        self.ring_files: typing.Dict[str, typing.Tuple[int, int]] = {}
+        self.primary_indexes: typing.Dict[
+            typing.Tuple[str, str], PrimaryPartitionIndex] = {}
+        # like the servers' ring_ip/bind_ip; by default, every local address
+        self.my_ips = set(swift.common.utils.whataremyips(
+            conf.get('ring_ip')))
+        self.reload_rings()
         self.worker_queue: queue.Queue[Stat] = queue.Queue()
-        self.workers = [
-            SwiftDiskRingAssignmentTracker(self.worker_queue, {
-                # slight abuse: conf dicts are usually str -> str mappings,
-                # but this was handy
-                'disk': disk,
-                'manager': self,
-                'user': conf.get('user', 'swift'),
-            }) for disk in self.devices_path.iterdir()
-        ]
+        self.workers: typing.List[SwiftDiskRingAssignmentTracker] = []
+        self.update_workers()
         self.stats = StatCollection()
         self.track_hashdirs = swift.common.utils.config_true_value(
             conf.get('track_hashdirs', 'false'))
@@ -70,43 +263,127 @@ class SwiftRingAssignmentTracker(Tracker):
             t.start()
         super().start()
 
+    def reload_rings(self) -> None:
+        """
+        Load any ring files that appeared or were replaced since we last
+        looked, then swap the whole set of rings in at once.
+
+        Rings are loaded with an infinite ``reload_time`` so they never
+        reload themselves out from under a disk scan; we're the only ones
+        that replace them.
+        """
+        rings = {}
+        ring_files = {}
+        for path in sorted(self.swift_dir.glob('*.ring.gz')):
+            name = path.name.split('.')[0]
+            try:
+                st = path.stat()
+                ring_files[name] = (st.st_ino, st.st_mtime_ns)
+                if self.ring_files.get(name) == ring_files[name]:
+                    rings[name] = self.rings[name]
+                else:
+                    rings[name] = swift.common.ring.Ring(
+                        str(path), reload_time=float('inf'))
+            except Exception:
+                # half-written ring? keep what we had and try again later
+                traceback.print_exc()
+                ring_files.pop(name, None)
+                if name in self.rings:
+                    rings[name] = self.rings[name]
+                    ring_files[name] = self.ring_files[name]
+
+        changed = {name for name in set(self.rings) | set(rings)
+                   if self.rings.get(name) is not rings.get(name)}
+        self.rings, self.ring_files = rings, ring_files
+        for key in list(self.primary_indexes):
+            if key[0] in changed:
+                del self.primary_indexes[key]
+        if changed:
+            # so other trackers classify ports by what the rings say
+            PORTS.update(ring_port_map(self.rings, self.my_ips))
+
+    def update_workers(self) -> None:
+        """
+        Start tracking any devices that showed up since we last looked, and
+        stop tracking any that went away.
+        """
+        # d_type from the listing; no stat()s of possibly-hung mount points
+        disks = {entry.name for entry in os.scandir(self.devices_path)
+                 if entry.is_dir(follow_symlinks=False)}
+        for t in self.workers:
+            if t.disk.name not in disks:
+                t.stop()
+        self.workers = [t for t in self.workers if t.disk.name in disks]
+        known = {t.disk.name for t in self.workers}
+        for name in sorted(disks - known):
+            disk = self.devices_path / name
+            worker = SwiftDiskRingAssignmentTracker(self.worker_queue, {
+                # slight abuse: conf dicts are usually str -> str mappings,
+                # but this was handy
+                'disk': disk,
+                'manager': self,
+                'user': self.swift_user,
+            })
+            self.workers.append(worker)
+            if self.is_alive():
+                worker.start()
+
     def get_stats(self) -> WriteOnceStatCollection:
+        self.reload_rings()
+        self.update_workers()
+
+        # give first passes a chance to report, but don't let a disk that's
+        # stuck (or a worker that died) hold every other disk up for good
+        deadline = time.time() + self.interval
         for t in self.workers:
-            t.ever_reported.wait()
+            t.ever_reported.wait(max(deadline - time.time(), 0))
 
         while True:
             try:
                 self.stats.update(self.worker_queue.get_nowait())
             except queue.Empty:
                 break
+        # forget devices that went away, including anything their workers
+        # reported on the way out; every worker stat has a device label
+        disks = {t.disk.name for t in self.workers}
+        self.stats = StatCollection(
+            stat for stat in self.stats
+            if dict(stat.labels).get('device') in disks)
 
         return WriteOnceStatCollection(self.stats)
 
-def consolidate_hashes(swift_user, part_path):
-    r, w = os.pipe()
-    child_pid = os.fork()
-    if child_pid:
-        os.close(w)
-        # You can't create a pipe in non-blocking mode; you must set it
-        # later.
-        rflags = fcntl.fcntl(r, fcntl.F_GETFL)
-        fcntl.fcntl(r, fcntl.F_SETFL, rflags | os.O_NONBLOCK)
-        try:
-            return pickle.loads(os.read(r, 2 ** 20))
-        except Exception:
-            raise ColsolidateFailure
-        finally:
-            os.waitid(os.P_PID, child_pid, os.WEXITED)
-            os.close(r)
-    else:
-        try:
-            os.close(r)
-            swift.common.utils.drop_privileges(swift_user)
-            hashes = swift.obj.diskfile.consolidate_hashes(part_path)
-            os.write(w, pickle.dumps(hashes))
-        finally:
-            os.close(w)
-            os._exit(0)
+    def collect(self) -> WriteOnceStatCollection:
+        """
+        Scan every disk inline, one after another, rather than waiting on
+        the per-disk threads.
+        """
+        self.reload_rings()
+        self.update_workers()
+        stats = WriteOnceStatCollection()
+        for t in self.workers:
+            stats.merge(t.collect())
+        return stats
+
+    def primary_index(self, ring_name: str,
+                      device: str) -> PrimaryPartitionIndex:
+        """
+        Get the primary partitions for a local device, rebuilding the index
+        only if the ring changed since it was last built.
+
+        :raises KeyError: if there is no ring named ``ring_name``
+        """
+        ring = self.rings[ring_name]
+        index = self.primary_indexes.get((ring_name, device))
+        if index is None or index.mtime != ring._mtime:
+            dev_id = next((
+                dev['id'] for dev in ring.devs
+                if dev and dev['device'] == device
+                and (self.my_ips & {dev['ip'], dev['replication_ip']})
+            ), None)
+            index = PrimaryPartitionIndex(ring, dev_id)
+            self.primary_indexes[ring_name, device] = index
+        return index
+
 
 class SwiftDiskRingAssignmentTracker(Tracker):
     interval = 60  # seconds
@@ -114,16 +391,119 @@ class SwiftDiskRingAssignmentTracker(Tracker):
     def configure(self, conf: typing.Dict[str, typing.Any]) -> None:
         self.disk = conf['disk']
         self.manager = conf['manager']
-        self.swift_user = conf['user']
+        self.hash_pool = HashWorkerPool(
+            conf['user'], self.manager.hash_workers,
+            self.manager.hash_timeout, self.read_hashes,
+            self.manager.io_priority)
+        self.io_budget = TokenBucket(self.manager.scan_ops_per_second)
+        self.partitions_scanned: typing.Counter[str] = collections.Counter()
+        self.part_cache: typing.Dict[str, typing.Dict[str, typing.Tuple[
+            typing.Tuple[int, ...], typing.Tuple[int, int, int]]]] = {}
+        # policy name -> (mtime, partition names)
+        self.policy_cache: typing.Dict[
+            str, typing.Tuple[int, typing.List[str]]] = {}
+        self.last_full_scan = 0.0
+        self.sample_pass = 0
+        self.sample_salt = random.getrandbits(32)
+        self.cache_path = self.manager.cache_dir / (
+            f'partitions.{self.disk.name}.pkl')
+        if self.manager.incremental_scan:
+            self.load_cache()
+        self.deadline = 0.0
+        self.last_success: typing.Optional[float] = None
 
     def scrape_time_labels(self) -> typing.Tuple[typing.Tuple[str, str], ...]:
         return super().scrape_time_labels() + (
             ("device", self.disk.name),
         )
 
+    def run(self) -> None:
+        try:
+            super().run()
+        finally:
+            # retired; see SwiftRingAssignmentTracker.update_workers
+            self.hash_pool.close()
+
     def get_stats(self) -> WriteOnceStatCollection:
         stats = WriteOnceStatCollection()
-        for policy in self.disk.iterdir():
+        scan_duration = None
+        calls = self.manager.calls
+        device = self.disk.name
+        try:
+            calls.check(device)
+        except CallTimeout:
+            # still waiting on a hung syscall from some earlier pass, or
+            # backing off after one; don't pile more threads up behind it
+            healthy = False
+        else:
+            backoff = calls.backoff.get(device, 0)
+            timeouts = calls.timeouts[device]
+            with self.manager.scan_slots:
+                start = time.time()
+                self.deadline = start + self.manager.scan_deadline
+                try:
+                    stats = self.scan()
+                except (CallTimeout, OSError) as e:
+                    # hung, or failing (EIO), or gone: either way, no
+                    # numbers for it this time, and leave it be for a while
+                    traceback.print_exc()
+                    healthy = False
+                    if isinstance(e, CallTimeout) \
+                            and calls.timeouts[device] == timeouts:
+                        # out of time between calls rather than in one
+                        calls.timeouts[device] += 1
+                    # longer each time the scan fails, whatever calls
+                    # worked before it did
+                    calls.back_off(device, backoff)
+                else:
+                    healthy = True
+                    self.last_success = time.time()
+                scan_duration = time.time() - start
+
+        now = Stat.now()
+        stats.update(
+            DeviceScanHealthStat(int(healthy), now, (
+                ("device", self.disk.name),
+            )),
+            DeviceScanTimeoutStat(calls.timeouts[device], now, (
+                ("device", self.disk.name),
+            )),
+        )
+        if self.last_success is not None:
+            stats.update(DeviceLastScanStat(self.last_success, now, (
+                ("device", self.disk.name),
+            )))
+        if scan_duration is not None:
+            stats.update(ScanDurationStat(scan_duration, now, (
+                ("device", self.disk.name),
+            )))
+        stats.merge(
+            PartitionsScannedStat(count, now, (
+                ("device", self.disk.name),
+                ("policy", policy),
+            )) for policy, count in self.partitions_scanned.items()
+        )
+        stats.update(HashFallbackStat(self.hash_pool.fallbacks, now, (
+            ("device", self.disk.name),
+        )))
+        stats.merge(
+            HashWorkerFailureStat(self.hash_pool.failures[reason], now, (
+                ("device", self.disk.name),
+                ("reason", reason),
+            )) for reason in ('spawn', 'died', 'timeout', 'error')
+        )
+        return stats
+
+    def scan(self) -> WriteOnceStatCollection:
+        stats = WriteOnceStatCollection()
+        full_scan = (time.time() - self.last_full_scan
+                     >= self.manager.full_scan_interval)
+        # policy name -> part name -> (signature, counts)
+        part_cache: typing.Dict[str, typing.Dict[str, typing.Tuple[
+            typing.Tuple[int, ...], typing.Tuple[int, int, int]]]] = {}
+        self.io_budget.consume()
+        for name in self.blocking(os.listdir, self.disk):
+            policy = self.disk / name
             stat_dict = {
                 'partitions': {'primary': 0, 'handoff': 0},
                 'suffixes': {'primary': {'valid': 0, 'invalid': 0},
@@ -131,56 +511,70 @@ class SwiftDiskRingAssignmentTracker(Tracker):
                 'hashdirs': {'primary': 0, 'handoff': 0},
             }
             try:
-                ring = self.manager.rings[policy.name.replace('s', '')]
+                primaries = self.manager.primary_index(
+                    policy.name.replace('s', ''), self.disk.name)
             except KeyError:
                 # tmp or async_pending, most likely
                 continue
 
             try:
-                dev = next(
-                    dev for dev in ring.devs
-                    if dev and dev['device'] == self.disk.name
-                    and (self.manager.my_ips & {
-                        dev['ip'], dev['replication_ip']}))
-            except StopIteration:
-                # dev not in ring; always handoff
-                dev = None
+                parts = {}
+                for name in self.list_partitions(policy, full_scan):
+                    part = policy / name
+                    parts[part] = ('primary' if int(name) in primaries
+                                   else 'handoff')
+                    stat_dict['partitions'][parts[part]] += 1
 
-            try:
-                for part in policy.iterdir():
-                    try:
-                        p = int(part.name)
-                    except ValueError:
-                        continue
-                    ph = ('primary' if dev and dev['id'] in [
-                        d['id'] for d in ring.get_part_nodes(p)
-                    ] else 'handoff')
-                    stat_dict['partitions'][ph] += 1
-
-                    hashes = {'valid': False}
-                    if policy.name.startswith('object'):
-                        if self.ever_reported.is_set():
-                            try:
-                                hashes = consolidate_hashes(self.swift_user, part)
-                            except ColsolidateFailure:
-                                hashes = swift.obj.diskfile.read_hashes(part)
-                        else:
-                            hashes = swift.obj.diskfile.read_hashes(part)
-                    if hashes['valid']:
-                        for h in hashes:
-                            if not swift.obj.diskfile.valid_suffix(h):
-                                continue
-                            v = 'invalid' if hashes[h] is None else 'valid'
-                            stat_dict['suffixes'][ph][v] += 1
-                            if self.manager.track_hashdirs:
-                                stat_dict['hashdirs'][ph] += (part / h).stat().st_nlink - 2
+                # part -> signature; None if it can't be cached
+                to_scan: typing.Dict[
+                    pathlib.Path, typing.Optional[typing.Tuple[int, ...]]
+                ] = {}
+                cached = self.part_cache.get(policy.name, {})
+                policy_cache = {}
+                if self.manager.sample_passes > 1:
+                    sample = self.sample(parts)
+                else:
+                    sample = parts
+                samples: typing.Dict[
+                    str, typing.List[typing.Tuple[int, int, int]]
+                ] = {'primary': [], 'handoff': []}
+                for part in sample:
+                    signature = None
+                    if self.manager.incremental_scan:
+                        signature = self.signature(policy, part)
+                    entry = cached.get(part.name)
+                    if not full_scan and signature is not None \
+                            and entry and entry[0] == signature:
+                        self.add_counts(stat_dict, parts[part], entry[1])
+                        samples[parts[part]].append(entry[1])
+                        policy_cache[part.name] = entry
                     else:
-                        for suf in part.iterdir():
-                            if not swift.obj.diskfile.valid_suffix(suf.name):
-                                continue
-                            stat_dict['suffixes'][ph]['invalid'] += 1
-                            if self.manager.track_hashdirs:
-                                stat_dict['hashdirs'][ph] += suf.stat().st_nlink - 2
+                        to_scan[part] = signature
+                for part in parts:
+                    # not this pass's turn; keep what we knew about it
+                    if part not in sample and part.name in cached:
+                        policy_cache[part.name] = cached[part.name]
+
+                if not policy.name.startswith('object'):
+                    part_hashes = (
+                        (part, {'valid': False}) for part in to_scan)
+                elif self.ever_reported.is_set():
+                    part_hashes = self.hash_pool.consolidate(
+                        self.paced(to_scan), self.deadline)
+                else:
+                    part_hashes = (
+                        (part, self.read_hashes(part)) for part in to_scan)
+
+                for part, hashes in part_hashes:
+                    self.partitions_scanned[policy.name] += 1
+                    counts = self.count_suffixes(part, hashes)
+                    self.add_counts(stat_dict, parts[part], counts)
+                    samples[parts[part]].append(counts)
+                    if to_scan[part] is not None:
+                        policy_cache[part.name] = (to_scan[part], counts)
+                part_cache[policy.name] = policy_cache
+                if sample is not parts:
+                    errors = self.estimate(stat_dict, parts, samples)
 
                 now = Stat.now()
                 stats.update(
@@ -270,9 +664,33 @@ class SwiftDiskRingAssignmentTracker(Tracker):
                             )
                         ),
                     )
+
+                # A/C partitions never get their hashes read, so there's
+                # no error worth reporting
+                if sample is not parts and policy.name.startswith('object'):
+                    stats.merge(
+                        SampleRelativeErrorStat(error, now, (
+                            ("device", self.disk.name),
+                            ("policy", policy.name),
+                            ("type", ph),
+                            ("series", series),
+                        ) + ((("status", status),) if status else ()))
+                        for (ph, series, status), error in errors.items()
+                        if series != 'hashdirs'
+                        or self.manager.track_hashdirs
+                    )
             except OSError:
                 # failed disk? maybe at some point we should unmount it
-                pass
+                if policy.name in self.part_cache:
+                    part_cache[policy.name] = self.part_cache[policy.name]
+
+        self.sample_pass += 1
+        if self.manager.incremental_scan:
+            if full_scan:
+                self.last_full_scan = time.time()
+            if part_cache != self.part_cache:
+                self.part_cache = part_cache
+                self.save_cache()
 
         if not stats:
             # Normally, the super() code handles this -- but even if we don't
@@ -280,6 +698,183 @@ class SwiftDiskRingAssignmentTracker(Tracker):
             self.ever_reported.set()
         return stats
 
+    def list_partitions(self, policy: pathlib.Path,
+                        full_scan: bool) -> typing.List[str]:
+        self.io_budget.consume()
+        mtime = None
+        if self.manager.incremental_scan:
+            mtime = self.blocking(os.stat, policy).st_mtime_ns
+            cached = self.policy_cache.get(policy.name)
+            if not full_scan and cached and cached[0] == mtime:
+                return cached[1]
+
+        names = []
+        for name in self.blocking(os.listdir, policy):
+            try:
+                int(name)
+            except ValueError:
+                continue
+            names.append(name)
+        if mtime is not None:
+            self.policy_cache[policy.name] = (mtime, names)
+        return names
+
+    def sample(self, parts: typing.Dict[pathlib.Path, str],
+               ) -> typing.Dict[pathlib.Path, str]:
+        """
+        Pick this pass's share of each stratum (primary/handoff). Every
+        partition gets picked exactly once every sample_passes passes; strata
+        too small to give a useful sample are scanned in full.
+        """
+        passes = self.manager.sample_passes
+        slot = self.sample_pass % passes
+        sizes = collections.Counter(parts.values())
+        return {
+            part: ph for part, ph in parts.items()
+            if sizes[ph] < MIN_SAMPLE_SIZE * passes
+            or hash((self.sample_salt, part.name)) % passes == slot
+        }
+
+    @staticmethod
+    def estimate(
+        stat_dict: dict,
+        parts: typing.Dict[pathlib.Path, str],
+        samples: typing.Dict[str, typing.List[typing.Tuple[int, int, int]]],
+    ) -> typing.Dict[typing.Tuple[str, str, typing.Optional[str]], float]:
+        """
+        Replace the suffix and hashdir counts in ``stat_dict`` with estimates
+        extrapolated from the sampled partitions.
+
+        :returns: a dict mapping (type, series, status) to the relative error
+                  of that estimate
+        """
+        sizes = collections.Counter(parts.values())
+        errors = {}
+        for ph, counts in samples.items():
+            for i, (series, status) in enumerate((
+                ('suffixes', 'valid'),
+                ('suffixes', 'invalid'),
+                ('hashdirs', None),
+            )):
+                total, errors[ph, series, status] = estimate_total(
+                    [c[i] for c in counts], sizes[ph])
+                if status:
+                    stat_dict[series][ph][status] = round(total)
+                else:
+                    stat_dict[series][ph] = round(total)
+        return errors
+
+    def signature(
+        self,
+        policy: pathlib.Path,
+        part: pathlib.Path,
+    ) -> typing.Optional[typing.Tuple[int, ...]]:
+        """
+        Get the mtimes that change whenever anything we count in a partition
+        does: the partition dir gets new/removed suffixes, and object writes
+        and consolidation touch the hashes files. Suffix dirs' hashdir counts
+        can't be tracked that way for A/C policies, so those always get
+        rescanned when track_hashdirs is on.
+        """
+        if policy.name.startswith('object'):
+            paths = (
+                part,
+                part / swift.obj.diskfile.HASH_FILE,
+                part / swift.obj.diskfile.HASH_INVALIDATIONS_FILE,
+            )
+        elif self.manager.track_hashdirs:
+            return None
+        else:
+            paths = (part,)
+
+        self.io_budget.consume(len(paths))
+        return self.blocking(mtimes, *paths)
+
+    def count_suffixes(
+        self,
+        part: pathlib.Path,
+        hashes: dict,
+    ) -> typing.Tuple[int, int, int]:
+        """
+        :returns: (valid suffixes, invalid suffixes, hashdirs)
+        """
+        self.io_budget.consume()
+        counts, ops = self.blocking(
+            count_suffixes, part, hashes, self.manager.track_hashdirs)
+        # pay for the rest after the fact
+        self.io_budget.consume(ops - 1)
+        return counts
+
+    @staticmethod
+    def add_counts(stat_dict: dict, ph: str,
+                   counts: typing.Tuple[int, int, int]) -> None:
+        valid, invalid, hashdirs = counts
+        stat_dict['suffixes'][ph]['valid'] += valid
+        stat_dict['suffixes'][ph]['invalid'] += invalid
+        stat_dict['hashdirs'][ph] += hashdirs
+
+    def load_cache(self) -> None:
+        try:
+            with open(self.cache_path, 'rb') as fp:
+                cache = pickle.load(fp)
+            self.part_cache = cache['partitions']
+            self.policy_cache = cache['policies']
+            self.last_full_scan = cache['last_full_scan']
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # corrupt? start cold
+            traceback.print_exc()
+
+    def save_cache(self) -> None:
+        tmp_path = self.cache_path.with_suffix('.tmp')
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump({
+                    'partitions': self.part_cache,
+                    'policies': self.policy_cache,
+                    'last_full_scan': self.last_full_scan,
+                }, fp)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            traceback.print_exc()
+
+    def paced(self, items: typing.Iterable[T]) -> typing.Iterator[T]:
+        for item in items:
+            self.io_budget.consume()
+            yield item
+
+    def read_hashes(self, part: pathlib.Path) -> dict:
+        self.io_budget.consume()
+        return self.blocking(swift.obj.diskfile.read_hashes, part)
+
+    def blocking(self, func: typing.Callable[..., T], path: pathlib.Path,
+                 *args: typing.Any) -> T:
+        """
+        ``func(path, *args)`` through the manager's DeviceCalls, so a disk
+        stuck in D-state can only hang one native thread; also given up on
+        at the scan's deadline.
+
+        :raises CallTimeout: if we gave up waiting, or the disk is still
+                             hung from an earlier call
+        """
+        priority = self.manager.io_priority
+
+        @functools.wraps(func)
+        def call(*args: typing.Any) -> T:
+            if priority:
+                set_io_priority(priority)
+            try:
+                return func(*args)
+            finally:
+                if priority:
+                    # back to the default for whatever tpool runs next
+                    set_io_priority(0)
+
+        return self.manager.calls.call(
+            call, path, *args, deadline=self.deadline)
+
 
 if __name__ == "__main__":
     SwiftRingAssignmentTracker.main()
@@ -1,11 +1,17 @@
 import collections
+import functools
+import os
 import re
 import socket
 import sys
 import threading
+import time
+import traceback
+from . import overflow_labels
 from . import Stat
 from . import Tracker
 from . import WriteOnceStatCollection
+from .state_file import open_state_file
 
 
 class PromInf(float):
@@ -82,6 +88,61 @@ class StatsdStat(Stat):
     help = 'stats from Swift StatsD emission'
 
 
+class StatsdPacketsStat(Stat):
+    name = 'statsd_packets'
+    type = 'counter'
+    help = 'StatsD packets received, by whether we made a stat of them'
+
+
+class StatsdSocketDropsStat(Stat):
+    name = 'statsd_socket_drops'
+    type = 'counter'
+    help = 'StatsD packets the kernel dropped because we fell behind'
+
+
+class StatsdSeriesRejectedStat(Stat):
+    name = 'statsd_series_rejected'
+    type = 'counter'
+    help = 'StatsD samples folded into an overflow series, by family'
+
+
+@functools.lru_cache(maxsize=None)
+def created_stat(cls):
+    """
+    The ``<family>_created`` family that goes with a counter family, so a
+    reset (say, because the state file went missing) can be told apart
+    from a quiet spell.
+    """
+    family = cls.name
+    if family.endswith('_bucket'):
+        family = family[:-len('_bucket')]
+    return type(f'{cls.__name__}Created', (Stat,), {
+        'name': f'{family}_created',
+        'type': 'gauge',
+        'help': f'When {family} series started counting (unix time)',
+    })
+
+
+def without_le(labels):
+    return tuple((k, v) for k, v in labels if k != 'le')
+
+
+def socket_drops(inode, proc_net_udp='/proc/net/udp'):
+    """
+    Find the drop counter for the socket with the given inode, or None.
+    """
+    try:
+        with open(proc_net_udp) as fp:
+            next(fp)  # header
+            for line in fp:
+                fields = line.split()
+                if fields[9] == str(inode):
+                    return int(fields[-1])
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
 class StatsdTracker(Tracker):
     REG_EXPS = [
         (re.compile(r"(?P<daemon>(?P<server>proxy)-server)\."
@@ -140,50 +201,150 @@ class StatsdTracker(Tracker):
     def statsd_server(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind(('127.0.0.1', 8125))
+        self.sock_inode = os.fstat(sock.fileno()).st_ino
 
         unhandled_stats = set()
         while True:
             data, _ = sock.recvfrom(2048)
-            line = data.decode('utf8').strip('\n')
-            stat, _, value = line.rpartition(':')
-            value, _, sample_rate = value.partition('|@')
-            sample_rate = float(sample_rate) if sample_rate else 1
-
-            for expr, cls in self.REG_EXPS:
-                m = expr.match(stat)
-                if not m:
-                    continue
-                labels = tuple(m.groupdict().items())
-                if value.endswith('|c'):
-                    self.stats[labels, cls] += int(value[:-2])/sample_rate
-                    if cls is SwiftBytesSentStat:
-                        self.stats[labels, SwiftRequestsStat] += 1/sample_rate
-                    break
-                if value.endswith('|ms'):
-                    # histogram time!
-                    value = float(value[:-3])
-                    for threshold in cls.thresholds:
-                        if value <= threshold:
-                            labels_t = labels + (
-                                ('le', str(threshold)),
-                            )
-                            self.stats[labels_t, cls] += 1/sample_rate
-                    break
-            else:
-                if stat not in unhandled_stats:
-                    print(line, file=sys.stderr)
-                    unhandled_stats.add(stat)
+            try:
+                self.handle(data, unhandled_stats)
+            except ValueError:
+                # bad UTF-8, or a value that isn't a number
+                self.packets['malformed'] += 1
+
+    def handle(self, data, unhandled_stats):
+        line = data.decode('utf8').strip('\n')
+        stat, _, value = line.rpartition(':')
+        value, _, sample_rate = value.partition('|@')
+        sample_rate = float(sample_rate) if sample_rate else 1
+
+        for expr, cls in self.REG_EXPS:
+            m = expr.match(stat)
+            if not m:
+                continue
+            labels = self.fold(tuple(m.groupdict().items()), cls)
+            if value.endswith('|c'):
+                self.stats[labels, cls] += int(value[:-2])/sample_rate
+                if cls is SwiftBytesSentStat:
+                    self.stats[labels, SwiftRequestsStat] += 1/sample_rate
+                self.packets['matched'] += 1
+                break
+            if value.endswith('|ms'):
+                # histogram time!
+                value = float(value[:-3])
+                for threshold in cls.thresholds:
+                    if value <= threshold:
+                        labels_t = labels + (
+                            ('le', str(threshold)),
+                        )
+                        self.stats[labels_t, cls] += 1/sample_rate
+                self.packets['matched'] += 1
+                break
+        else:
+            self.packets['unmatched'] += 1
+            if stat not in unhandled_stats:
+                print(line, file=sys.stderr)
+                unhandled_stats.add(stat)
+
+    def fold(self, labels, cls):
+        """
+        Keep each family to max_series label combinations (not counting
+        histogram buckets); anything new past that gets folded into one.
+        """
+        known = self.label_sets[cls]
+        if labels in known:
+            return labels
+        if len(known) < self.max_series:
+            known.add(labels)
+            return labels
+        self.rejected[cls.name] += 1
+        return overflow_labels(labels)
+
+    def families(self):
+        return {cls.name: cls for _, cls in self.REG_EXPS} | {
+            SwiftRequestsStat.name: SwiftRequestsStat}
+
+    def checkpoint(self):
+        try:
+            self.state.save({
+                'stats': [
+                    [cls.name, labels, value]
+                    for (labels, cls), value in list(self.stats.items())],
+                'created': [
+                    [cls.name, labels, created]
+                    for (labels, cls), created in self.created.items()],
+            })
+        except Exception:
+            traceback.print_exc()
+
+    def restore(self):
+        try:
+            state = self.state.load()
+        except Exception:
+            traceback.print_exc()
+            return
+        if not state:
+            return
+        families = self.families()
+        for name, labels, value in state['stats']:
+            if name not in families:
+                continue  # something we don't collect any more
+            labels = tuple(tuple(label) for label in labels)
+            self.stats[labels, families[name]] = value
+            self.label_sets[families[name]].add(without_le(labels))
+        for name, labels, created in state['created']:
+            if name in families:
+                self.created[tuple(tuple(label) for label in labels),
+                             families[name]] = created
 
     def configure(self, conf):
         self.stats = collections.defaultdict(int)
+        # one odd client could otherwise make a series per method/status
+        self.max_series = int(conf.get('max_series', '1000'))
+        self.label_sets = collections.defaultdict(set)
+        self.rejected = collections.Counter()
+        # (labels without le, cls) -> when we started counting it
+        self.created = {}
+        # off unless given somewhere to keep it
+        state_dir = conf.get('state_dir', '')
+        self.state = open_state_file(conf.get(
+            'state_file',
+            state_dir and os.path.join(state_dir, 'statsd.state')))
+        if self.state is not None:
+            self.restore()
+        self.packets = collections.Counter()
+        self.sock_inode = None
         threading.Thread(target=self.statsd_server, daemon=True).start()
 
     def get_stats(self):
         now = Stat.now()
-        return WriteOnceStatCollection(
+        stats = WriteOnceStatCollection(
             cls(int(value), now, labels)
             for (labels, cls), value in self.stats.items()
         )
+        stats.merge(
+            StatsdPacketsStat(self.packets[result], now, (
+                ('result', result),
+            ))
+            for result in ('matched', 'unmatched', 'malformed')
+        )
+        started = time.time()
+        for labels, cls in list(self.stats):
+            self.created.setdefault((without_le(labels), cls), started)
+        stats.merge(
+            created_stat(cls)(created, now, labels)
+            for (labels, cls), created in self.created.items()
+        )
+        if self.state is not None:
+            self.checkpoint()
+        stats.merge(
+            StatsdSeriesRejectedStat(n, now, (('family', family),))
+            for family, n in sorted(self.rejected.items())
+        )
+        drops = socket_drops(self.sock_inode)
+        if drops is not None:
+            stats.update(StatsdSocketDropsStat(drops, now))
+        return stats
 
 
 if __name__ == '__main__':